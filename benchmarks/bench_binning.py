@@ -1,7 +1,7 @@
 from time import time
 import numpy as np
 from joblib import Memory
-from pygbm.binning import find_bins, map_to_bins
+from pygbm.binning import find_binning_thresholds, map_to_bins
 
 
 m = Memory(location='/tmp')
@@ -16,20 +16,28 @@ def make_data(n_samples=int(1e8), n_features=5, seed=42, dtype=np.float32):
 print("Generating random data...")
 data = make_data(n_samples=int(1e8), n_features=5, seed=42, dtype=np.float32)
 print("Extracting bins from subsample of data...")
-bins = find_bins(data, random_state=0)
+for n_threads in [1, None]:
+    tic = time()
+    bins = find_binning_thresholds(data, random_state=0, n_threads=n_threads)
+    toc = time()
+    print(f"n_threads={n_threads}: done in {toc - tic:0.3f}s")
 
 print("Compiling map_to_bins...")
 tic = time()
 binned = map_to_bins(np.asfortranarray(data[:5]), bins)
+binned = map_to_bins(np.ascontiguousarray(data[:5]), bins)
 toc = time()
 duration = toc - tic
 print(f"done in {duration:0.3f}s")
 
-print("Mapping data to integer bins...")
-tic = time()
-binned = map_to_bins(data, bins)
-toc = time()
-duration = toc - tic
-print(f"Processed {data.nbytes/1e9:0.3f} GB in {duration:0.3f}s"
-      f" ({data.nbytes / 1e6 / duration:0.1f} MB/s)")
+for order in ['C', 'F']:
+    ordered_data = np.asarray(data, order=order)
+    print(f"Mapping {order}-ordered data to integer bins...")
+    tic = time()
+    binned = map_to_bins(ordered_data, bins)
+    toc = time()
+    duration = toc - tic
+    print(f"Processed {data.nbytes/1e9:0.3f} GB in {duration:0.3f}s"
+          f" ({data.nbytes / 1e6 / duration:0.1f} MB/s)")
+    del ordered_data
 print(f"Output size: {binned.nbytes / 1e9:0.3f} GB")
@@ -53,3 +53,38 @@ while grower.can_split_further():
     print(f"done in {toc - tic:0.3f}s")
 
 print(f"{len(grower.finalized_leaves)} leaves in {time() - tree_start:0.3f}s")
+pool = grower.histogram_pool
+print(f"Histogram pool: {pool.n_hits} hits, {pool.n_misses} misses, "
+      f"{pool.n_evictions} evictions, peak {pool.max_n_bytes / 1e6:.1f} MB")
+
+
+def _iter_nodes(node):
+    yield node
+    for child in (node.left_child, node.right_child):
+        if child is not None:
+            yield from _iter_nodes(child)
+
+
+subtraction_nodes = [node for node in _iter_nodes(grower.root)
+                     if node.hist_subtraction]
+subtraction_time = sum(node.find_split_time for node in subtraction_nodes)
+print(f"Time spent finding the best splits: "
+      f"{grower.total_find_split_time:0.3f}s, including "
+      f"{subtraction_time:0.3f}s for the {len(subtraction_nodes)} nodes "
+      f"computed by histogram subtraction")
+
+compact_node_size = int(1e5)
+print(f"Growing the same tree, with the rows of the nodes of at most "
+      f"{compact_node_size:.0e} samples copied into compact blocks...")
+tic = time()
+compact_grower = TreeGrower(binned_features, gradients, hessians,
+                            n_bins=n_bins, max_leaf_nodes=255,
+                            compact_node_size=compact_node_size)
+compact_grower.grow()
+print(f"{len(compact_grower.finalized_leaves)} leaves in "
+      f"{time() - tic:0.3f}s")
+print(f"Time spent finding the best splits: "
+      f"{compact_grower.total_find_split_time:0.3f}s (vs "
+      f"{grower.total_find_split_time:0.3f}s), compacting rows: "
+      f"{compact_grower.total_compact_time:0.3f}s for "
+      f"{compact_grower.total_compact_nbytes / 1e6:.1f} MB")
@@ -1,8 +1,12 @@
 from time import time
 import numpy as np
 from joblib import Memory
+from numba import njit
 from pygbm.histogram import _build_histogram_naive
 from pygbm.histogram import _build_histogram
+from pygbm.histogram import _subtract_histograms
+from pygbm.splitting import (SplittingContext, find_node_split,
+                             _n_sample_chunks, HISTOGRAM_COL_WISE)
 
 
 m = Memory(location='/tmp')
@@ -48,3 +52,146 @@ for func in [_build_histogram_naive, _build_histogram]:
     toc = time()
     duration = toc - tic
     print(f"Built in {duration:.3f}s")
+
+
+# Comparison with the former array-of-structures layout, where a histogram
+# is an array of (sum_gradients, sum_hessians, count) records.
+HISTOGRAM_DTYPE = np.dtype([
+    ('sum_gradients', np.float32),
+    ('sum_hessians', np.float32),
+    ('count', np.uint32),
+])
+
+
+@njit
+def _build_histogram_records(n_bins, sample_indices, binned_feature,
+                             ordered_gradients, ordered_hessians):
+    histogram = np.zeros(n_bins, dtype=HISTOGRAM_DTYPE)
+    for i, sample_idx in enumerate(sample_indices):
+        bin_idx = binned_feature[sample_idx]
+        histogram[bin_idx]['sum_gradients'] += ordered_gradients[i]
+        histogram[bin_idx]['sum_hessians'] += ordered_hessians[i]
+        histogram[bin_idx]['count'] += 1
+    return histogram
+
+
+@njit
+def _subtract_histograms_records(n_bins, hist_a, hist_b):
+    for i in range(n_bins):
+        hist_a[i]['sum_gradients'] -= hist_b[i]['sum_gradients']
+        hist_a[i]['sum_hessians'] -= hist_b[i]['sum_hessians']
+        hist_a[i]['count'] -= hist_b[i]['count']
+    return hist_a
+
+
+@njit
+def _scan_records(n_bins, histogram):
+    gradient_left, hessian_left = 0., 0.
+    best = 0.
+    for bin_idx in range(n_bins):
+        gradient_left += histogram[bin_idx]['sum_gradients']
+        hessian_left += histogram[bin_idx]['sum_hessians']
+        best = max(best, gradient_left ** 2 / (hessian_left + 1.))
+    return best
+
+
+@njit
+def _scan_arrays(n_bins, histogram):
+    gradient_left, hessian_left = 0., 0.
+    best = 0.
+    for bin_idx in range(n_bins):
+        gradient_left += histogram.sum_gradients[bin_idx]
+        hessian_left += histogram.sum_hessians[bin_idx]
+        best = max(best, gradient_left ** 2 / (hessian_left + 1.))
+    return best
+
+
+@njit
+def _subtract_records_loop(n_repeats, n_bins, hist_a, hist_b):
+    for _ in range(n_repeats):
+        histogram = _subtract_histograms_records(n_bins, hist_a, hist_b)
+    return histogram
+
+
+@njit
+def _subtract_arrays_loop(n_repeats, n_bins, hist_a, hist_b):
+    for _ in range(n_repeats):
+        histogram = _subtract_histograms(n_bins, hist_a, hist_b)
+    return histogram
+
+
+@njit
+def _scan_records_loop(n_repeats, n_bins, histogram):
+    best = 0.
+    for _ in range(n_repeats):
+        best += _scan_records(n_bins, histogram)
+    return best
+
+
+@njit
+def _scan_arrays_loop(n_repeats, n_bins, histogram):
+    best = 0.
+    for _ in range(n_repeats):
+        best += _scan_arrays(n_bins, histogram)
+    return best
+
+
+# The subtractions and scans are repeated in compiled loops so that the
+# overhead of calling compiled functions from Python is not measured.
+n_repeats = 100000
+layouts = [
+    ('records', _build_histogram_records, _subtract_records_loop,
+     _scan_records_loop),
+    ('arrays', _build_histogram, _subtract_arrays_loop, _scan_arrays_loop),
+]
+for layout, build, subtract_loop, scan_loop in layouts:
+    # compile
+    hist = build(n_bins, sample_indices[:3], binned_feature, gradients,
+                 hessians)
+    subtract_loop(1, n_bins, hist, hist)
+    scan_loop(1, n_bins, hist)
+
+    tic = time()
+    hist_a = build(n_bins, sample_indices, binned_feature, gradients,
+                   hessians)
+    build_duration = time() - tic
+    hist_b = build(n_bins, sample_indices[::2], binned_feature, gradients,
+                   hessians)
+    tic = time()
+    subtract_loop(n_repeats, n_bins, hist_a, hist_b)
+    subtract_duration = time() - tic
+    tic = time()
+    scan_loop(n_repeats, n_bins, hist_a)
+    scan_duration = time() - tic
+    print(f"{layout} layout: build {build_duration:.3f}s, "
+          f"{n_repeats} subtractions {subtract_duration:.3f}s, "
+          f"{n_repeats} scans {scan_duration:.3f}s")
+
+
+# Root histograms of a dataset with few features, like HIGGS (28 features):
+# with fewer features than threads, the histograms are built in parallel
+# over the features and over chunks of samples.
+n_samples, n_features = int(1e7), 28
+rng = np.random.RandomState(42)
+binned_features = np.asfortranarray(
+    rng.randint(0, n_bins, size=(n_samples, n_features), dtype=np.uint8))
+all_gradients = rng.randn(n_samples).astype(np.float32)
+all_hessians = rng.exponential(size=n_samples).astype(np.float32)
+sample_indices = np.arange(n_samples, dtype=np.uint32)
+for sample_parallel in (False, True):
+    context = SplittingContext(n_features, binned_features, n_bins,
+                               all_gradients, all_hessians, 0., 1e-3, None,
+                               0., None, None, None, None, HISTOGRAM_COL_WISE)
+    if not sample_parallel:
+        # Without per-thread buffers, the histograms are only built in
+        # parallel over the features.
+        context.thread_gradients = np.empty((0, 0), dtype=np.float32)
+        context.thread_hessians = np.empty((0, 0), dtype=np.float32)
+        context.thread_count = np.empty((0, 0), dtype=np.uint32)
+    n_chunks = _n_sample_chunks(context, n_samples)
+    find_node_split(context, sample_indices[:1000])  # compile
+    tic = time()
+    find_node_split(context, sample_indices)
+    duration = time() - tic
+    print(f"Root split of {n_samples:.0e} samples x {n_features} features "
+          f"with {n_chunks} chunk(s) of samples per feature: {duration:.3f}s")
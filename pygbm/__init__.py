@@ -1,5 +1,6 @@
 from pygbm.gradient_boosting import GradientBoostingMachine
+from pygbm.dataset import BinnedDataset
 
 
 __version__ = '0.1.0.dev0'
-__all__ = ['GradientBoostingMachine']
+__all__ = ['GradientBoostingMachine', 'BinnedDataset']
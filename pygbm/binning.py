@@ -1,24 +1,55 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from numba import njit, prange
+import numba
+from numba import njit, prange, uint32, from_dtype
+from scipy.sparse import issparse, csc_matrix
 from sklearn.utils import check_random_state, check_array
 from sklearn.base import BaseEstimator, TransformerMixin
 
+from .bitset import MAX_N_CATEGORIES
+
+# The largest number of bins that can be coded with each binned dtype.
+MAX_BINS_UINT8 = 256
+MAX_BINS_UINT16 = 65536
+
+
+def get_binned_dtype(max_bins):
+    """Return the smallest dtype that can code max_bins bins.
+
+    uint8 is used whenever possible: it is the compact (and fastest) layout.
+    The missing values bin is not included in max_bins.
+    """
+    if max_bins <= MAX_BINS_UINT8:
+        return np.uint8
+    return np.uint16
+
 
 def find_binning_thresholds(data, max_bins=255, subsample=int(2e5),
-                            random_state=None):
+                            random_state=None, n_threads=None):
     """Extract feature-wise equally-spaced quantiles from numerical data
 
     Subsample the dataset if too large as the feature-wise quantiles
-    should be stable.
+    should be stable. Missing values (NaN) are ignored: they are mapped to a
+    dedicated bin by map_to_bins.
+
+    Sparse data is processed without densification: the implicit zeros of
+    a column only make a difference when the column has more than max_bins
+    distinct values.
+
+    The thresholds of the different features are computed in parallel by a
+    pool of threads: the sorting and partitioning routines of numpy release
+    the GIL.
 
     Parameters
     ----------
-    data: array-like (n_samples, n_features)
+    data: array-like or sparse matrix (n_samples, n_features)
         The numerical dataset to analyse.
 
     max_bins: int
-        The number of bins to extract for each feature. As we code the binned
-        values as 8-bit integers, max_bins should be no larger than 256.
+        The number of bins to extract for each feature. The binned values are
+        coded as 8-bit integers up to 256 bins and as 16-bit integers
+        otherwise: max_bins should be no larger than 65536.
 
     subsample: int
         Number of random subsamples to consider to compute the quantiles.
@@ -26,6 +57,10 @@ def find_binning_thresholds(data, max_bins=255, subsample=int(2e5),
     random_state: int or numpy.random.RandomState or None
         Pseudo-random number generator to control the random sub-sampling.
 
+    n_threads: int or None
+        Number of threads used to process the features concurrently. If None,
+        numba's default number of threads is used.
+
     Return
     ------
     binning_thresholds: tuple of arrays
@@ -35,8 +70,9 @@ def find_binning_thresholds(data, max_bins=255, subsample=int(2e5),
         Each array has size (n_bins - 1) where:
             n_bins == min(max_bins, len(np.unique(data[:, feature_idx])))
     """
-    if max_bins > 256:
-        raise ValueError(f'max_bins should no larger than 256, got {max_bins}')
+    if max_bins > MAX_BINS_UINT16:
+        raise ValueError(f'max_bins should no larger than {MAX_BINS_UINT16}, '
+                         f'got {max_bins}')
     rng = check_random_state(random_state)
     if data.shape[0] > subsample:
         subset = rng.choice(np.arange(data.shape[0]), subsample)
@@ -46,55 +82,212 @@ def find_binning_thresholds(data, max_bins=255, subsample=int(2e5),
         dtype = np.float32
 
     percentiles = np.linspace(0, 100, num=max_bins + 1)[1:-1]
-    binning_thresholds = []
-    for f_idx in range(data.shape[1]):
-        col_data = np.ascontiguousarray(data[:, f_idx], dtype=dtype)
-        distinct_values = np.unique(col_data)
-        if len(distinct_values) <= max_bins:
-            midpoints = (distinct_values[:-1] + distinct_values[1:])
-            midpoints *= .5
-        else:
-            # We sort again the data in this case. We could compute
-            # approximate midpoint percentiles using the output of
-            # np.unique(col_data, return_counts) instead but this is more
-            # work and the performance benefit will be limited because we
-            # work on a fixed-size subsample of the full data.
-            midpoints = np.percentile(col_data, percentiles,
-                                      interpolation='midpoint').astype(dtype)
-        binning_thresholds.append(midpoints)
-    return tuple(binning_thresholds)
-
-
-def map_to_bins(data, binning_thresholds=None, out=None):
+
+    if issparse(data):
+        data = data.tocsc()
+
+        def find_column_thresholds(f_idx):
+            start, stop = data.indptr[f_idx], data.indptr[f_idx + 1]
+            col_data = np.asarray(data.data[start:stop], dtype=dtype)
+            n_zeros = data.shape[0] - col_data.shape[0]
+            if n_zeros > 0:
+                distinct_values = np.unique(np.append(col_data, 0))
+                distinct_values = distinct_values[~np.isnan(distinct_values)]
+                if len(distinct_values) <= max_bins:
+                    return _find_column_thresholds(distinct_values, max_bins,
+                                                   percentiles)
+                col_data = np.append(col_data, np.zeros(n_zeros, dtype))
+            return _find_column_thresholds(col_data, max_bins, percentiles)
+    else:
+        def find_column_thresholds(f_idx):
+            col_data = np.ascontiguousarray(data[:, f_idx], dtype=dtype)
+            return _find_column_thresholds(col_data, max_bins, percentiles)
+
+    return _map_features(find_column_thresholds, data.shape[1], n_threads)
+
+
+def _map_features(function, n_features, n_threads=None):
+    """Return the tuple of function(f_idx) for all the features.
+
+    The features are processed concurrently by a pool of n_threads threads
+    (numba's default number of threads if None).
+    """
+    if n_threads is None:
+        n_threads = numba.config.NUMBA_DEFAULT_NUM_THREADS
+    if n_threads == 1 or n_features == 1:
+        return tuple(map(function, range(n_features)))
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return tuple(executor.map(function, range(n_features)))
+
+
+def _find_column_thresholds(col_data, max_bins, percentiles):
+    """Return the bin thresholds of a single contiguous feature column."""
+    col_data = col_data[~np.isnan(col_data)]
+    distinct_values = np.unique(col_data)
+    if len(distinct_values) <= max_bins:
+        midpoints = (distinct_values[:-1] + distinct_values[1:])
+        midpoints *= .5
+    else:
+        # We sort again the data in this case. We could compute
+        # approximate midpoint percentiles using the output of
+        # np.unique(col_data, return_counts) instead but this is more
+        # work and the performance benefit will be limited because we
+        # work on a fixed-size subsample of the full data.
+        midpoints = np.percentile(col_data, percentiles,
+                                  interpolation='midpoint')
+        midpoints = midpoints.astype(col_data.dtype)
+    return midpoints
+
+
+def map_to_bins(data, binning_thresholds=None, out=None,
+                missing_values_bin_idx=255, dtype=np.uint8):
     """Bin numerical values to discrete integer-coded levels.
 
-    # TODO: write doc for params and returned value.
+    C-contiguous data is binned by a single kernel that processes blocks of
+    contiguous rows in parallel. Other memory layouts are binned feature by
+    feature, which is efficient for Fortran-ordered data.
+
+    Only the stored entries of sparse data are binned, column by column: the
+    implicit zeros of a feature are mapped to the bin of the value 0, see
+    find_zero_bins.
+
+    Parameters
+    ----------
+    data: array-like or sparse matrix (n_samples, n_features)
+        The numerical data to bin.
+
+    binning_thresholds: tuple of arrays
+        For each feature, the increasing thresholds separating the bins, as
+        returned by find_binning_thresholds.
+
+    out: array-like (n_samples, n_features) or None
+        Fortran-ordered array of dtype into which the binned data is written,
+        e.g. a np.memmap. Row slices of a Fortran-contiguous array are
+        accepted so that a large output can be filled chunk by chunk. If
+        None, a new array is allocated.
+
+    missing_values_bin_idx: int
+        The bin into which missing values (NaN) are mapped. It should be
+        larger than the number of thresholds of any feature.
+
+    dtype: np.uint8 or np.uint16
+        The dtype of the binned data, see get_binned_dtype.
+
+    Return
+    ------
+    binned: array or CSR matrix (n_samples, n_features)
+        The binned data (out if it was provided). Sparse data is
+        binned into a CSR matrix with sorted indices, the layout used by the
+        TreeGrower.
     """
-    # TODO: add support for categorical data encoded as integers
-    # TODO: add support for sparse data (numerical or categorical)
+    if missing_values_bin_idx > np.iinfo(dtype).max:
+        # The data was fitted without missing values and all the bins of
+        # dtype are taken: NaN would silently be mapped to a wrong bin.
+        values = data.data if issparse(data) else data
+        if np.isnan(values).any():
+            raise ValueError(
+                f'The data has missing values but there is no room for the '
+                f'missing values bin (bin {missing_values_bin_idx}) in '
+                f'{np.dtype(dtype).name} binned data: fit the BinMapper '
+                f'with max_bins <= {np.iinfo(dtype).max} or on data with '
+                f'missing values')
+    if issparse(data):
+        if out is not None:
+            raise ValueError('out is not supported for sparse data')
+        return _map_sparse_to_bins(data, binning_thresholds,
+                                   missing_values_bin_idx, dtype)
+
     if out is not None:
         assert out.shape == data.shape
-        assert out.dtype == np.uint8
-        assert out.flags.f_contiguous
+        assert out.dtype == dtype
+        assert out.flags.f_contiguous or out.strides[0] == out.itemsize
         binned = out
     else:
-        binned = np.zeros_like(data, dtype=np.uint8, order='F')
+        binned = np.zeros_like(data, dtype=dtype, order='F')
 
     binning_thresholds = tuple(np.ascontiguousarray(bt, dtype=np.float32)
                                for bt in binning_thresholds)
 
+    if data.flags.c_contiguous and data.shape[1] > 1:
+        n_thresholds = np.array([bt.shape[0] for bt in binning_thresholds],
+                                dtype=np.uint32)
+        all_thresholds = np.zeros((data.shape[1], max(n_thresholds.max(), 1)),
+                                  dtype=np.float32)
+        for feature_idx, bt in enumerate(binning_thresholds):
+            all_thresholds[feature_idx, :bt.shape[0]] = bt
+        _map_num_rows_to_bins(data, all_thresholds, n_thresholds, binned,
+                              missing_values_bin_idx)
+        return binned
+
     for feature_idx in range(data.shape[1]):
         _map_num_col_to_bins(data[:, feature_idx],
                              binning_thresholds[feature_idx],
-                             binned[:, feature_idx])
+                             binned[:, feature_idx], missing_values_bin_idx)
     return binned
 
 
+def _map_sparse_to_bins(data, binning_thresholds, missing_values_bin_idx,
+                        dtype):
+    data = data.tocsc()
+    if not data.has_canonical_format:
+        data = data.copy()
+        data.sum_duplicates()
+    # The thresholds of all the features are concatenated: padding them to
+    # a 2D array would cost O(n_features * max_bins) for wide data.
+    thresholds_offsets = np.zeros(data.shape[1] + 1, dtype=np.int64)
+    thresholds_offsets[1:] = np.cumsum([bt.shape[0]
+                                        for bt in binning_thresholds])
+    all_thresholds = np.concatenate(
+        [np.asarray(bt, dtype=np.float32) for bt in binning_thresholds] +
+        [np.empty(0, dtype=np.float32)])
+    binned_data = np.empty(data.data.shape[0], dtype=dtype)
+    _map_sparse_cols_to_bins(data.data, data.indptr, all_thresholds,
+                             thresholds_offsets, binned_data,
+                             missing_values_bin_idx)
+    binned = csc_matrix((binned_data, data.indices, data.indptr),
+                        shape=data.shape)
+    return binned.tocsr()
+
+
+@njit(parallel=True)
+def _map_sparse_cols_to_bins(data, indptr, all_thresholds, thresholds_offsets,
+                             binned, missing_values_bin_idx):
+    """Bin the stored entries of a CSC matrix, one column per thread."""
+    for feature_idx in prange(indptr.shape[0] - 1):
+        thresholds_start = thresholds_offsets[feature_idx]
+        n_thresholds = thresholds_offsets[feature_idx + 1] - thresholds_start
+        for i in range(indptr[feature_idx], indptr[feature_idx + 1]):
+            value = data[i]
+            if np.isnan(value):
+                binned[i] = missing_values_bin_idx
+                continue
+            left, right = 0, n_thresholds
+            while left < right:
+                middle = (right + left - 1) // 2
+                if value <= all_thresholds[thresholds_start + middle]:
+                    right = middle
+                else:
+                    left = middle + 1
+            binned[i] = left
+
+
+def find_zero_bins(binning_thresholds, dtype=np.uint8):
+    """Return the bin of the value 0 for each feature.
+
+    This is the bin of the implicit zeros of sparse data.
+    """
+    return np.array([np.searchsorted(bt, 0, side='left')
+                     for bt in binning_thresholds], dtype=dtype)
+
+
 @njit(parallel=True)
-def _map_num_col_to_bins(data, binning_thresholds, binned):
+def _map_num_col_to_bins(data, binning_thresholds, binned,
+                         missing_values_bin_idx):
     """Binary search to the find the bin index for each value in data."""
     for i in prange(data.shape[0]):
-        # TODO: add support for missing values (NaN or custom marker)
+        if np.isnan(data[i]):
+            binned[i] = missing_values_bin_idx
+            continue
         left, right = 0, binning_thresholds.shape[0]
         while left < right:
             middle = (right + left - 1) // 2
@@ -105,20 +298,691 @@ def _map_num_col_to_bins(data, binning_thresholds, binned):
         binned[i] = left
 
 
+@njit(parallel=True)
+def _map_num_rows_to_bins(data, all_thresholds, n_thresholds, binned,
+                          missing_values_bin_idx):
+    """Bin all the features of C-contiguous data in a single pass.
+
+    Each thread processes a block of consecutive rows so that data is read
+    contiguously. The blocks are a multiple of the cache line size so that
+    the threads do not write in the same cache lines of the Fortran-ordered
+    output.
+
+    all_thresholds has shape (n_features, max_n_thresholds): only the first
+    n_thresholds[feature_idx] values of each row are used.
+    """
+    rows_per_block = 1024
+    n_samples, n_features = data.shape
+    n_blocks = (n_samples + rows_per_block - 1) // rows_per_block
+    for block_idx in prange(n_blocks):
+        start = block_idx * rows_per_block
+        stop = min(start + rows_per_block, n_samples)
+        for i in range(start, stop):
+            for feature_idx in range(n_features):
+                value = data[i, feature_idx]
+                if np.isnan(value):
+                    binned[i, feature_idx] = missing_values_bin_idx
+                    continue
+                left, right = 0, n_thresholds[feature_idx]
+                while left < right:
+                    middle = (right + left - 1) // 2
+                    if value <= all_thresholds[feature_idx, middle]:
+                        right = middle
+                    else:
+                        left = middle + 1
+                binned[i, feature_idx] = left
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch of all the columns of a numerical dataset.
+
+    This is a simplified KLL sketch (Karnin, Lang and Liberty, 2016) where
+    the features are summarized jointly: each level of the sketch is an
+    array of shape (n_items, n_features) and each item of level h stands
+    for 2 ** h samples of the original data. When a level holds more than
+    sketch_size items, its columns are sorted and every other item (with a
+    random offset) is promoted to the next level.
+
+    The memory footprint is O(sketch_size * log(n_samples) * n_features)
+    whatever the number of samples that have been fed to the sketch.
+    Sketches that were built on different chunks of the data (e.g. by
+    different workers) can be combined with merge().
+
+    Parameters
+    ----------
+    n_features: int
+        The number of columns of the summarized data.
+
+    sketch_size: int
+        The maximum number of items of a level before it gets compacted.
+        The relative rank error of the quantiles is O(1 / sketch_size).
+
+    random_state: int or numpy.random.RandomState or None
+        Pseudo-random number generator to control the compactions.
+    """
+
+    def __init__(self, n_features, sketch_size=2048, random_state=None):
+        self.n_features = n_features
+        self.sketch_size = sketch_size
+        self.random_state = check_random_state(random_state)
+        self.levels = []
+        self.n_samples = 0
+
+    def update(self, data):
+        """Add the rows of data (n_samples, n_features) to the sketch."""
+        if data.shape[1] != self.n_features:
+            raise ValueError(f'Expected {self.n_features} features, got '
+                             f'{data.shape[1]}')
+        if data.dtype.kind != 'f':
+            data = data.astype(np.float32)
+        self._add_items(0, data)
+        self.n_samples += data.shape[0]
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """Add all the items summarized by other to this sketch."""
+        if other.n_features != self.n_features:
+            raise ValueError(f'Cannot merge sketches with {other.n_features} '
+                             f'and {self.n_features} features')
+        for level_idx, items in enumerate(other.levels):
+            self._add_items(level_idx, items)
+        self.n_samples += other.n_samples
+        self._compress()
+        return self
+
+    def binning_thresholds(self, max_bins=255, n_threads=None):
+        """Return the bin thresholds of each feature.
+
+        The thresholds follow the same rules as find_binning_thresholds: as
+        long as no compaction occurred, the sketch holds the exact data and
+        the results are identical. Otherwise the midpoint percentiles are
+        computed on the weighted items of the sketch. Like in
+        find_binning_thresholds, the features are processed by a pool of
+        n_threads threads.
+        """
+        if max_bins > MAX_BINS_UINT16:
+            raise ValueError(f'max_bins should no larger than '
+                             f'{MAX_BINS_UINT16}, got {max_bins}')
+        if self.n_samples == 0:
+            raise ValueError('Cannot compute thresholds of an empty sketch')
+        percentiles = np.linspace(0, 100, num=max_bins + 1)[1:-1]
+        if len(self.levels) == 1:
+            def find_column_thresholds(f_idx):
+                return _find_column_thresholds(
+                    np.ascontiguousarray(self.levels[0][:, f_idx]),
+                    max_bins, percentiles)
+            return _map_features(find_column_thresholds, self.n_features,
+                                 n_threads)
+
+        weights = np.concatenate([
+            np.full(items.shape[0], 2 ** level_idx, dtype=np.int64)
+            for level_idx, items in enumerate(self.levels)])
+        data = np.concatenate(self.levels)
+
+        def find_column_thresholds(f_idx):
+            col_data = data[:, f_idx]
+            not_missing = ~np.isnan(col_data)
+            col_data, col_weights = col_data[not_missing], weights[not_missing]
+            distinct_values, inverse = np.unique(col_data,
+                                                 return_inverse=True)
+            if len(distinct_values) <= max_bins:
+                midpoints = (distinct_values[:-1] + distinct_values[1:])
+                midpoints *= .5
+            else:
+                # Weighted version of the 'midpoint' interpolation of
+                # np.percentile.
+                counts = np.bincount(inverse, weights=col_weights,
+                                     minlength=len(distinct_values))
+                cum_counts = np.cumsum(counts)
+                ranks = percentiles / 100 * (cum_counts[-1] - 1)
+                lower = np.searchsorted(cum_counts, np.floor(ranks),
+                                        side='right')
+                upper = np.searchsorted(cum_counts, np.ceil(ranks),
+                                        side='right')
+                midpoints = (distinct_values[lower] +
+                             distinct_values[upper]) * .5
+            return midpoints.astype(col_data.dtype)
+
+        return _map_features(find_column_thresholds, self.n_features,
+                             n_threads)
+
+    def _add_items(self, level_idx, items):
+        while len(self.levels) <= level_idx:
+            self.levels.append(items[:0])
+        self.levels[level_idx] = np.concatenate([self.levels[level_idx],
+                                                 items])
+
+    def _compress(self):
+        level_idx = 0
+        while level_idx < len(self.levels):
+            items = self.levels[level_idx]
+            if items.shape[0] > self.sketch_size:
+                items = np.sort(items, axis=0)
+                # An odd item out is kept in the current level.
+                n_compacted = items.shape[0] - items.shape[0] % 2
+                offset = self.random_state.randint(2)
+                self.levels[level_idx] = items[n_compacted:]
+                self._add_items(level_idx + 1,
+                                items[offset:n_compacted:2])
+            level_idx += 1
+
+
+def find_feature_bundles(binned, zero_bins, n_bins, candidates,
+                         max_bins=255):
+    """Greedily group mutually exclusive features into bundles.
+
+    Two features are exclusive if no sample has a non-zero value (a bin
+    different from the zero bin) for both of them. Following Exclusive
+    Feature Bundling (Ke et al., LightGBM, 2017), the candidate features are
+    considered by decreasing number of non-zero values and each of them is
+    added to the first bundle it does not conflict with. The value 0 of a
+    bundle column stands for the zero bins of all its features, which then
+    take n_bins[feature_idx] consecutive values each: the values of a bundle
+    have to fit in [0, max_bins).
+
+    Parameters
+    ----------
+    binned: array or sparse matrix (n_samples, n_features)
+        The binned data (usually a subsample) used to detect the conflicts.
+
+    zero_bins: array (n_features,)
+        The bin of the value 0 of each feature.
+
+    n_bins: array of int (n_features,)
+        The number of bins of each feature, missing values bin excluded.
+
+    candidates: array of bool (n_features,)
+        The features that may be bundled with others. The other features
+        are given a bundle of their own.
+
+    max_bins: int
+        The number of values available in a bundle column.
+
+    Return
+    ------
+    bundles: list of arrays of int
+        The features of each bundle, sorted by index of their first feature.
+        Features that are not bundled with others are single-feature
+        bundles.
+    """
+    n_samples, n_features = binned.shape
+    if issparse(binned):
+        binned = binned.tocsc()
+    nonzero_rows = []
+    for feature_idx in range(n_features):
+        if issparse(binned):
+            start, stop = binned.indptr[feature_idx:feature_idx + 2]
+            rows = binned.indices[start:stop]
+            bins = binned.data[start:stop]
+        else:
+            rows = np.arange(n_samples)
+            bins = binned[:, feature_idx]
+        nonzero_rows.append(rows[bins != zero_bins[feature_idx]])
+
+    bundles = []
+    bundle_masks = []  # the samples with a non-zero value in each bundle
+    bundle_sizes = []  # the number of values used in each bundle column
+    order = np.argsort([-len(rows) for rows in nonzero_rows], kind='stable')
+    for feature_idx in order:
+        rows = nonzero_rows[feature_idx]
+        if candidates[feature_idx]:
+            for bundle_idx, mask in enumerate(bundle_masks):
+                if (mask is not None and
+                        bundle_sizes[bundle_idx] + n_bins[feature_idx]
+                        <= max_bins and not mask[rows].any()):
+                    bundles[bundle_idx].append(feature_idx)
+                    mask[rows] = True
+                    bundle_sizes[bundle_idx] += n_bins[feature_idx]
+                    break
+            else:
+                mask = np.zeros(n_samples, dtype=bool)
+                mask[rows] = True
+                bundles.append([feature_idx])
+                bundle_masks.append(mask)
+                bundle_sizes.append(1 + n_bins[feature_idx])
+        else:
+            bundles.append([feature_idx])
+            bundle_masks.append(None)
+            bundle_sizes.append(max_bins)
+    bundles = [np.sort(bundle) for bundle in bundles]
+    bundles.sort(key=lambda bundle: bundle[0])
+    return bundles
+
+
+def find_packed_columns(columns, n_bins, max_packed_bins=15):
+    """Pair the low-cardinality features into 4-bit packed columns.
+
+    The features of the single-feature columns that have no more than
+    max_packed_bins bins are packed two by two (in the order of their
+    indices) into a column, one feature in each half of the bytes. The
+    value 15 of a half is reserved to the missing values.
+
+    Return
+    ------
+    columns: list of arrays of int
+        The features of each column, sorted by index of their first feature.
+
+    is_packed: array of bool (n_columns,)
+        Whether the features of each column are 4-bit packed. The other
+        columns hold a single feature or a bundle of features.
+    """
+    packable = [column[0] for column in columns
+                if len(column) == 1 and n_bins[column[0]] <= max_packed_bins]
+    packed_columns = [np.array(packable[i:i + 2])
+                      for i in range(0, len(packable), 2)]
+    packable = set(packable)
+    columns = [column for column in columns
+               if len(column) > 1 or column[0] not in packable]
+    is_packed = [False] * len(columns) + [True] * len(packed_columns)
+    columns += packed_columns
+    order = sorted(range(len(columns)), key=lambda i: columns[i][0])
+    return ([columns[i] for i in order],
+            np.array([is_packed[i] for i in order], dtype=bool))
+
+
+FEATURE_LAYOUT_DTYPE = np.dtype([
+    ('column', np.uint32),  # column of the binned data holding the feature
+    ('shift', np.uint32),  # bit position of the feature in the column value
+    ('mask', np.uint32),  # bits of the shifted column value to keep
+    ('offset', np.uint32),  # value coding the bin 0 of the feature
+    ('width', np.uint32),  # number of values coding bins, from offset
+    ('default_bin', np.uint32),  # bin of the values outside of the range
+])
+FEATURE_LAYOUT_NUMBA_TYPE = from_dtype(FEATURE_LAYOUT_DTYPE)[::1]
+
+
+def make_feature_layout(columns, is_packed, n_bins, zero_bins,
+                        missing_values_bin_idx=255):
+    """Return the array locating the bins of each feature in the columns.
+
+    The bin of a feature is decoded from the value of its column by
+    decode_bin: the value is shifted and masked, then the values in
+    [offset, offset + width) code the bins 0 to width - 1 and the other
+    values code default_bin. This covers the three kinds of columns:
+
+    - a single feature: its bins are the values of the column.
+    - a bundle of mutually exclusive features (see find_feature_bundles):
+      the value 0 codes the zero bins of all the features, the bins of each
+      feature are shifted by an offset.
+    - two 4-bit packed features (see find_packed_columns): each half of the
+      bytes holds the bin of a feature, the value 15 coding the missing
+      values.
+
+    Return
+    ------
+    feature_layout: array of FEATURE_LAYOUT_DTYPE (n_features,)
+    """
+    feature_layout = identity_feature_layout(n_bins.shape[0])
+    for column_idx, column in enumerate(columns):
+        feature_layout['column'][column] = column_idx
+        if is_packed[column_idx]:
+            feature_layout['shift'][column] = np.arange(len(column)) * 4
+            feature_layout['mask'][column] = 0xF
+            feature_layout['width'][column] = 15
+            feature_layout['default_bin'][column] = missing_values_bin_idx
+        elif len(column) > 1:
+            feature_layout['offset'][column] = 1 + np.concatenate(
+                [[0], np.cumsum(n_bins[column])[:-1]])
+            feature_layout['width'][column] = n_bins[column]
+            feature_layout['default_bin'][column] = zero_bins[column]
+    return feature_layout
+
+
+@njit
+def identity_feature_layout(n_features):
+    """Return the layout of binned data with one column per feature."""
+    feature_layout = np.zeros(n_features, dtype=FEATURE_LAYOUT_DTYPE)
+    for feature_idx in range(n_features):
+        feature_layout[feature_idx]['column'] = feature_idx
+        feature_layout[feature_idx]['mask'] = MAX_BINS_UINT16 - 1
+        feature_layout[feature_idx]['width'] = MAX_BINS_UINT16
+    return feature_layout
+
+
+@njit
+def decode_bin(feature_layout, feature_idx, value):
+    """Return the bin of feature_idx given the value of its column."""
+    layout = feature_layout[feature_idx]
+    value = (uint32(value) >> layout['shift']) & layout['mask']
+    offset = layout['offset']
+    if offset <= value < offset + layout['width']:
+        return uint32(value - offset)
+    return layout['default_bin']
+
+
+def pack_binned_features(binned, zero_bins, columns, is_packed,
+                         feature_layout, missing_values_bin_idx=255,
+                         out=None):
+    """Pack the binned features into their columns, see make_feature_layout
+
+    If several features of a bundle are non-zero for the same sample (a
+    conflict), the last one wins. The missing values of bundled features
+    are mapped to their zero bin.
+
+    Sparse binned data is packed into a dense array: the point of bundling
+    is to turn many sparse features into a few dense columns.
+    """
+    n_samples = binned.shape[0]
+    if out is None:
+        dtype = binned.data.dtype if issparse(binned) else binned.dtype
+        out = np.zeros((n_samples, len(columns)), dtype=dtype, order='F')
+    else:
+        assert out.shape == (n_samples, len(columns))
+        out[:] = 0
+    if issparse(binned):
+        binned = binned.tocsc()
+
+    for column_idx, column in enumerate(columns):
+        is_bundle = len(column) > 1 and not is_packed[column_idx]
+        for feature_idx in column:
+            layout = feature_layout[feature_idx]
+            if issparse(binned):
+                start, stop = binned.indptr[feature_idx:feature_idx + 2]
+                rows = binned.indices[start:stop]
+                bins = binned.data[start:stop]
+                if not is_bundle:
+                    # The implicit zeros are coded as well.
+                    dense_bins = np.full(n_samples, zero_bins[feature_idx],
+                                         dtype=bins.dtype)
+                    dense_bins[rows] = bins
+                    rows, bins = np.arange(n_samples), dense_bins
+            else:
+                rows = np.arange(n_samples)
+                bins = binned[:, feature_idx]
+            if is_packed[column_idx]:
+                values = np.where(bins == missing_values_bin_idx, 15, bins)
+                out[rows, column_idx] |= (values.astype(out.dtype) <<
+                                          out.dtype.type(layout['shift']))
+            elif is_bundle:
+                nonzero = ((bins != zero_bins[feature_idx]) &
+                           (bins != missing_values_bin_idx))
+                out[rows[nonzero], column_idx] = (bins[nonzero] +
+                                                  layout['offset'])
+            else:
+                out[rows, column_idx] = bins
+    return out
+
+
 class BinMapper(BaseEstimator, TransformerMixin):
-    # TODO: write docstrings
+    """Transformer that maps a dataset into integer-valued bins.
+
+    The bins are created in a feature-wise fashion, with equally-spaced
+    quantiles. Missing values (NaN) are mapped to the dedicated bin
+    missing_values_bin_idx_ == max_bins.
+
+    The binned data is coded as uint8 up to max_bins=256 (255 with missing
+    values) and as uint16 for larger values of max_bins, e.g. to bin some
+    high-resolution features into 1024 bins. The binned_dtype_ attribute
+    holds the dtype of the binned data.
+
+    Sparse matrices are binned into CSR matrices of the same sparsity
+    pattern: the zero_bins_ attribute holds the bin of the implicit zeros of
+    each feature.
+
+    Parameters
+    ----------
+    max_bins: int
+        The maximum number of bins to use. If for a given feature the number
+        of unique values is less than max_bins, then those unique values
+        will be used to compute the bin thresholds, instead of the quantiles.
+        It should be no larger than 65536 (65535 with missing values).
+
+    subsample: int
+        If n_samples > subsample, then subsample samples will be randomly
+        selected to compute the quantiles. Not used by partial_fit.
+
+    sketch_size: int
+        Capacity of the levels of the quantile sketch used by partial_fit.
+
+    random_state: int or numpy.random.RandomState or None
+        Pseudo-random number generator to control the random sub-sampling
+        and the compactions of the quantile sketch.
+
+    categorical_features: array-like of int or bool or None
+        Indices (or boolean mask) of the categorical features. Categories
+        must be encoded as integers in [0, max_bins): category c is mapped
+        to bin c. The is_categorical_ attribute holds the resulting boolean
+        mask. At transform time, unknown categories are treated as missing
+        values. Categorical features require max_bins <= 256.
+
+    bundle_features: bool
+        Whether to bundle mutually exclusive features (features that are
+        never non-zero for the same sample of the fitted data, see
+        find_feature_bundles) into shared columns. Only numerical features
+        without missing values are bundled. Not supported by partial_fit.
+
+    pack_features: bool
+        Whether to pack the features with no more than 15 bins (16 with the
+        missing values bin) two by two into uint8 columns, each of them
+        taking 4 bits, see find_packed_columns. This halves the memory
+        traffic of the histograms of these features. Only used when the
+        binned data is uint8.
+
+    When features are bundled or packed, transform returns one column per
+    bundle or pair of packed features: the columns_ attribute holds the
+    features of each column, is_packed_column_ tells whether they are
+    packed and feature_layout_ (see make_feature_layout) locates the bins of
+    each feature in the columns. Otherwise, feature_layout_ is None.
+    """
 
-    def __init__(self, max_bins=255, subsample=int(1e5), random_state=None):
+    def __init__(self, max_bins=255, subsample=int(1e5), sketch_size=2048,
+                 random_state=None, categorical_features=None,
+                 bundle_features=False, pack_features=False):
         self.max_bins = max_bins
         self.subsample = subsample
+        self.sketch_size = sketch_size
         self.random_state = random_state
+        self.categorical_features = categorical_features
+        self.bundle_features = bundle_features
+        self.pack_features = pack_features
 
     def fit(self, X, y=None):
-        X = check_array(X)
-        self.bin_thresholds_ = find_binning_thresholds(
+        X = check_array(X, accept_sparse=['csr', 'csc'],
+                        force_all_finite='allow-nan')
+        self._check_missing_values_bin(X)
+        self._check_categorical_features(X)
+        self._set_bin_thresholds(find_binning_thresholds(
             X, self.max_bins, subsample=self.subsample,
-            random_state=self.random_state)
+            random_state=self.random_state))
+        self._set_columns(X)
+        self._sketch_updated = False
         return self
 
-    def transform(self, X):
-        return map_to_bins(X, binning_thresholds=self.bin_thresholds_)
+    def partial_fit(self, X, y=None):
+        """Update the bin thresholds with a new chunk of data.
+
+        The chunks are summarized in one streaming pass by a QuantileSketch
+        stored in the sketch_ attribute, so that X never has to fit in memory
+        as a whole. The thresholds are only computed from the sketch when
+        they are first needed (e.g. by transform) after the last chunk.
+        """
+        if self.bundle_features:
+            raise ValueError('bundle_features is not supported by '
+                             'partial_fit')
+        X = check_array(X, force_all_finite='allow-nan')
+        self._check_missing_values_bin(X)
+        self._check_categorical_features(X)
+        if not hasattr(self, 'sketch_'):
+            self.sketch_ = QuantileSketch(X.shape[1], self.sketch_size,
+                                          random_state=self.random_state)
+        self.sketch_.update(X)
+        self._reset_sketch_attributes()
+        return self
+
+    def merge(self, other):
+        """Merge the sketch of another mapper fitted with partial_fit."""
+        for mapper in (self, other):
+            if not hasattr(mapper, 'sketch_'):
+                raise ValueError('Only mappers fitted with partial_fit can '
+                                 'be merged')
+        self.sketch_.merge(other.sketch_)
+        self._reset_sketch_attributes()
+        return self
+
+    # The attributes computed from the sketch of partial_fit.
+    _SKETCH_ATTRIBUTES = ('bin_thresholds_', 'zero_bins_', 'columns_',
+                          'is_packed_column_', 'feature_layout_')
+
+    def _reset_sketch_attributes(self):
+        for name in self._SKETCH_ATTRIBUTES:
+            self.__dict__.pop(name, None)
+        self._sketch_updated = True
+
+    def __getattr__(self, name):
+        # Only called for missing attributes: the attributes of partial_fit
+        # are computed once, when first accessed after the last chunk.
+        if (name in BinMapper._SKETCH_ATTRIBUTES and
+                self.__dict__.get('_sketch_updated', False)):
+            self._sketch_updated = False
+            self._set_bin_thresholds(
+                self.sketch_.binning_thresholds(self.max_bins))
+            self._set_columns(None)
+            return getattr(self, name)
+        raise AttributeError(f"'{type(self).__name__}' object has no "
+                             f"attribute '{name}'")
+
+    def transform(self, X, out=None):
+        X = self._mask_unknown_categories(X)
+        if self.feature_layout_ is None:
+            return map_to_bins(
+                X, binning_thresholds=self.bin_thresholds_, out=out,
+                missing_values_bin_idx=self.missing_values_bin_idx_,
+                dtype=self.binned_dtype_)
+        binned = map_to_bins(
+            X, binning_thresholds=self.bin_thresholds_,
+            missing_values_bin_idx=self.missing_values_bin_idx_,
+            dtype=self.binned_dtype_)
+        return pack_binned_features(
+            binned, self.zero_bins_, self.columns_, self.is_packed_column_,
+            self.feature_layout_, self.missing_values_bin_idx_, out=out)
+
+    def unpack(self, X_binned):
+        """Return the binned features of the (bundled or packed) columns
+
+        This is the binned data as it would be returned by transform
+        without bundle_features and pack_features.
+        """
+        if self.feature_layout_ is None:
+            return X_binned
+        layout = self.feature_layout_
+        values = X_binned[:, layout['column']].astype(np.uint32)
+        values = (values >> layout['shift']) & layout['mask']
+        values -= layout['offset']  # values below the offset wrap around
+        binned = np.where(values < layout['width'], values,
+                          layout['default_bin'])
+        return np.asfortranarray(binned.astype(X_binned.dtype))
+
+    @property
+    def n_columns_(self):
+        """The number of columns of the binned data."""
+        return len(self.columns_)
+
+    def _check_missing_values_bin(self, X):
+        values = X.data if issparse(X) else X
+        self.binned_dtype_ = get_binned_dtype(self.max_bins)
+        if (self.max_bins > np.iinfo(self.binned_dtype_).max and
+                np.isnan(values).any()):
+            raise ValueError(
+                f'max_bins should be no larger than '
+                f'{np.iinfo(self.binned_dtype_).max} to leave room for the '
+                f'missing values bin, got {self.max_bins}')
+        self.missing_values_bin_idx_ = self.max_bins
+
+    def _check_categorical_features(self, X):
+        is_categorical = np.zeros(X.shape[1], dtype=bool)
+        if self.categorical_features is not None:
+            is_categorical[np.asarray(self.categorical_features)] = True
+        if is_categorical.any() and self.max_bins > MAX_N_CATEGORIES:
+            raise ValueError(f'max_bins should be no larger than '
+                             f'{MAX_N_CATEGORIES} with categorical features, '
+                             f'got {self.max_bins}')
+        if issparse(X) and is_categorical.any():
+            X = X.tocsc()
+        for feature_idx in np.flatnonzero(is_categorical):
+            if issparse(X):
+                categories = X.data[X.indptr[feature_idx]:
+                                    X.indptr[feature_idx + 1]]
+            else:
+                categories = X[:, feature_idx]
+            categories = categories[~np.isnan(categories)]
+            if (np.any(categories < 0) or
+                    np.any(categories >= self.max_bins) or
+                    np.any(categories != np.round(categories))):
+                raise ValueError(
+                    f'Categorical feature {feature_idx} should be encoded as '
+                    f'integers in [0, {self.max_bins})')
+        self.is_categorical_ = is_categorical
+
+    def _mask_unknown_categories(self, X):
+        # Categories that are not integers in [0, max_bins) have no bin:
+        # they are treated as missing values, like in TreePredictor.predict.
+        if not self.is_categorical_.any():
+            return X
+        if issparse(X):
+            values = X.data
+            columns = X.tocoo().col if X.format != 'csr' else X.indices
+            is_categorical = self.is_categorical_[columns]
+        else:
+            values = np.asarray(X)
+            is_categorical = self.is_categorical_
+        is_unknown = is_categorical & ((values < 0) |
+                                       (values >= self.max_bins) |
+                                       (values != np.round(values)))
+        if not is_unknown.any():
+            return X
+        values = np.where(is_unknown, np.nan, values)
+        if issparse(X):
+            X = X.copy()
+            X.data = values
+            return X
+        return values
+
+    def _set_columns(self, X):
+        n_features = len(self.bin_thresholds_)
+        columns = [np.array([feature_idx])
+                   for feature_idx in range(n_features)]
+        is_packed = np.zeros(n_features, dtype=bool)
+        n_bins = np.array([bt.shape[0] + 1 for bt in self.bin_thresholds_])
+        if self.bundle_features:
+            columns = self._find_bundles(X, n_bins)
+            is_packed = np.zeros(len(columns), dtype=bool)
+        if self.pack_features and self.binned_dtype_ == np.uint8:
+            columns, is_packed = find_packed_columns(columns, n_bins)
+        self.columns_ = columns
+        self.is_packed_column_ = is_packed
+        self.feature_layout_ = None
+        if len(columns) < n_features:
+            self.feature_layout_ = make_feature_layout(
+                columns, is_packed, n_bins, self.zero_bins_,
+                self.missing_values_bin_idx_)
+
+    def _find_bundles(self, X, n_bins):
+        rng = check_random_state(self.random_state)
+        if X.shape[0] > self.subsample:
+            X = X[rng.choice(np.arange(X.shape[0]), self.subsample)]
+        binned = map_to_bins(
+            X, binning_thresholds=self.bin_thresholds_,
+            missing_values_bin_idx=self.missing_values_bin_idx_,
+            dtype=self.binned_dtype_)
+        if issparse(binned):
+            is_missing = binned.data == self.missing_values_bin_idx_
+            has_missing = np.bincount(binned.indices[is_missing],
+                                      minlength=X.shape[1]) > 0
+        else:
+            has_missing = np.any(binned == self.missing_values_bin_idx_,
+                                 axis=0)
+        return find_feature_bundles(
+            binned, self.zero_bins_, n_bins,
+            candidates=~self.is_categorical_ & ~has_missing,
+            max_bins=self.max_bins)
+
+    def _set_bin_thresholds(self, bin_thresholds):
+        # Category c lies in ]c - .5, c + .5] and is mapped to bin c.
+        categorical_thresholds = np.arange(self.max_bins - 1) + .5
+        self.bin_thresholds_ = tuple(
+            categorical_thresholds.astype(bt.dtype) if is_categorical else bt
+            for bt, is_categorical in zip(bin_thresholds,
+                                          self.is_categorical_))
+        self.zero_bins_ = find_zero_bins(self.bin_thresholds_,
+                                         self.binned_dtype_)
@@ -0,0 +1,28 @@
+"""Fixed-size bitsets encoding the categories of categorical splits.
+
+A bitset is an array of BITSET_N_WORDS uint32 words: it can hold the
+categories 0 to BITSET_N_WORDS * 32 - 1 = 255.
+"""
+import numpy as np
+from numba import njit
+
+BITSET_N_WORDS = 8
+MAX_N_CATEGORIES = BITSET_N_WORDS * 32
+
+
+@njit
+def make_bitset():
+    return np.zeros(BITSET_N_WORDS, dtype=np.uint32)
+
+
+@njit
+def set_bitset(bitset, value):
+    bitset[value // 32] |= np.uint32(1) << np.uint32(value % 32)
+
+
+@njit
+def in_bitset(bitset, value):
+    if value < 0 or value >= MAX_N_CATEGORIES:
+        return False
+    word = bitset[value // 32] >> np.uint32(value % 32)
+    return (word & np.uint32(1)) != 0
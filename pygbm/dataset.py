@@ -0,0 +1,90 @@
+import os
+import pickle
+
+import numpy as np
+
+from pygbm.binning import BinMapper
+
+
+class BinnedDataset:
+    """Binned data along with its targets and the BinMapper that binned it.
+
+    A BinnedDataset can be passed to GradientBoostingMachine.fit and
+    GradientBoostingMachine.predict instead of numerical data: it is then
+    used as is, without being validated or binned again. This is useful to
+    fit several models on the same data, e.g. for hyper-parameter tuning.
+
+    Datasets can be saved to a folder holding the binned data and the
+    targets as .npy files and the pickled BinMapper. Loading a dataset
+    memory-maps the binned data: no copy of it is made.
+
+    Parameters
+    ----------
+    X_binned: array-like (n_samples, n_features)
+        The binned data, ideally as a Fortran-contiguous uint8 (or uint16)
+        array.
+
+    y: array-like (n_samples,) or None
+        The targets.
+
+    bin_mapper: BinMapper
+        The fitted BinMapper that was used to bin the data.
+    """
+
+    def __init__(self, X_binned, y, bin_mapper):
+        if y is not None and X_binned.shape[0] != y.shape[0]:
+            raise ValueError(f'X_binned and y have inconsistent numbers of '
+                             f'samples: {X_binned.shape[0]} and '
+                             f'{y.shape[0]}')
+        self.X_binned = X_binned
+        self.y = y
+        self.bin_mapper = bin_mapper
+
+    @classmethod
+    def from_data(cls, X, y=None, bin_mapper=None):
+        """Bin numerical data X with a BinMapper.
+
+        If bin_mapper is None, a new BinMapper is fitted on X. Otherwise the
+        already fitted bin_mapper is used, e.g. to bin test data.
+        """
+        if bin_mapper is None:
+            bin_mapper = BinMapper().fit(X)
+        X_binned = bin_mapper.transform(X)
+        if y is not None:
+            y = np.asarray(y, dtype=np.float32)
+        return cls(X_binned, y, bin_mapper)
+
+    @property
+    def shape(self):
+        return self.X_binned.shape
+
+    def save(self, folder):
+        """Save the dataset into folder, which is created if needed."""
+        os.makedirs(folder, exist_ok=True)
+        # np.save keeps the Fortran ordering of the binned data.
+        np.save(os.path.join(folder, 'X_binned.npy'), self.X_binned)
+        y_filename = os.path.join(folder, 'y.npy')
+        if self.y is not None:
+            np.save(y_filename, self.y)
+        elif os.path.exists(y_filename):
+            os.unlink(y_filename)
+        with open(os.path.join(folder, 'bin_mapper.pkl'), 'wb') as f:
+            pickle.dump(self.bin_mapper, f)
+
+    @classmethod
+    def load(cls, folder, mmap_mode='r'):
+        """Load a dataset saved in folder.
+
+        With the default mmap_mode, the binned data and the targets are
+        memory-mapped in read-only mode. Use mmap_mode=None to load them in
+        memory instead.
+        """
+        X_binned = np.load(os.path.join(folder, 'X_binned.npy'),
+                           mmap_mode=mmap_mode)
+        y_filename = os.path.join(folder, 'y.npy')
+        y = None
+        if os.path.exists(y_filename):
+            y = np.load(y_filename, mmap_mode=mmap_mode)
+        with open(os.path.join(folder, 'bin_mapper.pkl'), 'rb') as f:
+            bin_mapper = pickle.load(f)
+        return cls(X_binned, y, bin_mapper)
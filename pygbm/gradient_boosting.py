@@ -1,5 +1,8 @@
+from tempfile import TemporaryFile
+
 import numpy as np
 from numba import njit, prange
+from scipy.sparse import issparse
 from time import time
 from sklearn.base import BaseEstimator, RegressorMixin
 from sklearn.utils import check_X_y, check_random_state
@@ -7,6 +10,7 @@ from sklearn.metrics import check_scoring
 from sklearn.model_selection import train_test_split
 
 from pygbm.binning import BinMapper
+from pygbm.dataset import BinnedDataset
 from pygbm.grower import TreeGrower
 
 
@@ -17,7 +21,12 @@ class GradientBoostingMachine(BaseEstimator, RegressorMixin):
                  l2_regularization=0., max_bins=255,
                  max_no_improvement=5, validation_split=0.1,
                  scoring='neg_mean_squared_error',
-                 tol=1e-7, verbose=0, random_state=None):
+                 tol=1e-7, verbose=0, random_state=None, mmap_folder=None,
+                 categorical_features=None, bundle_features=False,
+                 pack_features=False, histogram_method='auto',
+                 histogram_pool_size=None, quantized_gradients=None,
+                 partition_gradients=False, compact_node_size=None,
+                 scan_method='auto'):
         self.learning_rate = learning_rate
         self.max_iter = max_iter
         self.max_leaf_nodes = max_leaf_nodes
@@ -31,44 +40,150 @@ class GradientBoostingMachine(BaseEstimator, RegressorMixin):
         self.tol = tol
         self.verbose = verbose
         self.random_state = random_state
+        self.mmap_folder = mmap_folder
+        self.categorical_features = categorical_features
+        self.bundle_features = bundle_features
+        self.pack_features = pack_features
+        self.histogram_method = histogram_method
+        self.histogram_pool_size = histogram_pool_size
+        self.quantized_gradients = quantized_gradients
+        self.partition_gradients = partition_gradients
+        self.compact_node_size = compact_node_size
+        self.scan_method = scan_method
+
+    def fit(self, X, y=None):
+        """Fit the gradient boosting model.
+
+        X can either be numerical data (n_samples, n_features) or a
+        BinnedDataset. In the latter case the data is neither validated nor
+        binned again and y defaults to the targets of the dataset. The
+        binned data is used without any copy if validation_split is None.
+        Otherwise the training split is copied once, into mmap_folder if
+        it is set.
+
+        Sparse CSR or CSC matrices are binned and fitted without being
+        densified: the cost of building the histograms is proportional to
+        the number of stored entries.
+
+        With bundle_features=True, the BinMapper packs mutually exclusive
+        features into shared columns: the histograms are built on these
+        bundles, which is much cheaper for wide and sparse data, and then
+        unpacked to find the best split among the original features. With
+        pack_features=True, the features with at most 15 bins are stored
+        4 bits each, two per column, which halves their memory traffic.
+
+        histogram_method ('auto', 'col_wise' or 'row_wise') selects how the
+        histograms of dense data are built: one column at a time, in
+        parallel over the columns, or all the columns at once for each
+        sample, in parallel over the samples. 'auto' picks the cheapest one
+        for each node, from its number of samples and the number of columns.
+
+        histogram_pool_size bounds the memory (in MB) used by the histograms
+        kept by each TreeGrower for the histogram subtraction trick. When
+        it is exceeded, the least recently used histograms are dropped and
+        the children of their node are computed from the data instead.
 
-    def fit(self, X, y):
+        With quantized_gradients=8 or 16, the gradients and hessians are
+        stochastically rounded to int8 or int16 integers at each iteration
+        and the histograms sum them into int32, which makes them smaller
+        and faster to build. The values of the leaves are still computed
+        from the exact gradients and hessians.
+
+        With partition_gradients=True, the gradients and hessians are
+        permuted along with the samples when a node is split, so that the
+        gradients of each node are contiguous and do not have to be
+        gathered before building its histograms. This trades random reads
+        of the gradients for sequential copies, and takes two more arrays
+        of the size of the training set.
+
+        With compact_node_size set, the rows of binned data of the nodes with
+        at most compact_node_size samples are copied into a compact block,
+        from which the histograms of the node and of its descendants are
+        built with reads that stay in the cache. Dense data only.
+
+        scan_method ('auto', 'loop' or 'vectorized') selects how the best
+        bin of each feature is found in the histograms of a node: by a loop
+        over the bins of each feature, or by evaluating the gains of all the
+        bins of all the features with branchless, vectorized loops. 'auto'
+        uses the loop, which has been faster in our benchmarks.
+        """
         fit_start_time = time()
         acc_find_split_time = 0.  # time spent finding the best splits
         acc_apply_split_time = 0.  # time spent splitting nodes
+        # time spent and memory used copying rows into compact blocks
+        acc_compact_time, acc_compact_nbytes = 0., 0
+        # lookups of the histograms of the parent and sibling nodes
+        acc_pool_hits, acc_pool_misses = 0, 0
         # time spent predicting X for gradient and hessians update
         acc_prediction_time = 0.
-        # TODO: add support for mixed-typed (numerical + categorical) data
-        # TODO: add support for missing data
-        # TODO: add support for pre-binned data (pass-through)?
-        X, y = check_X_y(X, y, dtype=[np.float32, np.float64])
-        y = y.astype(np.float32, copy=False)
         rng = check_random_state(self.random_state)
-        if self.verbose:
-            print(f"Binning {X.nbytes / 1e9:.3f} GB of data: ", end="",
-                  flush=True)
-        tic = time()
-        self.bin_mapper_ = BinMapper(max_bins=self.max_bins, random_state=rng)
-        X_binned = self.bin_mapper_.fit_transform(X)
-        toc = time()
-        if self.verbose:
-            duration = toc - tic
-            troughput = X.nbytes / duration
-            print(f"{duration:.3f} s ({troughput / 1e6:.3f} MB/s)")
-        if self.validation_split is not None:
-            X_binned_train, X_binned_val, y_train, y_val = train_test_split(
-                X_binned, y, test_size=self.validation_split, stratify=y,
-                random_state=rng)
-            # Histogram computation is faster on feature-aligned data.
-            X_binned_train = np.asfortranarray(X_binned_train)
+        if isinstance(X, BinnedDataset):
+            self.bin_mapper_ = X.bin_mapper
+            y = X.y if y is None else y
+            if y is None:
+                raise ValueError('y should be passed when the BinnedDataset '
+                                 'has no targets')
+            y = np.asarray(y, dtype=np.float32)
+            X_binned = X.X_binned
         else:
-            X_binned_train, y_train = X_binned, y
-            X_binned_val, y_val = None, None
+            X, y = check_X_y(X, y, accept_sparse=['csr', 'csc'],
+                             dtype=[np.float32, np.float64],
+                             force_all_finite='allow-nan')
+            y = y.astype(np.float32, copy=False)
+            if issparse(X) and self.mmap_folder is not None:
+                raise ValueError('mmap_folder is not supported for sparse '
+                                 'data')
+            nbytes = X.data.nbytes if issparse(X) else X.nbytes
+            if self.verbose:
+                print(f"Binning {nbytes / 1e9:.3f} GB of data: ", end="",
+                      flush=True)
+            tic = time()
+            self.bin_mapper_ = BinMapper(
+                max_bins=self.max_bins, random_state=rng,
+                categorical_features=self.categorical_features,
+                bundle_features=self.bundle_features,
+                pack_features=self.pack_features)
+            if self.mmap_folder is not None:
+                X_binned = None
+                X_binned_train, X_binned_val, y_train, y_val = \
+                    self._bin_splits_memmap(X, y, rng)
+            else:
+                X_binned = self.bin_mapper_.fit_transform(X)
+            toc = time()
+            if self.verbose:
+                duration = toc - tic
+                troughput = nbytes / duration
+                print(f"{duration:.3f} s ({troughput / 1e6:.3f} MB/s)")
+        if X_binned is not None:  # not split into memory-mapped files yet
+            if self.validation_split is not None:
+                train_indices, val_indices = train_test_split(
+                    np.arange(X_binned.shape[0]),
+                    test_size=self.validation_split, stratify=y,
+                    random_state=rng)
+                # Sorted indices make for sequential reads of X_binned,
+                # which may be memory-mapped (e.g. a loaded BinnedDataset).
+                train_indices.sort()
+                val_indices.sort()
+                y_train, y_val = y[train_indices], y[val_indices]
+                X_binned_val = X_binned[val_indices]
+                if issparse(X_binned):
+                    X_binned_train = X_binned[train_indices]
+                else:
+                    # Histogram computation is faster on feature-aligned
+                    # data: the training split is copied once into a
+                    # Fortran array.
+                    X_binned_train = _take_rows(X_binned, train_indices,
+                                                self.mmap_folder)
+            else:
+                X_binned_train, y_train = X_binned, y
+                X_binned_val, y_val = None, None
 
         # Subsample the training set for score-based monitoring.
         subsample_size = 10000
         if X_binned_train.shape[0] < subsample_size:
-            X_binned_small_train = np.ascontiguousarray(X_binned_train)
+            X_binned_small_train = X_binned_train
+            if not issparse(X_binned_train):
+                X_binned_small_train = np.ascontiguousarray(X_binned_train)
             y_small_train = y_train
         else:
             indices = rng.choice(
@@ -76,6 +191,16 @@ class GradientBoostingMachine(BaseEstimator, RegressorMixin):
             X_binned_small_train = X_binned_train[indices]
             y_small_train = y_train[indices]
 
+        # The last bin of the histograms holds the missing values.
+        missing_values_bin_idx = self.bin_mapper_.missing_values_bin_idx_
+        n_bins = missing_values_bin_idx + 1
+        # The histogram of each feature only covers its actual bins, and the
+        # missing values bin.
+        n_bins_per_feature = np.array(
+            [bt.shape[0] + 2 for bt in self.bin_mapper_.bin_thresholds_],
+            dtype=np.uint32)
+        is_categorical = self.bin_mapper_.is_categorical_.astype(np.uint8)
+
         if self.verbose:
             print("Fitting gradient boosted rounds:")
         # TODO: plug custom loss functions
@@ -99,10 +224,22 @@ class GradientBoostingMachine(BaseEstimator, RegressorMixin):
                 break
             shrinkage = 1. if self.n_iter_ == 0 else self.learning_rate
             grower = TreeGrower(
-                X_binned_train, gradients, hessians, n_bins=self.max_bins,
+                X_binned_train, gradients, hessians, n_bins=n_bins,
                 max_leaf_nodes=self.max_leaf_nodes, max_depth=self.max_depth,
                 min_samples_leaf=self.min_samples_leaf,
-                shrinkage=shrinkage)
+                shrinkage=shrinkage,
+                missing_values_bin_idx=missing_values_bin_idx,
+                is_categorical=is_categorical,
+                zero_bins=self.bin_mapper_.zero_bins_,
+                feature_layout=self.bin_mapper_.feature_layout_,
+                histogram_method=self.histogram_method,
+                histogram_pool_size=self.histogram_pool_size,
+                quantized_gradients=self.quantized_gradients,
+                random_state=rng,
+                partition_gradients=self.partition_gradients,
+                compact_node_size=self.compact_node_size,
+                scan_method=self.scan_method,
+                n_bins_per_feature=n_bins_per_feature)
             grower.grow()
             predictor = grower.make_predictor(
                 bin_thresholds=self.bin_mapper_.bin_thresholds_)
@@ -117,7 +254,11 @@ class GradientBoostingMachine(BaseEstimator, RegressorMixin):
             acc_prediction_time += toc_pred - tic_pred
 
             acc_apply_split_time += grower.total_apply_split_time
+            acc_compact_time += grower.total_compact_time
+            acc_compact_nbytes += grower.total_compact_nbytes
             acc_find_split_time += grower.total_find_split_time
+            acc_pool_hits += grower.histogram_pool.n_hits
+            acc_pool_misses += grower.histogram_pool.n_misses
         if self.verbose:
             duration = time() - fit_start_time
             n_leaf_nodes = sum(p.get_n_leaf_nodes() for p in self.predictors_)
@@ -129,15 +270,47 @@ class GradientBoostingMachine(BaseEstimator, RegressorMixin):
                                           acc_apply_split_time))
             print('{:<32} {:.3f}s'.format('Time spent predicting:',
                                           acc_prediction_time))
+            print('{:<32} {} hits, {} misses'.format(
+                'Histogram pool:', acc_pool_hits, acc_pool_misses))
+            if self.compact_node_size is not None:
+                print('{:<32} {:.3f}s, {:.1f} MB'.format(
+                    'Time spent compacting rows:', acc_compact_time,
+                    acc_compact_nbytes / 1e6))
         self.train_scores_ = np.asarray(self.train_scores_)
         if self.validation_split is not None:
             self.validation_scores_ = np.asarray(self.validation_scores_)
         return self
 
+    def _bin_splits_memmap(self, X, y, rng):
+        """Bin the training and validation splits into memory-mapped files
+
+        Neither the whole binned dataset nor a Fortran copy of the training
+        split is held in memory: the peak memory usage of the training loop
+        stays close to the size of the binned data.
+        """
+        self.bin_mapper_.fit(X)
+        train_indices = np.arange(X.shape[0])
+        X_binned_val, y_val = None, None
+        if self.validation_split is not None:
+            train_indices, val_indices = train_test_split(
+                train_indices, test_size=self.validation_split, stratify=y,
+                random_state=rng)
+            # Sorted indices make for sequential reads of X.
+            train_indices.sort()
+            val_indices.sort()
+            X_binned_val = _map_to_bins_memmap(
+                self.bin_mapper_, X, val_indices, self.mmap_folder)
+            y_val = y[val_indices]
+        X_binned_train = _map_to_bins_memmap(
+            self.bin_mapper_, X, train_indices, self.mmap_folder)
+        y_train = y[train_indices]
+        return X_binned_train, X_binned_val, y_train, y_val
+
     def predict(self, X):
         # TODO: check input / check_fitted
-        # TODO: make predictor behave correctly on pre-binned data
         # TODO: handle classification and output class labels in this case
+        if isinstance(X, BinnedDataset):
+            return self._predict_binned(X.X_binned)
         predicted = np.zeros(X.shape[0], dtype=np.float32)
         for predictor in self.predictors_:
             predicted += predictor.predict(X)
@@ -146,7 +319,9 @@ class GradientBoostingMachine(BaseEstimator, RegressorMixin):
     def _predict_binned(self, X_binned):
         predicted = np.zeros(X_binned.shape[0], dtype=np.float32)
         for predictor in self.predictors_:
-            predicted += predictor.predict_binned(X_binned)
+            predicted += predictor.predict_binned(
+                X_binned, zero_bins=self.bin_mapper_.zero_bins_,
+                feature_layout=self.bin_mapper_.feature_layout_)
         return predicted
 
     def _stopping_criterion(self, start_time, scorer, X_binned_train, y_train,
@@ -200,6 +375,47 @@ class GradientBoostingMachine(BaseEstimator, RegressorMixin):
 # of using a single class?
 
 
+def _map_to_bins_memmap(bin_mapper, X, indices, folder,
+                        chunk_bytes=int(64e6)):
+    """Bin X[indices] into a Fortran-ordered memory-mapped array.
+
+    The rows are gathered and binned by chunks of about chunk_bytes bytes of
+    X, so that only a small part of the numerical data is copied at a time.
+    The backing file in folder is anonymous: it is removed as soon as the
+    returned array is garbage collected.
+    """
+    X_binned = np.memmap(TemporaryFile(dir=folder),
+                         dtype=bin_mapper.binned_dtype_, mode='w+',
+                         shape=(indices.shape[0], bin_mapper.n_columns_),
+                         order='F')
+    chunk_size = max(1, chunk_bytes // max(X[:1].nbytes, 1))
+    for start in range(0, indices.shape[0], chunk_size):
+        stop = start + chunk_size
+        bin_mapper.transform(X[indices[start:stop]], out=X_binned[start:stop])
+    return X_binned
+
+
+def _take_rows(X_binned, indices, folder=None):
+    """Gather X_binned[indices] into a Fortran-ordered array.
+
+    The rows are gathered column by column, without any intermediate copy:
+    with sorted indices, the reads of a Fortran-ordered (e.g.
+    memory-mapped) X_binned are sequential. If folder is not None, the
+    result is memory-mapped into an anonymous file of folder.
+    """
+    shape = (indices.shape[0], X_binned.shape[1])
+    if folder is None:
+        out = np.empty(shape, dtype=X_binned.dtype, order='F')
+    else:
+        out = np.memmap(TemporaryFile(dir=folder), dtype=X_binned.dtype,
+                        mode='w+', shape=shape, order='F')
+    for column_idx in range(X_binned.shape[1]):
+        # mode='clip' writes directly into out, 'raise' would buffer.
+        np.take(X_binned[:, column_idx], indices, mode='clip',
+                out=out[:, column_idx])
+    return out
+
+
 @njit(parallel=True)
 def _update_y_pred(leaves_data, y_pred):
     """Read prediction data on the training set from the grower leaves"""
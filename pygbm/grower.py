@@ -1,11 +1,21 @@
 import warnings
+from collections import OrderedDict
 from heapq import heappush, heappop
 import numpy as np
+from scipy.sparse import issparse, csr_matrix
+from sklearn.utils import check_random_state
 from time import time
 
-from .splitting import (SplittingContext, split_indices, find_node_split,
-                        find_node_split_subtraction)
+from .splitting import (SplittingContext, SplittingContextUInt16,
+                        QUANTIZED_SPLITTING_CONTEXTS,
+                        split_indices, find_node_split,
+                        find_node_split_subtraction, HISTOGRAM_AUTO,
+                        HISTOGRAM_COL_WISE, HISTOGRAM_ROW_WISE, SCAN_AUTO,
+                        SCAN_LOOP, SCAN_VECTORIZED)
+from .quantization import quantize, QUANTIZED_DTYPES
 from .predictor import TreePredictor, PREDICTOR_RECORD_DTYPE
+from .bitset import BITSET_N_WORDS, MAX_N_CATEGORIES
+from .binning import FEATURE_LAYOUT_DTYPE
 
 
 class TreeNode:
@@ -13,7 +23,6 @@ class TreeNode:
     left_child = None  # Link to left node (only for non-leaf nodes)
     right_child = None  # Link to right node (only for non-leaf nodes)
     value = None  # Prediction value (only for leaf nodes)
-    histograms = None  # array of histogram shape = (n_features, n_bins)
     sibling = None  # Link to sibling node, None for root
     parent = None  # Link to parent node, None for root
     find_split_time = 0.  # time spent finding the best split
@@ -21,11 +30,19 @@ class TreeNode:
     apply_split_time = 0.  # time spent splitting the node
     # wheter the subtraction method was used for histogram computation
     hist_subtraction = False
+    # The splitting context of the node (and of its descendants): the
+    # grower's, or the one of the compact block of rows of the node or of an
+    # ancestor, in which case sample_indices are rows of the block and
+    # compact_samples maps them to the samples (see TreeGrower._compact_rows)
+    splitting_context = None
+    compact_samples = None
 
     def __init__(self, depth, sample_indices, sum_gradients,
-                 sum_hessians, parent=None):
+                 sum_hessians, parent=None, partition_start=0):
         self.depth = depth
         self.sample_indices = sample_indices
+        # position of sample_indices in the partition of the context
+        self.partition_start = partition_start
         self.n_samples = sample_indices.shape[0]
         self.sum_gradients = sum_gradients
         self.sum_hessians = sum_hessians
@@ -53,27 +70,212 @@ class TreeNode:
         return self.split_info.gain > other_node.split_info.gain
 
 
+class HistogramPool:
+    """Histograms of the nodes of a TreeGrower, within a memory budget
+
+    The histograms of a node (Histograms of the histograms of the features,
+    or of the columns for bundled or packed data, packed into 1D arrays) are
+    only needed to compute the histograms of its children by subtraction:
+    the TreeGrower releases them once the children are computed, or when
+    the node becomes a leaf. If the histograms held by the pool exceed
+    max_bytes, the least recently used ones are evicted: the children of
+    their node then build their histograms from the data (a miss).
+
+    Parameters
+    ----------
+    max_bytes: int or None
+        The memory budget of the pool. None means no limit. The histograms
+        that were just added are never evicted.
+
+    Attributes
+    ----------
+    n_hits, n_misses: int
+        The number of lookups of histograms that were found in the pool or
+        not (released or evicted).
+    n_evictions: int
+        The number of histograms evicted to stay within the budget.
+    n_bytes, max_n_bytes: int
+        The current and peak memory used by the histograms of the pool.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_evictions = 0
+        self.n_bytes = 0
+        self.max_n_bytes = 0
+        self._histograms = OrderedDict()  # node -> histograms, LRU first
+
+    def put(self, node, histograms):
+        """Store the histograms of node, evicting older ones if needed"""
+        self.release(node)
+        self._histograms[node] = histograms
+        self.n_bytes += _nbytes(histograms)
+        self.max_n_bytes = max(self.max_n_bytes, self.n_bytes)
+        while (self.max_bytes is not None and self.n_bytes > self.max_bytes
+               and len(self._histograms) > 1):
+            _, evicted = self._histograms.popitem(last=False)
+            self.n_bytes -= _nbytes(evicted)
+            self.n_evictions += 1
+
+    def get(self, node):
+        """Return the histograms of node, or None if they are not held"""
+        histograms = self._histograms.get(node)
+        if histograms is None:
+            self.n_misses += 1
+        else:
+            self.n_hits += 1
+            self._histograms.move_to_end(node)
+        return histograms
+
+    def release(self, node):
+        """Drop the histograms of node, if they are held"""
+        histograms = self._histograms.pop(node, None)
+        if histograms is not None:
+            self.n_bytes -= _nbytes(histograms)
+
+
+def _nbytes(histograms):
+    return sum(array.nbytes for array in histograms)
+
+
 class TreeGrower:
     def __init__(self, features_data, all_gradients, all_hessians,
                  max_leaf_nodes=None, max_depth=None, min_samples_leaf=20,
                  min_gain_to_split=0., n_bins=256, l2_regularization=0.,
-                 min_hessian_to_split=1e-3, shrinkage=1.):
-        if features_data.dtype != np.uint8:
+                 min_hessian_to_split=1e-3, shrinkage=1.,
+                 missing_values_bin_idx=None, is_categorical=None,
+                 zero_bins=None, feature_layout=None,
+                 histogram_method='auto', histogram_pool_size=None,
+                 quantized_gradients=None, random_state=None,
+                 partition_gradients=False, compact_node_size=None,
+                 n_bins_per_feature=None, scan_method='auto'):
+        if features_data.dtype not in (np.uint8, np.uint16):
             raise NotImplementedError(
                 "Explicit feature binning required for now")
+        binned_dtype = features_data.dtype
         if max_leaf_nodes is not None and max_leaf_nodes < 1:
             raise ValueError(f'max_leaf_nodes={max_leaf_nodes} should not be'
                              f' smaller than 1')
         if max_depth is not None and max_depth < 1:
             raise ValueError(f'max_depth={max_depth} should not be'
                              f' smaller than 1')
-        if not features_data.flags.f_contiguous:
-            warnings.warn("Binned data should be passed as Fortran contiguous"
-                          "array for maximum efficiency.")
-        self.splitting_context = SplittingContext(
-            features_data.shape[1], features_data, n_bins,
-            all_gradients, all_hessians, l2_regularization,
-            min_hessian_to_split, min_samples_leaf, min_gain_to_split)
+        if (missing_values_bin_idx is not None
+                and not 0 <= missing_values_bin_idx < n_bins):
+            raise ValueError(f'missing_values_bin_idx={missing_values_bin_idx}'
+                             f' should be in [0, n_bins={n_bins}).')
+        histogram_methods = {'auto': HISTOGRAM_AUTO,
+                             'col_wise': HISTOGRAM_COL_WISE,
+                             'row_wise': HISTOGRAM_ROW_WISE}
+        if histogram_method not in histogram_methods:
+            raise ValueError(f'histogram_method should be one of '
+                             f'{sorted(histogram_methods)}, got '
+                             f'{histogram_method!r}')
+        scan_methods = {'auto': SCAN_AUTO, 'loop': SCAN_LOOP,
+                        'vectorized': SCAN_VECTORIZED}
+        if scan_method not in scan_methods:
+            raise ValueError(f'scan_method should be one of '
+                             f'{sorted(scan_methods)}, got {scan_method!r}')
+        if (quantized_gradients is not None and
+                quantized_gradients not in QUANTIZED_DTYPES):
+            raise ValueError(f'quantized_gradients should be None or one of '
+                             f'{sorted(QUANTIZED_DTYPES)}, got '
+                             f'{quantized_gradients!r}')
+        n_features = features_data.shape[1]
+        if feature_layout is not None:
+            # features_data holds the bundled or packed columns built by the
+            # BinMapper: the splits are still made on the original features.
+            if issparse(features_data):
+                raise ValueError('Bundled or packed binned data should be '
+                                 'dense')
+            feature_layout = np.ascontiguousarray(feature_layout,
+                                                  dtype=FEATURE_LAYOUT_DTYPE)
+            n_features = feature_layout.shape[0]
+        if n_bins_per_feature is not None:
+            n_bins_per_feature = np.asarray(n_bins_per_feature,
+                                            dtype=np.uint32)
+            if (n_bins_per_feature.shape != (n_features,) or
+                    not np.all((1 <= n_bins_per_feature) &
+                               (n_bins_per_feature <= n_bins))):
+                raise ValueError(f'n_bins_per_feature should have shape '
+                                 f'({n_features},) and values in [1, '
+                                 f'n_bins={n_bins}]')
+        if is_categorical is not None:
+            is_categorical = np.asarray(is_categorical, dtype=np.uint8)
+            if is_categorical.shape != (n_features,):
+                raise ValueError(f'is_categorical should have shape '
+                                 f'({n_features},), got '
+                                 f'{is_categorical.shape}')
+        if issparse(features_data):
+            # Histograms are built from the stored entries of the rows of
+            # the nodes: the CSR layout is required.
+            features_data = csr_matrix(features_data)
+            features_data.sort_indices()
+            if zero_bins is None:
+                zero_bins = np.zeros(features_data.shape[1],
+                                     dtype=binned_dtype)
+            sparse_binned_features = (
+                features_data.data,
+                features_data.indices.astype(np.int32, copy=False),
+                features_data.indptr.astype(np.int64, copy=False),
+                np.asarray(zero_bins, dtype=binned_dtype))
+            binned_features = np.empty((0, features_data.shape[1]),
+                                       dtype=binned_dtype, order='F')
+        else:
+            if not features_data.flags.f_contiguous:
+                warnings.warn("Binned data should be passed as Fortran "
+                              "contiguous array for maximum efficiency.")
+            sparse_binned_features = None
+            binned_features = features_data
+        # The exact gradients and hessians, from which the values of the
+        # leaves are computed.
+        self.all_gradients = all_gradients
+        self.all_hessians = all_hessians
+        self.quantized_gradients = quantized_gradients
+        gradient_scale, hessian_scale = 1., 1.
+        if quantized_gradients is not None:
+            # The splits are found on the histograms of the gradients and
+            # hessians stochastically rounded to quantized_gradients bits.
+            rng = check_random_state(random_state)
+            all_gradients, gradient_scale = quantize(
+                all_gradients, quantized_gradients, rng)
+            if all_hessians.shape[0] == 1:
+                hessian_scale = all_hessians[0]
+                all_hessians = np.ones(1, dtype=all_gradients.dtype)
+            else:
+                all_hessians, hessian_scale = quantize(
+                    all_hessians, quantized_gradients, rng)
+            context_class = QUANTIZED_SPLITTING_CONTEXTS[
+                binned_dtype, all_gradients.dtype]
+        elif binned_dtype == np.uint8:
+            context_class = SplittingContext
+        else:
+            context_class = SplittingContextUInt16
+        # The parameters shared with the splitting contexts of the compact
+        # blocks of rows, see _compact_rows.
+        self._context_class = context_class
+        self._context_params = dict(
+            l2_regularization=l2_regularization,
+            min_hessian_to_split=min_hessian_to_split,
+            min_samples_leaf=min_samples_leaf,
+            min_gain_to_split=min_gain_to_split,
+            missing_values_bin_idx=missing_values_bin_idx,
+            is_categorical=is_categorical, feature_layout=feature_layout,
+            histogram_method=histogram_methods[histogram_method],
+            scan_method=scan_methods[scan_method],
+            gradient_scale=gradient_scale, hessian_scale=hessian_scale,
+            partition_gradients=partition_gradients,
+            n_bins_per_feature=n_bins_per_feature)
+        self.splitting_context = context_class(
+            n_features, binned_features, n_bins, all_gradients, all_hessians,
+            sparse_binned_features=sparse_binned_features,
+            **self._context_params)
+        if compact_node_size is not None and issparse(features_data):
+            raise ValueError('compact_node_size is not supported for sparse '
+                             'binned data')
+        self.compact_node_size = compact_node_size
+        self.missing_values_bin_idx = missing_values_bin_idx
         self.max_leaf_nodes = max_leaf_nodes
         self.max_depth = max_depth
         self.min_samples_leaf = min_samples_leaf
@@ -85,8 +287,16 @@ class TreeGrower:
         self.shrinkage = shrinkage
         self.splittable_nodes = []
         self.finalized_leaves = []
+        # histogram_pool_size is given in MB, like in LightGBM.
+        if histogram_pool_size is not None:
+            histogram_pool_size = int(histogram_pool_size * 1e6)
+        self.histogram_pool = HistogramPool(histogram_pool_size)
         self.total_find_split_time = 0.  # time spent finding the best splits
         self.total_apply_split_time = 0.  # time spent splitting nodes
+        # time spent copying the rows of nodes into compact blocks, and
+        # memory allocated for the blocks
+        self.total_compact_time = 0.
+        self.total_compact_nbytes = 0
         self._intilialize_root()
         self.n_nodes = 1
 
@@ -98,15 +308,16 @@ class TreeGrower:
         n_samples = self.features_data.shape[0]
         depth = 0
         if self.splitting_context.constant_hessian:
-            hessian = self.splitting_context.all_hessians[0] * n_samples
+            hessian = self.all_hessians[0] * n_samples
         else:
-            hessian = self.splitting_context.all_hessians.sum()
+            hessian = self.all_hessians.sum()
         self.root = TreeNode(
             depth=depth,
             sample_indices=self.splitting_context.partition.view(),
-            sum_gradients=self.splitting_context.all_gradients.sum(),
+            sum_gradients=self.all_gradients.sum(),
             sum_hessians=hessian
         )
+        self.root.splitting_context = self.splitting_context
         if (self.max_leaf_nodes is not None and self.max_leaf_nodes == 1):
             self._finalize_leaf(self.root)
             return
@@ -117,6 +328,8 @@ class TreeGrower:
             return
 
         self._compute_spittability(self.root)
+        if self.root.value is not None:  # no valid split
+            self.histogram_pool.release(self.root)
 
     def _compute_spittability(self, node, only_hist=False):
         """Compute histograms and split_info of a node and either make it a
@@ -128,7 +341,7 @@ class TreeGrower:
         this same node, the histograms won't be computed again.
         """
         # Compute split_info and histograms if not already done
-        if node.split_info is None and node.histograms is None:
+        if node.split_info is None:
             # If the sibling has less samples, compute its hist first (with
             # the regular method) and use the subtraction method for the
             # current node
@@ -136,23 +349,38 @@ class TreeGrower:
                 if node.sibling.n_samples < node.n_samples:
                     self._compute_spittability(node.sibling, only_hist=True)
                     # As hist of sibling is now computed we'll use the hist
-                    # subtraction method for the current node.
-                    node.hist_subtraction = True
+                    # subtraction method for the current node, unless the
+                    # histograms of the parent were evicted from the pool.
+                    parent_histograms = self.histogram_pool.get(node.parent)
+                    sibling_histograms = self.histogram_pool.get(
+                        node.sibling)
+                    node.hist_subtraction = (
+                        parent_histograms is not None and
+                        sibling_histograms is not None)
+
+            if (self.compact_node_size is not None and
+                    node.n_samples <= self.compact_node_size and
+                    node.compact_samples is None and node.parent is not None):
+                self._compact_rows(node)
 
             tic = time()
             if node.hist_subtraction:
+                # The histograms of node are computed in place in the
+                # buffers of its parent, which are handed over to node.
+                self.histogram_pool.release(node.parent)
                 split_info, histograms = find_node_split_subtraction(
-                    self.splitting_context, node.sample_indices,
-                    node.parent.histograms, node.sibling.histograms)
+                    node.splitting_context, node.sample_indices,
+                    parent_histograms, sibling_histograms)
             else:
                 split_info, histograms = find_node_split(
-                    self.splitting_context, node.sample_indices)
+                    node.splitting_context, node.sample_indices,
+                    node.partition_start)
             toc = time()
             node.find_split_time = toc - tic
             self.total_find_split_time += node.find_split_time
             node.construction_speed = node.n_samples / node.find_split_time
             node.split_info = split_info
-            node.histograms = histograms
+            self.histogram_pool.put(node, histograms)
 
         if only_hist:
             # _compute_spittability was called by a sibling. We only needed to
@@ -182,7 +410,8 @@ class TreeGrower:
 
         tic = time()
         (sample_indices_left, sample_indices_right) = split_indices(
-            self.splitting_context, node.split_info, node.sample_indices)
+            node.splitting_context, node.split_info, node.sample_indices,
+            node.partition_start)
         toc = time()
         node.apply_split_time = toc - tic
         self.total_apply_split_time += node.apply_split_time
@@ -195,12 +424,21 @@ class TreeGrower:
                                    sample_indices_left,
                                    node.split_info.gradient_left,
                                    node.split_info.hessian_left,
-                                   parent=node)
+                                   parent=node,
+                                   partition_start=node.partition_start)
         right_child_node = TreeNode(depth,
                                     sample_indices_right,
                                     node.split_info.gradient_right,
                                     node.split_info.hessian_right,
-                                    parent=node)
+                                    parent=node,
+                                    partition_start=(
+                                        node.partition_start +
+                                        sample_indices_left.shape[0]))
+        for child in (left_child_node, right_child_node):
+            child.splitting_context = node.splitting_context
+            child.compact_samples = node.compact_samples
+        # Release the compact block once all its nodes are split or leaves
+        node.splitting_context = None
         left_child_node.sibling = right_child_node
         right_child_node.sibling = left_child_node
         node.right_child = right_child_node
@@ -210,6 +448,7 @@ class TreeGrower:
         if self.max_depth is not None and depth == self.max_depth:
             self._finalize_leaf(left_child_node)
             self._finalize_leaf(right_child_node)
+            self._release_histograms(node)
             return left_child_node, right_child_node
 
         if (self.max_leaf_nodes is not None
@@ -217,6 +456,7 @@ class TreeGrower:
             self._finalize_leaf(left_child_node)
             self._finalize_leaf(right_child_node)
             self._finalize_splittable_nodes()
+            self._release_histograms(node)
             return left_child_node, right_child_node
 
         if (self.min_samples_leaf is not None
@@ -231,8 +471,33 @@ class TreeGrower:
         else:
             self._compute_spittability(right_child_node)
 
+        self._release_histograms(node)
         return left_child_node, right_child_node
 
+    def _release_histograms(self, node):
+        """Release the histograms that are not needed after splitting node
+
+        The histograms of node were only needed by its children, and those
+        of its children only if they can be split further.
+        """
+        self.histogram_pool.release(node)
+        for child in (node.left_child, node.right_child):
+            if child.value is not None:  # finalized leaf
+                self.histogram_pool.release(child)
+                self._restore_sample_indices(child)
+
+    def _restore_sample_indices(self, leaf):
+        """Map the sample_indices of a leaf of a compact block of rows back
+        to the samples, and release its splitting context.
+
+        This is done once the leaf cannot be used to compute the histograms
+        of its sibling anymore.
+        """
+        if leaf.compact_samples is not None:
+            leaf.sample_indices = leaf.compact_samples[leaf.sample_indices]
+            leaf.compact_samples = None
+        leaf.splitting_context = None
+
     def can_split_further(self):
         return len(self.splittable_nodes) >= 1
 
@@ -242,24 +507,95 @@ class TreeGrower:
         See Equation 5 of:
         XGBoost: A Scalable Tree Boosting System, T. Chen, C. Guestrin, 2016
         https://arxiv.org/abs/1603.02754
+
+        With quantized gradients, the sums of the split infos are those of
+        the quantized gradients and hessians: the value is computed from the
+        exact sums instead.
         """
+        if self.quantized_gradients is not None:
+            sample_indices = node.sample_indices
+            if node.compact_samples is not None:
+                sample_indices = node.compact_samples[sample_indices]
+            node.sum_gradients = self.all_gradients[sample_indices].sum()
+            if self.splitting_context.constant_hessian:
+                node.sum_hessians = self.all_hessians[0] * node.n_samples
+            else:
+                node.sum_hessians = self.all_hessians[sample_indices].sum()
         node.value = self.shrinkage * node.sum_gradients / (
             node.sum_hessians + self.splitting_context.l2_regularization)
         self.finalized_leaves.append(node)
 
+    def _compact_rows(self, node):
+        """Copy the rows of node into a compact block of binned data
+
+        The rows and the gradients of the samples of node are copied, in the
+        order of node.sample_indices, into new arrays on which a new
+        splitting context is built: node and its descendants are split in
+        this context, their sample_indices being rows of the block. Their
+        histograms are then built from the block, which fits in the cache
+        for small enough nodes, instead of reads scattered across all the
+        rows of the binned data.
+        """
+        tic = time()
+        context = self.splitting_context
+        samples = node.sample_indices.copy()
+        binned_features = context.binned_features
+        n_columns = binned_features.shape[1]
+        block = np.empty((samples.shape[0], n_columns),
+                         dtype=binned_features.dtype, order='F')
+        for column_idx in range(n_columns):
+            # mode='clip' writes directly into block, 'raise' would buffer.
+            np.take(binned_features[:, column_idx], samples, mode='clip',
+                    out=block[:, column_idx])
+        all_hessians = context.all_hessians
+        if not context.constant_hessian:
+            all_hessians = all_hessians[samples]
+        block_context = self._context_class(
+            context.n_features, block, context.n_bins,
+            context.all_gradients[samples], all_hessians,
+            **self._context_params)
+        # The per-thread histograms buffers are shared with the grower's
+        # context: only one node is split at a time.
+        block_context.thread_gradients = context.thread_gradients
+        block_context.thread_hessians = context.thread_hessians
+        block_context.thread_count = context.thread_count
+
+        node.splitting_context = block_context
+        node.compact_samples = samples
+        node.sample_indices = block_context.partition.view()
+        node.partition_start = 0
+        self.total_compact_time += time() - tic
+        self.total_compact_nbytes += samples.nbytes + sum(
+            array.nbytes for array in (
+                block, block_context.all_gradients,
+                block_context.all_hessians, block_context.ordered_gradients,
+                block_context.ordered_hessians, block_context.partition,
+                block_context.left_indices_buffer,
+                block_context.right_indices_buffer,
+                block_context.gradients_buffer,
+                block_context.hessians_buffer))
+
     def _finalize_splittable_nodes(self):
         while len(self.splittable_nodes) > 0:
             node = self.splittable_nodes.pop()
             self._finalize_leaf(node)
+            self.histogram_pool.release(node)
+            self._restore_sample_indices(node)
 
     def make_predictor(self, bin_thresholds=None):
         predictor_nodes = np.zeros(self.n_nodes, dtype=PREDICTOR_RECORD_DTYPE)
+        categorical_bitsets = []
         self._fill_predictor_node_array(predictor_nodes, self.root,
+                                        categorical_bitsets,
                                         bin_thresholds=bin_thresholds)
-        return TreePredictor(predictor_nodes)
+        categorical_bitsets = np.array(categorical_bitsets, dtype=np.uint32)
+        categorical_bitsets = categorical_bitsets.reshape(-1, BITSET_N_WORDS)
+        return TreePredictor(predictor_nodes, self.missing_values_bin_idx,
+                             categorical_bitsets)
 
     def _fill_predictor_node_array(self, predictor_nodes, grower_node,
-                                   bin_thresholds=None, next_free_idx=0):
+                                   categorical_bitsets, bin_thresholds=None,
+                                   next_free_idx=0):
         node = predictor_nodes[next_free_idx]
         node['count'] = grower_node.n_samples
         node['depth'] = grower_node.depth
@@ -279,17 +615,32 @@ class TreeGrower:
             feature_idx, bin_idx = split_info.feature_idx, split_info.bin_idx
             node['feature_idx'] = feature_idx
             node['bin_threshold'] = bin_idx
-            if bin_thresholds is not None:
-                threshold = bin_thresholds[feature_idx][bin_idx]
+            node['missing_go_to_left'] = split_info.missing_go_to_left
+            if split_info.is_categorical:
+                node['is_categorical'] = True
+                node['bitset_idx'] = len(categorical_bitsets)
+                categorical_bitsets.append(split_info.left_cat_bitset.copy())
+                # The threshold of a categorical node is the number of
+                # categories: larger values are unknown categories.
+                if bin_thresholds is not None:
+                    node['threshold'] = len(bin_thresholds[feature_idx]) + 1
+                else:
+                    node['threshold'] = MAX_N_CATEGORIES
+            elif bin_thresholds is not None:
+                if bin_idx < len(bin_thresholds[feature_idx]):
+                    threshold = bin_thresholds[feature_idx][bin_idx]
+                else:
+                    # All the non-missing values go to the left child.
+                    threshold = np.inf
                 node['threshold'] = threshold
             next_free_idx += 1
 
             node['left'] = next_free_idx
             next_free_idx = self._fill_predictor_node_array(
-                predictor_nodes, grower_node.left_child,
+                predictor_nodes, grower_node.left_child, categorical_bitsets,
                 bin_thresholds=bin_thresholds, next_free_idx=next_free_idx)
 
             node['right'] = next_free_idx
             return self._fill_predictor_node_array(
-                predictor_nodes, grower_node.right_child,
+                predictor_nodes, grower_node.right_child, categorical_bitsets,
                 bin_thresholds=bin_thresholds, next_free_idx=next_free_idx)
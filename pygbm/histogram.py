@@ -1,76 +1,141 @@
+from collections import namedtuple
+
 import numpy as np
-from numba import njit
+from numba import njit, prange, types
+from numba.extending import overload
+
+from .binning import decode_bin
+
+# The histograms are stored as a struct of arrays: each statistic is a
+# contiguous array over the bins, so that the accumulations, subtractions
+# and cumulative scans run over plain float32 / uint32 arrays that can be
+# vectorized, instead of interleaved records. The histograms of a node are
+# packed one after the other into 1D arrays: histogram i spans the bins
+# offsets[i]:offsets[i + 1], each feature only taking as many bins as it
+# actually has. The kernels below count the values of a feature beyond its
+# last bin, i.e. the shared missing values bin of the BinMapper, into its
+# last bin.
+# With quantized gradients and hessians (int8 or int16, see
+# pygbm.quantization), the sums are int32.
+Histograms = namedtuple('Histograms',
+                        ['sum_gradients', 'sum_hessians', 'count'])
+
+
+def _histogram_dtype(gradients):
+    """Return the dtype of the sums of the histograms of gradients"""
+
+
+@overload(_histogram_dtype)
+def _histogram_dtype_overload(gradients):
+    if isinstance(gradients.dtype, types.Integer):
+        return lambda gradients: np.int32
+    return lambda gradients: np.float32
+
+
+@njit
+def _zero_histogram(n_bins, dtype=np.float32):
+    """Return an empty histogram of n_bins bins"""
+    return Histograms(np.zeros(n_bins, dtype=dtype),
+                      np.zeros(n_bins, dtype=dtype),
+                      np.zeros(n_bins, dtype=np.uint32))
 
-HISTOGRAM_DTYPE = np.dtype([
-    ('sum_gradients', np.float32),
-    ('sum_hessians', np.float32),
-    ('count', np.uint32),
-])
+
+@njit
+def _zero_histograms(offsets, dtype=np.float32):
+    """Return the empty packed histograms delimited by offsets"""
+    return _zero_histogram(offsets[-1], dtype)
+
+
+@njit
+def _get_histogram(sum_gradients, sum_hessians, count, offsets, idx):
+    """Return histogram idx of the packed arrays of histograms
+
+    The arrays are passed separately since namedtuples cannot be used across
+    the boundaries of prange loops: parallel functions unpack the Histograms
+    of a node before the loop.
+    """
+    start, stop = offsets[idx], offsets[idx + 1]
+    return Histograms(sum_gradients[start:stop], sum_hessians[start:stop],
+                      count[start:stop])
+
+
+@njit
+def _set_histogram(sum_gradients, sum_hessians, count, offsets, idx,
+                   histogram):
+    """Copy histogram into histogram idx of the packed arrays"""
+    start, stop = offsets[idx], offsets[idx + 1]
+    sum_gradients[start:stop] = histogram.sum_gradients
+    sum_hessians[start:stop] = histogram.sum_hessians
+    count[start:stop] = histogram.count
 
 
 @njit
 def _build_histogram_naive(n_bins, sample_indices, binned_feature,
                            ordered_gradients, ordered_hessians):
-    histogram = np.zeros(n_bins, dtype=HISTOGRAM_DTYPE)
+    histogram = _zero_histogram(n_bins, _histogram_dtype(ordered_gradients))
+    last_bin = n_bins - 1
     for i, sample_idx in enumerate(sample_indices):
-        bin_idx = binned_feature[sample_idx]
-        histogram[bin_idx]['sum_gradients'] += ordered_gradients[i]
-        histogram[bin_idx]['sum_hessians'] += ordered_hessians[i]
-        histogram[bin_idx]['count'] += 1
+        bin_idx = min(binned_feature[sample_idx], last_bin)
+        histogram.sum_gradients[bin_idx] += ordered_gradients[i]
+        histogram.sum_hessians[bin_idx] += ordered_hessians[i]
+        histogram.count[bin_idx] += 1
     return histogram
 
 
 @njit
 def _subtract_histograms(n_bins, hist_a, hist_b):
-    """Return hist_a - hist_b"""
-
-    histogram = np.zeros(n_bins, dtype=HISTOGRAM_DTYPE)
-
-    sg = 'sum_gradients'
-    sh = 'sum_hessians'
-    c = 'count'
+    """Subtract hist_b from hist_a in place and return hist_a
 
+    No histogram is allocated: the histogram of the larger child is computed
+    in the buffers of its parent, which are not needed anymore.
+    """
+    for i in range(n_bins):
+        hist_a.sum_gradients[i] -= hist_b.sum_gradients[i]
+    for i in range(n_bins):
+        hist_a.sum_hessians[i] -= hist_b.sum_hessians[i]
     for i in range(n_bins):
-        histogram[i][sg] = hist_a[i][sg] - hist_b[i][sg]
-        histogram[i][sh] = hist_a[i][sh] - hist_b[i][sh]
-        histogram[i][c] = hist_a[i][c] - hist_b[i][c]
+        hist_a.count[i] -= hist_b.count[i]
 
-    return histogram
+    return hist_a
 
 
 @njit
 def _build_histogram(n_bins, sample_indices, binned_feature, ordered_gradients,
                      ordered_hessians):
-    histogram = np.zeros(n_bins, dtype=HISTOGRAM_DTYPE)
+    histogram = _zero_histogram(n_bins, _histogram_dtype(ordered_gradients))
+    last_bin = n_bins - 1
+    sum_gradients = histogram.sum_gradients
+    sum_hessians = histogram.sum_hessians
+    count = histogram.count
     n_node_samples = sample_indices.shape[0]
     unrolled_upper = (n_node_samples // 4) * 4
 
     for i in range(0, unrolled_upper, 4):
-        bin_0 = binned_feature[sample_indices[i]]
-        bin_1 = binned_feature[sample_indices[i + 1]]
-        bin_2 = binned_feature[sample_indices[i + 2]]
-        bin_3 = binned_feature[sample_indices[i + 3]]
-
-        histogram[bin_0]['sum_gradients'] += ordered_gradients[i]
-        histogram[bin_1]['sum_gradients'] += ordered_gradients[i + 1]
-        histogram[bin_2]['sum_gradients'] += ordered_gradients[i + 2]
-        histogram[bin_3]['sum_gradients'] += ordered_gradients[i + 3]
-
-        histogram[bin_0]['sum_hessians'] += ordered_hessians[i]
-        histogram[bin_1]['sum_hessians'] += ordered_hessians[i + 1]
-        histogram[bin_2]['sum_hessians'] += ordered_hessians[i + 2]
-        histogram[bin_3]['sum_hessians'] += ordered_hessians[i + 3]
-
-        histogram[bin_0]['count'] += 1
-        histogram[bin_1]['count'] += 1
-        histogram[bin_2]['count'] += 1
-        histogram[bin_3]['count'] += 1
+        bin_0 = min(binned_feature[sample_indices[i]], last_bin)
+        bin_1 = min(binned_feature[sample_indices[i + 1]], last_bin)
+        bin_2 = min(binned_feature[sample_indices[i + 2]], last_bin)
+        bin_3 = min(binned_feature[sample_indices[i + 3]], last_bin)
+
+        sum_gradients[bin_0] += ordered_gradients[i]
+        sum_gradients[bin_1] += ordered_gradients[i + 1]
+        sum_gradients[bin_2] += ordered_gradients[i + 2]
+        sum_gradients[bin_3] += ordered_gradients[i + 3]
+
+        sum_hessians[bin_0] += ordered_hessians[i]
+        sum_hessians[bin_1] += ordered_hessians[i + 1]
+        sum_hessians[bin_2] += ordered_hessians[i + 2]
+        sum_hessians[bin_3] += ordered_hessians[i + 3]
+
+        count[bin_0] += 1
+        count[bin_1] += 1
+        count[bin_2] += 1
+        count[bin_3] += 1
 
     for i in range(unrolled_upper, n_node_samples):
-        bin_idx = binned_feature[sample_indices[i]]
-        histogram[bin_idx]['sum_gradients'] += ordered_gradients[i]
-        histogram[bin_idx]['sum_hessians'] += ordered_hessians[i]
-        histogram[bin_idx]['count'] += 1
+        bin_idx = min(binned_feature[sample_indices[i]], last_bin)
+        sum_gradients[bin_idx] += ordered_gradients[i]
+        sum_hessians[bin_idx] += ordered_hessians[i]
+        count[bin_idx] += 1
 
     return histogram
 
@@ -78,30 +143,33 @@ def _build_histogram(n_bins, sample_indices, binned_feature, ordered_gradients,
 @njit
 def _build_histogram_no_hessian(n_bins, sample_indices, binned_feature,
                                 ordered_gradients):
-    histogram = np.zeros(n_bins, dtype=HISTOGRAM_DTYPE)
+    histogram = _zero_histogram(n_bins, _histogram_dtype(ordered_gradients))
+    last_bin = n_bins - 1
+    sum_gradients = histogram.sum_gradients
+    count = histogram.count
     n_node_samples = sample_indices.shape[0]
     unrolled_upper = (n_node_samples // 4) * 4
 
     for i in range(0, unrolled_upper, 4):
-        bin_0 = binned_feature[sample_indices[i]]
-        bin_1 = binned_feature[sample_indices[i + 1]]
-        bin_2 = binned_feature[sample_indices[i + 2]]
-        bin_3 = binned_feature[sample_indices[i + 3]]
+        bin_0 = min(binned_feature[sample_indices[i]], last_bin)
+        bin_1 = min(binned_feature[sample_indices[i + 1]], last_bin)
+        bin_2 = min(binned_feature[sample_indices[i + 2]], last_bin)
+        bin_3 = min(binned_feature[sample_indices[i + 3]], last_bin)
 
-        histogram[bin_0]['sum_gradients'] += ordered_gradients[i]
-        histogram[bin_1]['sum_gradients'] += ordered_gradients[i + 1]
-        histogram[bin_2]['sum_gradients'] += ordered_gradients[i + 2]
-        histogram[bin_3]['sum_gradients'] += ordered_gradients[i + 3]
+        sum_gradients[bin_0] += ordered_gradients[i]
+        sum_gradients[bin_1] += ordered_gradients[i + 1]
+        sum_gradients[bin_2] += ordered_gradients[i + 2]
+        sum_gradients[bin_3] += ordered_gradients[i + 3]
 
-        histogram[bin_0]['count'] += 1
-        histogram[bin_1]['count'] += 1
-        histogram[bin_2]['count'] += 1
-        histogram[bin_3]['count'] += 1
+        count[bin_0] += 1
+        count[bin_1] += 1
+        count[bin_2] += 1
+        count[bin_3] += 1
 
     for i in range(unrolled_upper, n_node_samples):
-        bin_idx = binned_feature[sample_indices[i]]
-        histogram[bin_idx]['sum_gradients'] += ordered_gradients[i]
-        histogram[bin_idx]['count'] += 1
+        bin_idx = min(binned_feature[sample_indices[i]], last_bin)
+        sum_gradients[bin_idx] += ordered_gradients[i]
+        count[bin_idx] += 1
 
     return histogram
 
@@ -114,30 +182,33 @@ def _build_histogram_root_no_hessian(n_bins, binned_feature, all_gradients):
     training set. binned_feature and all_gradients already have a consistent
     ordering.
     """
-    histogram = np.zeros(n_bins, dtype=HISTOGRAM_DTYPE)
+    histogram = _zero_histogram(n_bins, _histogram_dtype(all_gradients))
+    last_bin = n_bins - 1
+    sum_gradients = histogram.sum_gradients
+    count = histogram.count
     n_node_samples = binned_feature.shape[0]
     unrolled_upper = (n_node_samples // 4) * 4
 
     for i in range(0, unrolled_upper, 4):
-        bin_0 = binned_feature[i]
-        bin_1 = binned_feature[i + 1]
-        bin_2 = binned_feature[i + 2]
-        bin_3 = binned_feature[i + 3]
+        bin_0 = min(binned_feature[i], last_bin)
+        bin_1 = min(binned_feature[i + 1], last_bin)
+        bin_2 = min(binned_feature[i + 2], last_bin)
+        bin_3 = min(binned_feature[i + 3], last_bin)
 
-        histogram[bin_0]['sum_gradients'] += all_gradients[i]
-        histogram[bin_1]['sum_gradients'] += all_gradients[i + 1]
-        histogram[bin_2]['sum_gradients'] += all_gradients[i + 2]
-        histogram[bin_3]['sum_gradients'] += all_gradients[i + 3]
+        sum_gradients[bin_0] += all_gradients[i]
+        sum_gradients[bin_1] += all_gradients[i + 1]
+        sum_gradients[bin_2] += all_gradients[i + 2]
+        sum_gradients[bin_3] += all_gradients[i + 3]
 
-        histogram[bin_0]['count'] += 1
-        histogram[bin_1]['count'] += 1
-        histogram[bin_2]['count'] += 1
-        histogram[bin_3]['count'] += 1
+        count[bin_0] += 1
+        count[bin_1] += 1
+        count[bin_2] += 1
+        count[bin_3] += 1
 
     for i in range(unrolled_upper, n_node_samples):
-        bin_idx = binned_feature[i]
-        histogram[bin_idx]['sum_gradients'] += all_gradients[i]
-        histogram[bin_idx]['count'] += 1
+        bin_idx = min(binned_feature[i], last_bin)
+        sum_gradients[bin_idx] += all_gradients[i]
+        count[bin_idx] += 1
 
     return histogram
 
@@ -151,35 +222,210 @@ def _build_histogram_root(n_bins, binned_feature, all_gradients,
     training set. binned_feature and all_gradients already have a consistent
     ordering.
     """
-    histogram = np.zeros(n_bins, dtype=HISTOGRAM_DTYPE)
+    histogram = _zero_histogram(n_bins, _histogram_dtype(all_gradients))
+    last_bin = n_bins - 1
+    sum_gradients = histogram.sum_gradients
+    sum_hessians = histogram.sum_hessians
+    count = histogram.count
     n_node_samples = binned_feature.shape[0]
     unrolled_upper = (n_node_samples // 4) * 4
 
     for i in range(0, unrolled_upper, 4):
-        bin_0 = binned_feature[i]
-        bin_1 = binned_feature[i + 1]
-        bin_2 = binned_feature[i + 2]
-        bin_3 = binned_feature[i + 3]
-
-        histogram[bin_0]['sum_gradients'] += all_gradients[i]
-        histogram[bin_1]['sum_gradients'] += all_gradients[i + 1]
-        histogram[bin_2]['sum_gradients'] += all_gradients[i + 2]
-        histogram[bin_3]['sum_gradients'] += all_gradients[i + 3]
-
-        histogram[bin_0]['sum_hessians'] += all_hessians[i]
-        histogram[bin_1]['sum_hessians'] += all_hessians[i + 1]
-        histogram[bin_2]['sum_hessians'] += all_hessians[i + 2]
-        histogram[bin_3]['sum_hessians'] += all_hessians[i + 3]
-
-        histogram[bin_0]['count'] += 1
-        histogram[bin_1]['count'] += 1
-        histogram[bin_2]['count'] += 1
-        histogram[bin_3]['count'] += 1
+        bin_0 = min(binned_feature[i], last_bin)
+        bin_1 = min(binned_feature[i + 1], last_bin)
+        bin_2 = min(binned_feature[i + 2], last_bin)
+        bin_3 = min(binned_feature[i + 3], last_bin)
+
+        sum_gradients[bin_0] += all_gradients[i]
+        sum_gradients[bin_1] += all_gradients[i + 1]
+        sum_gradients[bin_2] += all_gradients[i + 2]
+        sum_gradients[bin_3] += all_gradients[i + 3]
+
+        sum_hessians[bin_0] += all_hessians[i]
+        sum_hessians[bin_1] += all_hessians[i + 1]
+        sum_hessians[bin_2] += all_hessians[i + 2]
+        sum_hessians[bin_3] += all_hessians[i + 3]
+
+        count[bin_0] += 1
+        count[bin_1] += 1
+        count[bin_2] += 1
+        count[bin_3] += 1
 
     for i in range(unrolled_upper, n_node_samples):
-        bin_idx = binned_feature[i]
-        histogram[bin_idx]['sum_gradients'] += all_gradients[i]
-        histogram[bin_idx]['sum_hessians'] += all_hessians[i]
-        histogram[bin_idx]['count'] += 1
+        bin_idx = min(binned_feature[i], last_bin)
+        sum_gradients[bin_idx] += all_gradients[i]
+        sum_hessians[bin_idx] += all_hessians[i]
+        count[bin_idx] += 1
 
     return histogram
+
+
+@njit
+def _build_sparse_histograms(offsets, zero_bins, sample_indices, binned_data,
+                             binned_indices, binned_indptr, ordered_gradients,
+                             ordered_hessians, constant_hessian,
+                             sum_gradients, sum_hessians):
+    """Build the packed histograms of all the features of CSR binned data
+
+    Only the stored entries of the rows in sample_indices are scanned. The
+    implicit entries of a feature fall into its zero bin: their statistics
+    are the node totals minus the statistics of the stored entries.
+    ordered_gradients and ordered_hessians are aligned with sample_indices,
+    sum_gradients and sum_hessians are their sums.
+    """
+    n_features = zero_bins.shape[0]
+    histograms = _zero_histograms(offsets,
+                                  _histogram_dtype(ordered_gradients))
+    hist_gradients = histograms.sum_gradients
+    hist_hessians = histograms.sum_hessians
+    hist_count = histograms.count
+    n_node_samples = sample_indices.shape[0]
+
+    for i in range(n_node_samples):
+        sample_idx = sample_indices[i]
+        for k in range(binned_indptr[sample_idx],
+                       binned_indptr[sample_idx + 1]):
+            feature_idx = binned_indices[k]
+            start = offsets[feature_idx]
+            bin_idx = start + min(binned_data[k],
+                                  offsets[feature_idx + 1] - start - 1)
+            hist_gradients[bin_idx] += ordered_gradients[i]
+            if not constant_hessian:
+                hist_hessians[bin_idx] += ordered_hessians[i]
+            hist_count[bin_idx] += 1
+
+    for feature_idx in range(n_features):
+        stored_gradients = 0.
+        stored_hessians = 0.
+        stored_count = 0
+        for bin_idx in range(offsets[feature_idx], offsets[feature_idx + 1]):
+            stored_gradients += hist_gradients[bin_idx]
+            stored_hessians += hist_hessians[bin_idx]
+            stored_count += hist_count[bin_idx]
+        zero_bin = offsets[feature_idx] + zero_bins[feature_idx]
+        hist_gradients[zero_bin] += sum_gradients - stored_gradients
+        if not constant_hessian:
+            hist_hessians[zero_bin] += sum_hessians - stored_hessians
+        hist_count[zero_bin] += n_node_samples - stored_count
+
+    return histograms
+
+
+@njit
+def _unpack_histograms(column_offsets, column_histograms, feature_layout,
+                       unpacked_features, unpacked_offsets):
+    """Build the histograms of unpacked_features from those of their columns
+
+    Each bin of a column histogram is added to the bin of the feature that
+    its column value decodes to (see binning.make_feature_layout): for a
+    bundle, the values coding the other features of the bundle fall into
+    the default (zero) bin of the feature. The histograms of the columns
+    and of the unpacked features are packed along column_offsets and
+    unpacked_offsets.
+    """
+    n_features = unpacked_features.shape[0]
+    histograms = _zero_histograms(unpacked_offsets,
+                                  column_histograms.sum_gradients.dtype)
+    for i in range(n_features):
+        feature_idx = unpacked_features[i]
+        column_idx = feature_layout[feature_idx]['column']
+        start = unpacked_offsets[i]
+        last_bin = unpacked_offsets[i + 1] - start - 1
+        column_start = column_offsets[column_idx]
+        for value in range(column_offsets[column_idx + 1] - column_start):
+            count = column_histograms.count[column_start + value]
+            if count == 0:
+                continue
+            bin_idx = start + min(
+                decode_bin(feature_layout, feature_idx, value), last_bin)
+            histograms.sum_gradients[bin_idx] += (
+                column_histograms.sum_gradients[column_start + value])
+            histograms.sum_hessians[bin_idx] += (
+                column_histograms.sum_hessians[column_start + value])
+            histograms.count[bin_idx] += count
+    return histograms
+
+
+@njit(parallel=True)
+def _build_histograms_row_wise(n_threads, sample_indices, binned_features,
+                               ordered_gradients, ordered_hessians,
+                               constant_hessian, offsets, histograms,
+                               buffers):
+    """Build the histograms of all the columns of binned_features at once
+
+    Each sample of sample_indices is visited once, its gradient (and
+    hessian) being added to the histograms of all the columns, instead of
+    reading sample_indices and the gradients once per column like the
+    column-wise kernels above. ordered_gradients and ordered_hessians are
+    aligned with sample_indices. The histograms are packed along offsets.
+
+    The samples are divided into n_threads contiguous chunks. Each thread
+    accumulates the statistics of its chunk into its own buffers, arrays of
+    shape (n_threads, offsets[-1]), which are then summed into histograms.
+    With a single thread, histograms is updated directly.
+    """
+    n_samples = sample_indices.shape[0]
+    hist_gradients, hist_hessians, hist_count = histograms
+    if n_threads == 1:
+        _accumulate_rows(sample_indices, binned_features, ordered_gradients,
+                         ordered_hessians, constant_hessian, 0, n_samples,
+                         offsets, hist_gradients, hist_hessians, hist_count)
+        return
+
+    buffer_gradients, buffer_hessians, buffer_count = buffers
+    sizes = np.full(n_threads, n_samples // n_threads, dtype=np.int64)
+    sizes[:n_samples % n_threads] += 1
+    starts = np.zeros(n_threads, dtype=np.int64)
+    starts[1:] = np.cumsum(sizes[:-1])
+    for thread_idx in prange(n_threads):
+        buffer_gradients[thread_idx] = 0
+        buffer_hessians[thread_idx] = 0
+        buffer_count[thread_idx] = 0
+        _accumulate_rows(sample_indices, binned_features, ordered_gradients,
+                         ordered_hessians, constant_hessian,
+                         starts[thread_idx],
+                         starts[thread_idx] + sizes[thread_idx], offsets,
+                         buffer_gradients[thread_idx],
+                         buffer_hessians[thread_idx],
+                         buffer_count[thread_idx])
+
+    n_columns = binned_features.shape[1]
+    for column_idx in prange(n_columns):
+        for thread_idx in range(n_threads):
+            for bin_idx in range(offsets[column_idx],
+                                 offsets[column_idx + 1]):
+                hist_gradients[bin_idx] += buffer_gradients[thread_idx,
+                                                            bin_idx]
+                hist_hessians[bin_idx] += buffer_hessians[thread_idx,
+                                                          bin_idx]
+                hist_count[bin_idx] += buffer_count[thread_idx, bin_idx]
+
+
+@njit
+def _accumulate_rows(sample_indices, binned_features, ordered_gradients,
+                     ordered_hessians, constant_hessian, start, stop,
+                     offsets, sum_gradients, sum_hessians, count):
+    """Add the samples start:stop of sample_indices to the histograms of all
+    the columns, packed along offsets"""
+    n_columns = binned_features.shape[1]
+    for i in range(start, stop):
+        sample_idx = sample_indices[i]
+        gradient = ordered_gradients[i]
+        if constant_hessian:
+            for column_idx in range(n_columns):
+                column_start = offsets[column_idx]
+                bin_idx = column_start + min(
+                    binned_features[sample_idx, column_idx],
+                    offsets[column_idx + 1] - column_start - 1)
+                sum_gradients[bin_idx] += gradient
+                count[bin_idx] += 1
+        else:
+            hessian = ordered_hessians[i]
+            for column_idx in range(n_columns):
+                column_start = offsets[column_idx]
+                bin_idx = column_start + min(
+                    binned_features[sample_idx, column_idx],
+                    offsets[column_idx + 1] - column_start - 1)
+                sum_gradients[bin_idx] += gradient
+                sum_hessians[bin_idx] += hessian
+                count[bin_idx] += 1
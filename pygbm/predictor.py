@@ -1,5 +1,11 @@
 import numpy as np
 from numba import njit, from_dtype, prange
+from scipy.sparse import issparse, csr_matrix
+
+from .bitset import BITSET_N_WORDS, in_bitset
+from .sparse import get_sparse_value
+from .binning import decode_bin, identity_feature_layout
+from .binning import FEATURE_LAYOUT_DTYPE
 
 
 PREDICTOR_RECORD_DTYPE = np.dtype([
@@ -7,69 +13,209 @@ PREDICTOR_RECORD_DTYPE = np.dtype([
     ('value', np.float32),
     ('count', np.uint32),
     ('feature_idx', np.uint32),
-    ('bin_threshold', np.uint8),
+    ('bin_threshold', np.uint16),
     ('threshold', np.float32),
     ('left', np.uint32),
     ('right', np.uint32),
     ('gain', np.float32),
     ('depth', np.uint32),
+    ('missing_go_to_left', np.uint8),
+    ('is_categorical', np.uint8),
+    ('bitset_idx', np.uint32),  # row of the categorical_bitsets array
     # TODO: shrinkage in leaf for feature importance error bar?
 ])
 PREDICTOR_NUMBA_TYPE = from_dtype(PREDICTOR_RECORD_DTYPE)[::1]
 
 
 class TreePredictor:
-    def __init__(self, nodes):
+    """Tree structure that can make predictions on new data.
+
+    Parameters
+    ----------
+    nodes: array of PREDICTOR_RECORD_DTYPE
+        The nodes of the tree.
+
+    missing_values_bin_idx: int or None
+        The bin of the missing values in the binned data, if the tree was
+        grown with support for missing values.
+
+    categorical_bitsets: array (n_categorical_splits, BITSET_N_WORDS) or None
+        For each categorical split, the bitset of the categories that go to
+        the left child. Categories are equal to their bins.
+    """
+    def __init__(self, nodes, missing_values_bin_idx=None,
+                 categorical_bitsets=None):
         self.nodes = nodes
+        self.missing_values_bin_idx = missing_values_bin_idx
+        if categorical_bitsets is None:
+            categorical_bitsets = np.zeros((0, BITSET_N_WORDS),
+                                           dtype=np.uint32)
+        self.categorical_bitsets = categorical_bitsets
 
     def get_n_leaf_nodes(self):
         return int(self.nodes['is_leaf'].sum())
 
-    def predict_binned(self, binned_data, out=None):
+    def predict_binned(self, binned_data, out=None, zero_bins=None,
+                       feature_layout=None):
+        """Predict the binned data, which may be a sparse matrix
+
+        zero_bins holds the bin of the implicit entries of each feature of
+        sparse binned data. It defaults to 0 for all the features.
+
+        If the columns of binned_data hold bundled or packed features,
+        feature_layout is the feature_layout_ attribute of the BinMapper
+        locating the bins of each feature in the columns.
+        """
         if out is None:
             out = np.empty(binned_data.shape[0], dtype=np.float32)
-        _predict_binned(self.nodes, binned_data, out)
+        missing_values_bin_idx = self.missing_values_bin_idx
+        if missing_values_bin_idx is None:
+            missing_values_bin_idx = -1  # never matches a bin
+        if issparse(binned_data):
+            binned_data = _canonical_csr(binned_data)
+            if zero_bins is None:
+                zero_bins = np.zeros(binned_data.shape[1],
+                                     dtype=binned_data.dtype)
+            _predict_sparse_binned(
+                self.nodes, self.categorical_bitsets, binned_data.data,
+                binned_data.indices, binned_data.indptr,
+                np.asarray(zero_bins, dtype=binned_data.dtype),
+                missing_values_bin_idx, out)
+        else:
+            if feature_layout is None:
+                feature_layout = identity_feature_layout(binned_data.shape[1])
+            feature_layout = np.ascontiguousarray(feature_layout,
+                                                  dtype=FEATURE_LAYOUT_DTYPE)
+            _predict_binned(self.nodes, self.categorical_bitsets,
+                            binned_data, feature_layout,
+                            missing_values_bin_idx, out)
         return out
 
     def predict(self, X):
         # TODO: introspect X to dispatch to numerical or categorical data
-        # (dense or sparse) on a feature by feature basis.
+        # on a feature by feature basis.
         out = np.empty(X.shape[0], dtype=np.float32)
-        _predict_from_numeric_data(self.nodes, X, out)
+        if issparse(X):
+            # Rows are traversed independently: only the CSR layout gives
+            # access to the stored entries of a row without densification.
+            X = _canonical_csr(X)
+            _predict_from_sparse_numeric_data(
+                self.nodes, self.categorical_bitsets, X.data, X.indices,
+                X.indptr, out)
+        else:
+            _predict_from_numeric_data(self.nodes, self.categorical_bitsets,
+                                       X, out)
         return out
 
 
+def _canonical_csr(X):
+    """Return X as a CSR matrix with sorted indices, without modifying X"""
+    X = csr_matrix(X)
+    if not X.has_sorted_indices:
+        X = X.copy()
+        X.sort_indices()
+    return X
+
+
+@njit
+def _goes_left_binned(node, categorical_bitsets, bin_idx,
+                      missing_values_bin_idx):
+    if bin_idx == missing_values_bin_idx:
+        return node['missing_go_to_left']
+    if node['is_categorical']:
+        return in_bitset(categorical_bitsets[node['bitset_idx']], bin_idx)
+    return bin_idx <= node['bin_threshold']
+
+
+@njit
+def _goes_left_numeric(node, categorical_bitsets, value):
+    if np.isnan(value):
+        return node['missing_go_to_left']
+    if node['is_categorical']:
+        # Unknown categories are treated as missing values, as in
+        # BinMapper.transform. The threshold is the number of categories.
+        if not (0 <= value < node['threshold'] and value == int(value)):
+            return node['missing_go_to_left']
+        return in_bitset(categorical_bitsets[node['bitset_idx']],
+                         int(value))
+    return value <= node['threshold']
+
+
 @njit
-def _predict_one_binned(nodes, binned_data):
+def _predict_one_binned(nodes, categorical_bitsets, binned_data,
+                        feature_layout, missing_values_bin_idx):
     node = nodes[0]
     while True:
         if node['is_leaf']:
             return node['value']
-        if binned_data[node['feature_idx']] <= node['bin_threshold']:
+        feature_idx = node['feature_idx']
+        bin_idx = decode_bin(
+            feature_layout, feature_idx,
+            binned_data[feature_layout[feature_idx]['column']])
+        if _goes_left_binned(node, categorical_bitsets, bin_idx,
+                             missing_values_bin_idx):
             node = nodes[node['left']]
         else:
             node = nodes[node['right']]
 
 
 @njit(parallel=True)
-def _predict_binned(nodes, binned_data, out):
+def _predict_binned(nodes, categorical_bitsets, binned_data, feature_layout,
+                    missing_values_bin_idx, out):
     for i in prange(binned_data.shape[0]):
-        out[i] = _predict_one_binned(nodes, binned_data[i])
+        out[i] = _predict_one_binned(nodes, categorical_bitsets,
+                                     binned_data[i], feature_layout,
+                                     missing_values_bin_idx)
+
+
+@njit(parallel=True)
+def _predict_sparse_binned(nodes, categorical_bitsets, data, indices, indptr,
+                           zero_bins, missing_values_bin_idx, out):
+    for i in prange(indptr.shape[0] - 1):
+        node = nodes[0]
+        while not node['is_leaf']:
+            feature_idx = node['feature_idx']
+            bin_idx = get_sparse_value(data, indices, indptr[i],
+                                       indptr[i + 1], feature_idx,
+                                       zero_bins[feature_idx])
+            if _goes_left_binned(node, categorical_bitsets, bin_idx,
+                                 missing_values_bin_idx):
+                node = nodes[node['left']]
+            else:
+                node = nodes[node['right']]
+        out[i] = node['value']
 
 
 @njit
-def _predict_one_from_numeric_data(nodes, numeric_data):
+def _predict_one_from_numeric_data(nodes, categorical_bitsets, numeric_data):
     node = nodes[0]
     while True:
         if node['is_leaf']:
             return node['value']
-        if numeric_data[node['feature_idx']] <= node['threshold']:
+        value = numeric_data[node['feature_idx']]
+        if _goes_left_numeric(node, categorical_bitsets, value):
             node = nodes[node['left']]
         else:
             node = nodes[node['right']]
 
 
 @njit(parallel=True)
-def _predict_from_numeric_data(nodes, numeric_data, out):
+def _predict_from_numeric_data(nodes, categorical_bitsets, numeric_data, out):
     for i in prange(numeric_data.shape[0]):
-        out[i] = _predict_one_from_numeric_data(nodes, numeric_data[i])
+        out[i] = _predict_one_from_numeric_data(nodes, categorical_bitsets,
+                                                numeric_data[i])
+
+
+@njit(parallel=True)
+def _predict_from_sparse_numeric_data(nodes, categorical_bitsets, data,
+                                      indices, indptr, out):
+    for i in prange(indptr.shape[0] - 1):
+        node = nodes[0]
+        while not node['is_leaf']:
+            value = get_sparse_value(data, indices, indptr[i], indptr[i + 1],
+                                     node['feature_idx'], 0.)
+            if _goes_left_numeric(node, categorical_bitsets, value):
+                node = nodes[node['left']]
+            else:
+                node = nodes[node['right']]
+        out[i] = node['value']
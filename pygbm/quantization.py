@@ -0,0 +1,45 @@
+"""Stochastic quantization of the gradients and hessians.
+
+With quantized training (like use_quantized_grad in LightGBM), the
+gradients and hessians of each tree are rounded to int8 or int16 integers
+times a float scale, so that the histograms sum integers into int32: they
+are smaller, and faster to build and to subtract. The rounding is
+stochastic, hence unbiased: the sums of the quantized values are close to
+the exact sums, which are still used to compute the values of the leaves.
+"""
+import numpy as np
+from numba import njit, prange
+
+QUANTIZED_DTYPES = {8: np.int8, 16: np.int16}
+# The histograms of the quantized gradients are int32.
+MAX_HISTOGRAM_SUM = np.iinfo(np.int32).max
+
+
+def quantize(values, n_bits, rng):
+    """Stochastically round values to n_bits integers
+
+    The scale is chosen so that the largest absolute value maps to the
+    largest integer, and so that the sum of the integers over all the
+    values fits into the int32 histograms.
+
+    Returns the integers, of dtype QUANTIZED_DTYPES[n_bits], and the scale:
+    the quantized values are the integers times the scale.
+    """
+    n_levels = min(np.iinfo(QUANTIZED_DTYPES[n_bits]).max,
+                   MAX_HISTOGRAM_SUM // values.shape[0])
+    max_abs_value = np.abs(values).max()
+    scale = max_abs_value / n_levels if max_abs_value > 0 else 1.
+    quantized = np.empty(values.shape[0], dtype=QUANTIZED_DTYPES[n_bits])
+    _stochastic_round(values, np.float32(1. / scale), n_levels,
+                      rng.uniform(size=values.shape[0]).astype(np.float32),
+                      quantized)
+    return quantized, np.float32(scale)
+
+
+@njit(parallel=True)
+def _stochastic_round(values, inverse_scale, n_levels, noise, quantized):
+    """Round values * inverse_scale down or up, with a probability of being
+    rounded up equal to the fractional part (noise is uniform in [0, 1))"""
+    for i in prange(values.shape[0]):
+        level = np.floor(values[i] * inverse_scale + noise[i])
+        quantized[i] = min(max(level, -n_levels), n_levels)
@@ -0,0 +1,25 @@
+"""Helpers to read the rows of CSR matrices from numba code.
+
+The column indices of each row are expected to be sorted, which is the
+canonical format of scipy.sparse matrices.
+"""
+from numba import njit
+
+
+@njit
+def get_sparse_value(data, indices, start, stop, column, default):
+    """Return the value at column of the row stored in data[start:stop]
+
+    The column indices of the row are indices[start:stop]. default is
+    returned for the columns that are not stored, i.e. implicit zeros.
+    """
+    left, right = start, stop
+    while left < right:
+        middle = (left + right) // 2
+        if indices[middle] < column:
+            left = middle + 1
+        else:
+            right = middle
+    if left < stop and indices[left] == column:
+        return data[left]
+    return default
@@ -1,86 +1,308 @@
-# from collections import namedtuple
+from collections import namedtuple
+
 import numpy as np
-from numba import njit, jitclass, prange, float32, uint8, uint32, optional
+from numba import (njit, jitclass, prange, float32, uint8, uint16, uint32,
+                   int8, int16, int32, int64, optional, from_dtype)
 import numba
 from .histogram import _build_histogram
 from .histogram import _subtract_histograms
 from .histogram import _build_histogram_no_hessian
 from .histogram import _build_histogram_root
 from .histogram import _build_histogram_root_no_hessian
-from .histogram import HISTOGRAM_DTYPE
-
-
-@jitclass([
-    ('gain', float32),
-    ('feature_idx', uint32),
-    ('bin_idx', uint8),
-    ('gradient_left', float32),
-    ('hessian_left', float32),
-    ('gradient_right', float32),
-    ('hessian_right', float32),
-    ('n_samples_left', uint32),
-    ('n_samples_right', uint32),
-])
-class SplitInfo:
-    def __init__(self, gain=-1., feature_idx=0, bin_idx=0,
-                 gradient_left=0., hessian_left=0.,
-                 gradient_right=0., hessian_right=0.,
-                 n_samples_left=0, n_samples_right=0):
-        self.gain = gain
-        self.feature_idx = feature_idx
-        self.bin_idx = bin_idx
-        self.gradient_left = gradient_left
-        self.hessian_left = hessian_left
-        self.gradient_right = gradient_right
-        self.hessian_right = hessian_right
-        self.n_samples_left = n_samples_left
-        self.n_samples_right = n_samples_right
-
-
-@jitclass([
-    ('n_features', uint32),
-    ('binned_features', uint8[::1, :]),
-    ('n_bins', uint32),
-    ('min_samples_leaf', optional(uint32)),
-    ('min_gain_to_split', float32),
-    ('all_gradients', float32[::1]),
-    ('all_hessians', float32[::1]),
-    ('ordered_gradients', float32[::1]),
-    ('ordered_hessians', float32[::1]),
-    ('sum_gradients', float32),
-    ('sum_hessians', float32),
-    ('constant_hessian', uint8),
-    ('constant_hessian_value', float32),
-    ('l2_regularization', float32),
-    ('min_hessian_to_split', float32),
-    ('partition', uint32[::1]),
-    ('left_indices_buffer', uint32[::1]),
-    ('right_indices_buffer', uint32[::1]),
+from .histogram import _build_sparse_histograms
+from .histogram import _unpack_histograms
+from .histogram import _zero_histograms
+from .histogram import _histogram_dtype
+from .histogram import _get_histogram
+from .histogram import _set_histogram
+from .histogram import _build_histograms_row_wise
+from .bitset import set_bitset, in_bitset, BITSET_N_WORDS
+from .sparse import get_sparse_value
+from .binning import decode_bin, identity_feature_layout
+from .binning import FEATURE_LAYOUT_NUMBA_TYPE
+
+# How the histograms of dense data are built, see _n_row_wise_threads:
+# automatically chosen for each node, or forced to the column-wise kernels
+# (one histogram per column, in parallel over the columns) or to the
+# row-wise kernel (all the histograms at once, in parallel over the
+# samples), like the force_col_wise and force_row_wise options of LightGBM.
+HISTOGRAM_AUTO = 0
+HISTOGRAM_COL_WISE = 1
+HISTOGRAM_ROW_WISE = 2
+# The row-wise kernel updates the histograms of all the columns for each
+# sample: it is only chosen automatically if they fit in the cache of a
+# core, i.e. if there are no more than this number of bins in total.
+ROW_WISE_MAX_TOTAL_BINS = 2 ** 15
+# Relative cost of a histogram update by the column-wise kernels, which
+# read sample_indices and the gradients once per column.
+COL_WISE_OVERHEAD = 1.5
+# With fewer columns than threads, the column-wise histograms of a node are
+# built in parallel over the columns and over chunks of samples of at least
+# this number of bins (see _n_sample_chunks).
+MIN_CHUNK_SIZE_PER_BIN = 16
+# How the best bin of each feature is found in the histograms of a node: by
+# a loop over the bins of each feature that stops as soon as a child gets
+# too small (_find_best_bin_to_split_helper), or by evaluating the gains of
+# all the bins of all the features at once, with masks for the constraints
+# (_scan_histograms_vectorized). The loop is the default: the vectorized
+# scan writes and reads back the prefix sums and the gains of the whole
+# block, which costs more than the early exits save, even for nodes with
+# many features.
+SCAN_AUTO = 0
+SCAN_LOOP = 1
+SCAN_VECTORIZED = 2
+
+
+# The split found for a feature of a node: the splitting context holds one
+# such record per feature, filled in parallel by the split finders, and the
+# best one is returned to the TreeGrower as a SplitInfo.
+SPLIT_INFO_DTYPE = np.dtype([
+    ('gain', np.float32),
+    ('feature_idx', np.uint32),
+    ('bin_idx', np.uint16),
+    ('gradient_left', np.float32),
+    ('hessian_left', np.float32),
+    ('gradient_right', np.float32),
+    ('hessian_right', np.float32),
+    ('n_samples_left', np.uint32),
+    ('n_samples_right', np.uint32),
+    ('missing_go_to_left', np.uint8),
+    # For categorical splits, the categories (bins) of the left child.
+    ('is_categorical', np.uint8),
+    ('left_cat_bitset', np.uint32, (BITSET_N_WORDS,)),
 ])
+SPLIT_INFO_NUMBA_TYPE = from_dtype(SPLIT_INFO_DTYPE)[::1]
+SplitInfo = namedtuple('SplitInfo', SPLIT_INFO_DTYPE.names)
+# The best split of a node is searched in parallel over chunks of at least
+# this number of features.
+MIN_FEATURES_PER_CHUNK = 64
+
+
+def _splitting_context_spec(binned_type, gradient_type=float32):
+    """Return the jitclass spec of a SplittingContext of binned_type data
+    and gradient_type gradients and hessians."""
+    histogram_type = float32 if gradient_type == float32 else int32
+    return [
+        ('n_features', uint32),
+        ('binned_features', binned_type[::1, :]),
+        ('n_bins', uint32),
+        ('min_samples_leaf', optional(uint32)),
+        ('min_gain_to_split', float32),
+        ('all_gradients', gradient_type[::1]),
+        ('all_hessians', gradient_type[::1]),
+        ('ordered_gradients', gradient_type[::1]),
+        ('ordered_hessians', gradient_type[::1]),
+        ('gradient_scale', float32),
+        ('hessian_scale', float32),
+        ('sum_gradients', float32),
+        ('sum_hessians', float32),
+        ('constant_hessian', uint8),
+        ('constant_hessian_value', float32),
+        ('l2_regularization', float32),
+        ('min_hessian_to_split', float32),
+        ('partition', uint32[::1]),
+        ('left_indices_buffer', uint32[::1]),
+        ('right_indices_buffer', uint32[::1]),
+        ('partition_gradients', uint8),
+        ('gradients_offset', int64),
+        ('gradients_buffer', gradient_type[::1]),
+        ('hessians_buffer', gradient_type[::1]),
+        ('support_missing_values', uint8),
+        ('missing_values_bin_idx', uint32),
+        ('is_categorical', uint8[::1]),
+        ('is_sparse', uint8),
+        ('sparse_data', binned_type[::1]),
+        ('sparse_indices', int32[::1]),
+        ('sparse_indptr', int64[::1]),
+        ('zero_bins', binned_type[::1]),
+        ('has_feature_layout', uint8),
+        ('feature_layout', FEATURE_LAYOUT_NUMBA_TYPE),
+        ('n_bins_per_feature', uint32[::1]),
+        ('column_n_bins', uint32[::1]),
+        ('column_offsets', int64[::1]),
+        ('unpacked_features', uint32[::1]),
+        ('unpacked_idx', int32[::1]),
+        ('unpacked_offsets', int64[::1]),
+        ('histogram_method', uint8),
+        ('scan_method', uint8),
+        ('column_features', int32[::1]),
+        ('n_threads', uint32),
+        ('split_infos', SPLIT_INFO_NUMBA_TYPE),
+        ('thread_gradients', histogram_type[:, ::1]),
+        ('thread_hessians', histogram_type[:, ::1]),
+        ('thread_count', uint32[:, ::1]),
+        ('scan_gradients', float32[::1]),
+        ('scan_hessians', float32[::1]),
+        ('scan_count', uint32[::1]),
+        ('scan_gains', float32[::1]),
+        ('scan_missing_go_to_left', uint8[::1]),
+    ]
+
+
 class SplittingContext:
     def __init__(self, n_features, binned_features, n_bins,
                  all_gradients, all_hessians, l2_regularization,
                  min_hessian_to_split=1e-3, min_samples_leaf=None,
-                 min_gain_to_split=0.):
+                 min_gain_to_split=0., missing_values_bin_idx=None,
+                 is_categorical=None, sparse_binned_features=None,
+                 feature_layout=None, histogram_method=HISTOGRAM_AUTO,
+                 gradient_scale=1., hessian_scale=1.,
+                 partition_gradients=False, n_bins_per_feature=None,
+                 scan_method=SCAN_AUTO):
         self.n_features = n_features
-        self.binned_features = binned_features
+        # Fortran arrays are kept as is. The empty placeholder of sparse data
+        # is also C contiguous and would be typed as such by numba.
+        self.binned_features = np.asfortranarray(binned_features)
+        # Empty array of the dtype of the binned data (uint8 or uint16), for
+        # the unused attributes below.
+        no_bins = binned_features[:0, 0].copy()
+        # The histogram of each feature only has n_bins_per_feature bins:
+        # its actual bins, then a bin for the missing values (see
+        # BinMapper), whose values are mapped to the last bin.
+        if n_bins_per_feature is None:
+            self.n_bins_per_feature = np.full(n_features, n_bins,
+                                              dtype=np.uint32)
+        else:
+            self.n_bins_per_feature = n_bins_per_feature
+        # With bundled or 4-bit packed features, the columns of the binned
+        # data hold several features, located by feature_layout (see
+        # binning.make_feature_layout). The histograms are built on the
+        # columns, over column_n_bins[column_idx] values (all the byte
+        # values for packed columns, the values of all the features of a
+        # bundle), and the histograms of the features of bundled or packed
+        # columns (the unpacked_features) are unpacked from them before
+        # looking for the best split. The histograms of the other features
+        # are their column histograms. The histograms of the columns and of
+        # the unpacked features are packed along column_offsets and
+        # unpacked_offsets (see histogram.py).
+        n_columns = binned_features.shape[1]
+        self.column_n_bins = np.zeros(n_columns, dtype=np.uint32)
+        self.unpacked_idx = np.full(n_features, -1, dtype=np.int32)
+        if feature_layout is None:
+            self.has_feature_layout = False
+            self.feature_layout = identity_feature_layout(n_features)
+        else:
+            self.has_feature_layout = True
+            self.feature_layout = feature_layout
+        n_unpacked = 0
+        for feature_idx in range(n_features):
+            layout = self.feature_layout[feature_idx]
+            column_idx = layout['column']
+            if layout['mask'] == 0xF:
+                column_n_bins = uint32(256)
+            elif layout['offset'] > 0:
+                column_n_bins = uint32(layout['offset'] + layout['width'])
+            else:
+                column_n_bins = uint32(self.n_bins_per_feature[feature_idx])
+            self.column_n_bins[column_idx] = max(
+                self.column_n_bins[column_idx], column_n_bins)
+            if layout['mask'] == 0xF or layout['offset'] > 0:
+                self.unpacked_idx[feature_idx] = n_unpacked
+                n_unpacked += 1
+        self.column_offsets = np.zeros(n_columns + 1, dtype=np.int64)
+        self.column_offsets[1:] = np.cumsum(self.column_n_bins)
+        # The feature of each column whose histogram is that of the
+        # feature, -1 for bundled or packed columns.
+        self.column_features = np.full(n_columns, -1, dtype=np.int32)
+        for feature_idx in range(n_features):
+            if self.unpacked_idx[feature_idx] < 0:
+                self.column_features[
+                    self.feature_layout[feature_idx]['column']] = feature_idx
+        self.unpacked_features = np.empty(n_unpacked, dtype=np.uint32)
+        self.unpacked_offsets = np.zeros(n_unpacked + 1, dtype=np.int64)
+        for feature_idx in range(n_features):
+            unpacked_idx = self.unpacked_idx[feature_idx]
+            if unpacked_idx >= 0:
+                self.unpacked_features[unpacked_idx] = feature_idx
+                self.unpacked_offsets[unpacked_idx + 1] = (
+                    self.n_bins_per_feature[feature_idx])
+        self.unpacked_offsets = np.cumsum(self.unpacked_offsets)
+        # Sparse binned data is given as the (data, indices, indptr) arrays
+        # of a CSR matrix with sorted indices, along with the bin of the
+        # implicit entries of each feature. binned_features has no rows in
+        # this case.
+        if sparse_binned_features is None:
+            self.is_sparse = False
+            n_samples = binned_features.shape[0]
+            self.sparse_data = no_bins
+            self.sparse_indices = np.empty(0, dtype=np.int32)
+            self.sparse_indptr = np.zeros(1, dtype=np.int64)
+            self.zero_bins = no_bins
+        else:
+            self.is_sparse = True
+            (self.sparse_data, self.sparse_indices, self.sparse_indptr,
+             self.zero_bins) = sparse_binned_features
+            n_samples = self.sparse_indptr.shape[0] - 1
         self.n_bins = n_bins
+        # Quantized gradients and hessians are integers: their actual
+        # values are the integers times gradient_scale and hessian_scale.
+        # The histograms sum the integers, the scans scale the sums.
         self.all_gradients = all_gradients
         self.all_hessians = all_hessians
+        self.gradient_scale = gradient_scale
+        self.hessian_scale = hessian_scale
         # for root node, gradients and hessians are already ordered
         self.ordered_gradients = all_gradients.copy()
         self.ordered_hessians = all_hessians.copy()
-        self.sum_gradients = self.all_gradients.sum()
-        self.sum_hessians = self.all_hessians.sum()
+        self.sum_gradients = self.all_gradients.sum() * gradient_scale
+        self.sum_hessians = self.all_hessians.sum() * hessian_scale
         self.constant_hessian = all_hessians.shape[0] == 1
         self.l2_regularization = l2_regularization
         self.min_hessian_to_split = min_hessian_to_split
         self.min_samples_leaf = min_samples_leaf
         self.min_gain_to_split = min_gain_to_split
         if self.constant_hessian:
-            self.constant_hessian_value = self.all_hessians[0]  # 1 scalar
+            # 1 scalar
+            self.constant_hessian_value = self.all_hessians[0] * hessian_scale
         else:
             self.constant_hessian_value = float32(1.)  # won't be used anyway
+        # Missing values are mapped to the last bin of the histograms. The
+        # split finder learns for each split whether they go to the left or
+        # to the right child.
+        if missing_values_bin_idx is None:
+            self.support_missing_values = False
+            self.missing_values_bin_idx = n_bins  # won't be used anyway
+        else:
+            self.support_missing_values = True
+            self.missing_values_bin_idx = missing_values_bin_idx
+        # Categorical features are integer-coded: a bin is a category.
+        if is_categorical is None:
+            self.is_categorical = np.zeros(n_features, dtype=np.uint8)
+        else:
+            self.is_categorical = is_categorical
+
+        # Per-thread partial histograms of the row-wise kernel and of the
+        # sample-chunked column-wise histograms, only allocated if they can
+        # be used, i.e. with several threads and either few enough bins in
+        # total or fewer columns than threads.
+        self.histogram_method = histogram_method
+        self.scan_method = scan_method
+        self.n_threads = numba.config.NUMBA_DEFAULT_NUM_THREADS
+        buffers_shape = (self.n_threads, self.column_offsets[-1])
+        row_wise = (histogram_method == HISTOGRAM_ROW_WISE or
+                    (histogram_method == HISTOGRAM_AUTO and
+                     self.column_offsets[-1] <= ROW_WISE_MAX_TOTAL_BINS))
+        if (self.n_threads == 1 or self.is_sparse or
+                not (row_wise or n_columns < self.n_threads)):
+            buffers_shape = (0, 0)
+        histogram_dtype = _histogram_dtype(all_gradients)
+        self.thread_gradients = np.empty(buffers_shape, dtype=histogram_dtype)
+        self.thread_hessians = np.empty(buffers_shape, dtype=histogram_dtype)
+        self.thread_count = np.empty(buffers_shape, dtype=np.uint32)
+        # Prefix sums and gains of the thresholds of a block of histograms,
+        # only allocated if the histograms are scanned by
+        # _scan_histograms_vectorized.
+        n_scan_bins = 0
+        if scan_method == SCAN_VECTORIZED:
+            n_scan_bins = max(self.column_offsets[-1],
+                              self.unpacked_offsets[-1])
+        self.scan_gradients = np.empty(n_scan_bins, dtype=np.float32)
+        self.scan_hessians = np.empty(n_scan_bins, dtype=np.float32)
+        self.scan_count = np.empty(n_scan_bins, dtype=np.uint32)
+        self.scan_gains = np.empty(n_scan_bins, dtype=np.float32)
+        self.scan_missing_go_to_left = np.empty(n_scan_bins, dtype=np.uint8)
+        # The best split of each feature of the node being split.
+        self.split_infos = np.zeros(n_features, dtype=SPLIT_INFO_DTYPE)
 
         # The partition array maps each sample index into the leaves of the
         # tree (a leaf in this context is a node that isn't splitted yet, not
@@ -91,17 +313,48 @@ class SplittingContext:
         # partition = [cef|abdghijkl]
         # we have 2 leaves, the left one is at position 0 and the second one at
         # position 3. The order of the samples is irrelevant.
-        self.partition = np.arange(0, binned_features.shape[0], 1, np.uint32)
+        self.partition = np.arange(0, n_samples, 1, np.uint32)
         # buffers used in split_indices to support parallel splitting.
         self.left_indices_buffer = np.empty_like(self.partition)
         self.right_indices_buffer = np.empty_like(self.partition)
+        # With partition_gradients, ordered_gradients and ordered_hessians
+        # are kept aligned with the partition: split_indices permutes them
+        # along with the sample indices, so that the gradients of a node are
+        # contiguous, at the position of the node in the partition, and
+        # find_node_split does not gather them. Otherwise, the gradients of
+        # each node are gathered at the start of ordered_gradients.
+        # gradients_offset is the position of the gradients of the node
+        # being split.
+        self.partition_gradients = partition_gradients
+        self.gradients_offset = 0
+        n_buffer = n_samples if partition_gradients else 0
+        self.gradients_buffer = np.empty(n_buffer, dtype=all_gradients.dtype)
+        if self.constant_hessian:
+            n_buffer = 0
+        self.hessians_buffer = np.empty(n_buffer, dtype=all_hessians.dtype)
+
+
+# The binned data is either uint8 (the default, most compact layout) or
+# uint16 (for more than 256 bins): numba needs a jitclass for each dtype.
+# Likewise for the int8 and int16 quantized gradients, by (binned data,
+# gradients) dtypes.
+QUANTIZED_SPLITTING_CONTEXTS = {
+    (np.dtype(binned_dtype), np.dtype(gradient_dtype)): jitclass(
+        _splitting_context_spec(binned_type, gradient_type))(
+            SplittingContext)
+    for binned_dtype, binned_type in ((np.uint8, uint8), (np.uint16, uint16))
+    for gradient_dtype, gradient_type in ((np.int8, int8), (np.int16, int16))
+}
+SplittingContextUInt16 = jitclass(_splitting_context_spec(uint16))(
+    SplittingContext)
+SplittingContext = jitclass(_splitting_context_spec(uint8))(SplittingContext)
 
 
 @njit(parallel=True,
       locals={'sample_idx': uint32,
               'left_count': uint32,
               'right_count': uint32})
-def split_indices(context, split_info, sample_indices):
+def split_indices(context, split_info, sample_indices, partition_start=0):
     """Split samples into left and right arrays.
 
     This is a multi-threaded implementation inspired by lightgbm.
@@ -144,9 +397,32 @@ def split_indices(context, split_info, sample_indices):
     Note: We here show left/right_indices_buffer as being the same size as
     sample_indices for simplicity, but in reality they are of the same size as
     partition.
+
+    With context.partition_gradients, sample_indices starts at
+    partition_start in the partition and the gradients and hessians of the
+    node, at the same position in ordered_gradients and ordered_hessians,
+    are permuted along with it. Each thread puts the gradients of its left
+    samples at the start of its region of gradients_buffer, and those of
+    its right samples at the end.
     """
 
-    binned_feature = context.binned_features.T[split_info.feature_idx]
+    feature_idx = split_info.feature_idx
+    feature_layout = context.feature_layout
+    binned_feature = context.binned_features.T[
+        feature_layout[feature_idx]['column']]
+    has_feature_layout = context.has_feature_layout
+    missing_go_to_left = split_info.missing_go_to_left
+    missing_values_bin_idx = context.missing_values_bin_idx
+    is_categorical = split_info.is_categorical
+    left_cat_bitset = split_info.left_cat_bitset
+    is_sparse = context.is_sparse
+    sparse_data = context.sparse_data
+    sparse_indices = context.sparse_indices
+    sparse_indptr = context.sparse_indptr
+    if is_sparse:
+        zero_bin = context.zero_bins[feature_idx]
+    else:
+        zero_bin = uint8(0)  # won't be used anyway
 
     n_threads = numba.config.NUMBA_DEFAULT_NUM_THREADS
     n_samples = sample_indices.shape[0]
@@ -165,6 +441,14 @@ def split_indices(context, split_info, sample_indices):
     # (see numba issue 3459)
     left_indices_buffer = context.left_indices_buffer
     right_indices_buffer = context.right_indices_buffer
+    partition_gradients = context.partition_gradients
+    permute_hessians = partition_gradients and not context.constant_hessian
+    node_gradients = context.ordered_gradients[
+        partition_start:partition_start + n_samples]
+    node_hessians = context.ordered_hessians[
+        partition_start:partition_start + n_samples]
+    gradients_buffer = context.gradients_buffer
+    hessians_buffer = context.hessians_buffer
 
     # map indices from samples_indices to left/right_indices_buffer
     for thread_idx in prange(n_threads):
@@ -175,7 +459,30 @@ def split_indices(context, split_info, sample_indices):
         stop = start + sizes[thread_idx]
         for i in range(start, stop):
             sample_idx = sample_indices[i]
-            if binned_feature[sample_idx] <= split_info.bin_idx:
+            if is_sparse:
+                bin_idx = get_sparse_value(
+                    sparse_data, sparse_indices, sparse_indptr[sample_idx],
+                    sparse_indptr[sample_idx + 1], feature_idx, zero_bin)
+            elif has_feature_layout:
+                bin_idx = decode_bin(feature_layout, feature_idx,
+                                     binned_feature[sample_idx])
+            else:
+                bin_idx = binned_feature[sample_idx]
+            if bin_idx == missing_values_bin_idx:
+                goes_left = missing_go_to_left
+            elif is_categorical:
+                goes_left = in_bitset(left_cat_bitset, bin_idx)
+            else:
+                goes_left = bin_idx <= split_info.bin_idx
+            if partition_gradients:
+                if goes_left:
+                    buffer_idx = start + left_count
+                else:
+                    buffer_idx = stop - 1 - right_count
+                gradients_buffer[buffer_idx] = node_gradients[i]
+                if permute_hessians:
+                    hessians_buffer[buffer_idx] = node_hessians[i]
+            if goes_left:
                 left_indices_buffer[start + left_count] = sample_idx
                 left_count += 1
             else:
@@ -206,20 +513,43 @@ def split_indices(context, split_info, sample_indices):
             sample_indices[right_offset[thread_idx] + i] = \
                 right_indices_buffer[offset_in_buffers[thread_idx] + i]
 
+        if partition_gradients:
+            start = offset_in_buffers[thread_idx]
+            stop = start + sizes[thread_idx]
+            for i in range(left_counts[thread_idx]):
+                node_gradients[left_offset[thread_idx] + i] = \
+                    gradients_buffer[start + i]
+            for i in range(right_counts[thread_idx]):
+                node_gradients[right_offset[thread_idx] + i] = \
+                    gradients_buffer[stop - 1 - i]
+        if permute_hessians:
+            start = offset_in_buffers[thread_idx]
+            stop = start + sizes[thread_idx]
+            for i in range(left_counts[thread_idx]):
+                node_hessians[left_offset[thread_idx] + i] = \
+                    hessians_buffer[start + i]
+            for i in range(right_counts[thread_idx]):
+                node_hessians[right_offset[thread_idx] + i] = \
+                    hessians_buffer[stop - 1 - i]
+
     return (sample_indices[:right_child_position],
             sample_indices[right_child_position:])
 
 
 @njit(parallel=True)
-def find_node_split(context, sample_indices):
+def find_node_split(context, sample_indices, partition_start=0):
     """For each feature, find the best bin to split on by scanning data.
 
     This is done by calling _find_histogram_split that compute histograms
     for the samples that reached this node.
 
-    Returns the best SplitInfo among all features, along with all the feature
-    histograms that can be latter used to compute the sibling or children
-    histograms by substraction.
+    With context.partition_gradients, sample_indices starts at
+    partition_start in the partition, and so do the gradients of the node
+    in ordered_gradients: they are not gathered.
+
+    Returns the best split among all features, a record of SPLIT_INFO_DTYPE,
+    along with all the feature histograms that can be latter used to compute
+    the sibling or children histograms by substraction.
     """
 
     ctx = context  # shorter name to avoid various line breaks
@@ -230,11 +560,15 @@ def find_node_split(context, sample_indices):
     ordered_gradients = ctx.ordered_gradients
     ordered_hessians = ctx.ordered_hessians
 
-    # Populate ordered_gradients and ordered_hessians. (Already done for root)
+    # Populate ordered_gradients and ordered_hessians. (Already done for root
+    # and with partition_gradients)
     # This is a parallelized version of the following vanilla code:
     # for i range(n_samples):
     #     ctx.ordered_gradients[i] = ctx.all_gradients[samples_indices[i]]
-    if sample_indices.shape[0] != ctx.all_gradients.shape[0]:
+    ctx.gradients_offset = 0
+    if ctx.partition_gradients:
+        ctx.gradients_offset = partition_start
+    elif sample_indices.shape[0] != ctx.all_gradients.shape[0]:
         n_threads = numba.config.NUMBA_DEFAULT_NUM_THREADS
         # Each threads writes data in ordered_xx from starts[thread_idx] to
         # starts[thread_idx] + sizes[thread_idx]
@@ -254,27 +588,84 @@ def find_node_split(context, sample_indices):
                     ordered_gradients[i] = ctx.all_gradients[sample_indices[i]]
                     ordered_hessians[i] = ctx.all_hessians[sample_indices[i]]
 
-    ctx.sum_gradients = ctx.ordered_gradients[:n_samples].sum()
+    offset = ctx.gradients_offset
+    node_gradients = ctx.ordered_gradients[offset:offset + n_samples]
+    node_hessians = ctx.ordered_hessians[offset:offset + n_samples]
+
+    # Sums of the (possibly quantized) gradients and hessians of the node
+    sum_gradients = node_gradients.sum()
+    ctx.sum_gradients = sum_gradients * ctx.gradient_scale
     if ctx.constant_hessian:
+        sum_hessians = ctx.all_hessians[0] * n_samples
         ctx.sum_hessians = ctx.constant_hessian_value * float32(n_samples)
     else:
-        ctx.sum_hessians = ctx.ordered_hessians[:n_samples].sum()
-
-    # Pre-allocate the results datastructure to be able to use prange:
-    # numba jitclass do not seem to properly support default values for kwargs.
-    split_infos = [SplitInfo(-1., 0, 0, 0., 0., 0., 0., 0, 0)
-                   for i in range(context.n_features)]
-    histograms = np.empty(
-        shape=(np.int64(context.n_features), np.int64(context.n_bins)),
-        dtype=HISTOGRAM_DTYPE
-    )
+        sum_hessians = node_hessians.sum()
+        ctx.sum_hessians = sum_hessians * ctx.hessian_scale
+
+    if context.is_sparse:
+        # The histograms of all the features are built in a single pass
+        # over the stored entries of the rows of the node.
+        histograms = _build_sparse_histograms(
+            context.column_offsets, context.zero_bins, sample_indices,
+            context.sparse_data, context.sparse_indices,
+            context.sparse_indptr, node_gradients, node_hessians,
+            context.constant_hessian,
+            sum_gradients, sum_hessians)
+        _find_feature_splits(context, histograms, n_samples)
+        split_info = _find_best_feature_to_split_helper(context)
+        return split_info, histograms
+
+    n_columns = context.binned_features.shape[1]
+    n_chunks = _n_sample_chunks(context, n_samples)
+    n_threads = _n_row_wise_threads(context, n_samples, n_chunks)
+    if n_threads > 0:
+        histograms = _zero_histograms(context.column_offsets,
+                                      _histogram_dtype(ctx.all_gradients))
+        _build_histograms_row_wise(
+            n_threads, sample_indices, context.binned_features,
+            node_gradients, node_hessians, context.constant_hessian,
+            context.column_offsets, histograms,
+            (context.thread_gradients, context.thread_hessians,
+             context.thread_count))
+        _find_feature_splits(context, histograms, n_samples)
+        split_info = _find_best_feature_to_split_helper(context)
+        return split_info, histograms
+
+    if n_chunks > 1:
+        histograms = _zero_histograms(context.column_offsets,
+                                      _histogram_dtype(ctx.all_gradients))
+        _build_column_histograms_chunked(context, sample_indices, n_chunks,
+                                         histograms)
+        _find_feature_splits(context, histograms, n_samples)
+        split_info = _find_best_feature_to_split_helper(context)
+        return split_info, histograms
+
+    if context.has_feature_layout or context.scan_method == SCAN_VECTORIZED:
+        # The histograms of the columns are built from the data and
+        # returned, the histograms of the features are unpacked from them
+        # (if needed) and then scanned.
+        histograms = _zero_histograms(context.column_offsets,
+                                      _histogram_dtype(ctx.all_gradients))
+        hist_gradients, hist_hessians, hist_count = histograms
+        for column_idx in prange(n_columns):
+            _set_histogram(hist_gradients, hist_hessians, hist_count,
+                           context.column_offsets, column_idx,
+                           _build_column_histogram(
+                               context, column_idx, sample_indices, 0,
+                               n_samples))
+        _find_feature_splits(context, histograms, n_samples)
+        split_info = _find_best_feature_to_split_helper(context)
+        return split_info, histograms
+
+    histograms = _zero_histograms(context.column_offsets,
+                                  _histogram_dtype(ctx.all_gradients))
+    hist_gradients, hist_hessians, hist_count = histograms
     for feature_idx in prange(context.n_features):
-        split_info, histogram = _find_histogram_split(
-            context, feature_idx, sample_indices)
-        split_infos[feature_idx] = split_info
-        histograms[feature_idx, :] = histogram
+        histogram = _find_histogram_split(context, feature_idx, sample_indices)
+        _set_histogram(hist_gradients, hist_hessians, hist_count,
+                       context.column_offsets, feature_idx, histogram)
 
-    split_info = _find_best_feature_to_split_helper(split_infos)
+    split_info = _find_best_feature_to_split_helper(context)
     return split_info, histograms
 
 
@@ -287,119 +678,575 @@ def find_node_split_subtraction(context, sample_indices, parent_histograms,
     to scan the samples from this node and can therefore be significantly
     faster than computing the histograms from data.
 
-    Returns the best SplitInfo among all features, along with all the feature
-    histograms that can be latter used to compute the sibling or children
-    histograms by substraction.
+    The histograms of the node are computed in place in the buffers of
+    parent_histograms, which are overwritten: the parent histograms must not
+    be used anymore after this call.
+
+    Returns the best split among all features, a record of SPLIT_INFO_DTYPE,
+    along with all the feature histograms that can be latter used to compute
+    the sibling or children histograms by substraction.
     """
 
     # We can pick any feature (here the first) in the histograms to
     # compute the gradients: they must be the same across all features
     # anyway, we have tests ensuring this. Maybe a more robust way would
     # be to compute an average but it's probably not worth it.
-    context.sum_gradients = (parent_histograms[0]['sum_gradients'].sum() -
-                             sibling_histograms[0]['sum_gradients'].sum())
+    offsets = context.column_offsets
+    first_bins = offsets[1]
+    context.sum_gradients = (
+        parent_histograms.sum_gradients[:first_bins].sum() -
+        sibling_histograms.sum_gradients[:first_bins].sum()
+    ) * context.gradient_scale
 
     n_samples = sample_indices.shape[0]
     if context.constant_hessian:
         context.sum_hessians = \
             context.constant_hessian_value * float32(n_samples)
     else:
-        context.sum_hessians = (parent_histograms[0]['sum_hessians'].sum() -
-                                sibling_histograms[0]['sum_hessians'].sum())
-
-    # Pre-allocate the results datastructure to be able to use prange
-    split_infos = [SplitInfo(-1., 0, 0, 0., 0., 0., 0., 0, 0)
-                   for i in range(context.n_features)]
-    histograms = np.empty(
-        shape=(np.int64(context.n_features), np.int64(context.n_bins)),
-        dtype=HISTOGRAM_DTYPE
-    )
+        context.sum_hessians = (
+            parent_histograms.sum_hessians[:first_bins].sum() -
+            sibling_histograms.sum_hessians[:first_bins].sum()
+        ) * context.hessian_scale
+
+    # The histograms of the node are computed in place in the buffers of
+    # the parent, so that no histogram is allocated.
+    parent_gradients, parent_hessians, parent_count = parent_histograms
+    sibling_gradients, sibling_hessians, sibling_count = sibling_histograms
+    if context.has_feature_layout or context.scan_method == SCAN_VECTORIZED:
+        n_columns = offsets.shape[0] - 1
+        for column_idx in prange(n_columns):
+            _subtract_histograms(
+                context.column_n_bins[column_idx],
+                _get_histogram(parent_gradients, parent_hessians,
+                               parent_count, offsets, column_idx),
+                _get_histogram(sibling_gradients, sibling_hessians,
+                               sibling_count, offsets, column_idx))
+        _find_feature_splits(context, parent_histograms, n_samples)
+        split_info = _find_best_feature_to_split_helper(context)
+        return split_info, parent_histograms
+
     for feature_idx in prange(context.n_features):
-        split_info, histogram = _find_histogram_split_subtraction(
-            context, feature_idx, parent_histograms,
-            sibling_histograms, n_samples)
-        split_infos[feature_idx] = split_info
-        histograms[feature_idx, :] = histogram
+        _find_histogram_split_subtraction(
+            context, feature_idx,
+            _get_histogram(parent_gradients, parent_hessians, parent_count,
+                           offsets, feature_idx),
+            _get_histogram(sibling_gradients, sibling_hessians,
+                           sibling_count, offsets, feature_idx),
+            n_samples)
 
-    split_info = _find_best_feature_to_split_helper(split_infos)
-    return split_info, histograms
+    split_info = _find_best_feature_to_split_helper(context)
+    return split_info, parent_histograms
+
+
+@njit
+def _n_sample_chunks(context, n_samples):
+    """Return the number of chunks of samples of the column-wise histograms
+
+    With fewer columns than threads, parallelizing over the columns only
+    would leave threads idle (e.g. at the root, on 28 features and 64
+    cores): the samples are then divided into chunks so that there are
+    about as many (column, chunk) histograms to build as threads. Each
+    chunk has at least MIN_CHUNK_SIZE_PER_BIN times the mean number of
+    bins of the columns samples so that summing the partial histograms
+    costs little compared to building them.
+    """
+    n_columns = context.binned_features.shape[1]
+    if context.thread_count.shape[0] == 0 or n_columns >= context.n_threads:
+        return 1
+    n_chunks = (context.n_threads + n_columns - 1) // n_columns
+    min_chunk_size = (MIN_CHUNK_SIZE_PER_BIN * context.column_offsets[-1] //
+                      n_columns)
+    return max(1, min(n_chunks, n_samples // min_chunk_size))
 
 
 @njit
-def _find_best_feature_to_split_helper(split_infos):
-    best_gain = None
-    for i, split_info in enumerate(split_infos):
-        gain = split_info.gain
-        if best_gain is None or gain > best_gain:
-            best_gain = gain
-            best_split_info = split_info
-    return best_split_info
+def _n_row_wise_threads(context, n_samples, n_chunks):
+    """Return the number of threads of the row-wise histograms kernel for
+    a node of n_samples samples, or 0 to use the column-wise kernels.
+
+    The row-wise kernel is parallel over the samples, the column-wise
+    kernels over the columns and n_chunks chunks of samples: the kernel
+    with the least histogram updates per thread is used, the column-wise
+    updates being COL_WISE_OVERHEAD times more expensive. Each thread of
+    the row-wise kernel makes at least as many histogram updates as its
+    buffers have bins so that clearing and summing them costs less than
+    filling them.
+    """
+    if context.histogram_method == HISTOGRAM_COL_WISE:
+        return 0
+    n_columns = context.binned_features.shape[1]
+    n_total_bins = context.column_offsets[-1]
+    n_threads = 1
+    if context.thread_count.shape[0] > 0:
+        n_threads = max(1, min(context.n_threads,
+                               n_samples * n_columns // n_total_bins))
+    if context.histogram_method == HISTOGRAM_ROW_WISE:
+        return n_threads
+    if n_total_bins > ROW_WISE_MAX_TOTAL_BINS:
+        return 0
+    n_tasks = n_columns * n_chunks
+    n_col_wise_updates = (
+        (n_tasks + context.n_threads - 1) // context.n_threads *
+        n_samples / n_chunks * COL_WISE_OVERHEAD)
+    if n_columns * n_samples / n_threads <= n_col_wise_updates:
+        return n_threads
+    return 0
+
+
+@njit(parallel=True)
+def _build_column_histograms_chunked(context, sample_indices, n_chunks,
+                                     histograms):
+    """Build the column histograms in parallel over the columns and over
+    n_chunks chunks of samples
+
+    The partial histogram of each (column, chunk) is built into the
+    per-thread buffers of the context, which are then summed into
+    histograms. All the histograms are packed along context.column_offsets.
+    """
+    n_samples = sample_indices.shape[0]
+    n_columns = context.binned_features.shape[1]
+    sizes = np.full(n_chunks, n_samples // n_chunks, dtype=np.int64)
+    sizes[:n_samples % n_chunks] += 1
+    starts = np.zeros(n_chunks, dtype=np.int64)
+    starts[1:] = np.cumsum(sizes[:-1])
+    buffer_gradients = context.thread_gradients
+    buffer_hessians = context.thread_hessians
+    buffer_count = context.thread_count
+    offsets = context.column_offsets
+    for task_idx in prange(n_columns * n_chunks):
+        column_idx = task_idx % n_columns
+        chunk_idx = task_idx // n_columns
+        start = starts[chunk_idx]
+        _set_histogram(buffer_gradients[chunk_idx],
+                       buffer_hessians[chunk_idx], buffer_count[chunk_idx],
+                       offsets, column_idx, _build_column_histogram(
+                           context, column_idx, sample_indices, start,
+                           start + sizes[chunk_idx]))
+
+    hist_gradients, hist_hessians, hist_count = histograms
+    for column_idx in prange(n_columns):
+        for chunk_idx in range(n_chunks):
+            for bin_idx in range(offsets[column_idx],
+                                 offsets[column_idx + 1]):
+                hist_gradients[bin_idx] += buffer_gradients[chunk_idx,
+                                                            bin_idx]
+                hist_hessians[bin_idx] += buffer_hessians[chunk_idx,
+                                                          bin_idx]
+                hist_count[bin_idx] += buffer_count[chunk_idx, bin_idx]
+
+
+@njit(parallel=True)
+def _find_feature_splits(context, column_histograms, n_samples):
+    """Find the best split of each feature from the column histograms"""
+    feature_layout = context.feature_layout
+    unpacked_histograms = _unpack_histograms(
+        context.column_offsets, column_histograms, feature_layout,
+        context.unpacked_features, context.unpacked_offsets)
+    if context.scan_method == SCAN_VECTORIZED:
+        _scan_histograms_vectorized(context, column_histograms,
+                                    context.column_offsets,
+                                    context.column_features, n_samples)
+        _scan_histograms_vectorized(context, unpacked_histograms,
+                                    context.unpacked_offsets,
+                                    context.unpacked_features, n_samples)
+        return
+
+    unpacked_gradients, unpacked_hessians, unpacked_count = (
+        unpacked_histograms)
+    column_gradients, column_hessians, column_count = column_histograms
+    for feature_idx in prange(context.n_features):
+        unpacked_idx = context.unpacked_idx[feature_idx]
+        if unpacked_idx >= 0:
+            histogram = _get_histogram(unpacked_gradients, unpacked_hessians,
+                                       unpacked_count,
+                                       context.unpacked_offsets, unpacked_idx)
+        else:
+            histogram = _get_histogram(
+                column_gradients, column_hessians, column_count,
+                context.column_offsets, feature_layout[feature_idx]['column'])
+        _find_best_bin_to_split_helper(context, feature_idx, histogram,
+                                       n_samples)
+
+
+@njit(parallel=True)
+def _scan_histograms_vectorized(context, histograms, offsets, features,
+                                n_samples):
+    """Find the best bin of the features of a block of packed histograms
+
+    This is the vectorized counterpart of _find_best_bin_to_split_helper:
+    the statistics of the left child for each bin threshold are the prefix
+    sums of the histograms, stored for the whole block in the scan_*
+    arrays of the context, and the gains of
+    all the thresholds are then evaluated by a branchless loop that the
+    compiler vectorizes, the min_samples_leaf, min_hessian_to_split and
+    min_gain_to_split conditions being masks instead of early exits. Each
+    threshold is evaluated with the missing values sent to the right child
+    and, if there are any, to the left child. The best threshold of each
+    feature is finally stored in context.split_infos.
+
+    The histograms of the block are packed along offsets, histogram i being
+    that of features[i] (or of no feature if it is -1). The categorical
+    features are scanned by _find_best_bin_to_split_helper.
+    """
+    left = (context.scan_gradients, context.scan_hessians,
+            context.scan_count)
+    gains = context.scan_gains
+    missing_go_to_left = context.scan_missing_go_to_left
+    for i in prange(features.shape[0]):
+        _scan_histogram_vectorized(context, histograms, offsets, features, i,
+                                   n_samples, left, gains,
+                                   missing_go_to_left)
+
+
+@njit
+def _scan_histogram_vectorized(context, histograms, offsets, features, i,
+                               n_samples, left, gains, missing_go_to_left):
+    """Find the best bin of histogram i of a block, see
+    _scan_histograms_vectorized"""
+    feature_idx = features[i]
+    if feature_idx < 0:
+        return
+    sum_gradients, sum_hessians, count = histograms
+    if context.is_categorical[feature_idx]:
+        _find_best_bin_to_split_helper(
+            context, feature_idx,
+            _get_histogram(sum_gradients, sum_hessians, count, offsets, i),
+            n_samples)
+        return
+
+    start, stop = offsets[i], offsets[i + 1]
+    n_thresholds = stop - start
+    gradient_missing = float32(0.)
+    hessian_missing = float32(0.)
+    n_samples_missing = uint32(0)
+    if context.support_missing_values:
+        missing_bin = min(context.missing_values_bin_idx, n_thresholds - 1)
+        n_thresholds = missing_bin
+        missing_idx = start + missing_bin
+        gradient_missing = sum_gradients[missing_idx] * context.gradient_scale
+        if context.constant_hessian:
+            hessian_missing = (count[missing_idx] *
+                               context.constant_hessian_value)
+        else:
+            hessian_missing = (sum_hessians[missing_idx] *
+                               context.hessian_scale)
+        n_samples_missing = count[missing_idx]
+
+    gradient_left, hessian_left, n_samples_left = left
+    gradient = float32(0.)
+    hessian = float32(0.)
+    n_left = uint32(0)
+    for bin_idx in range(start, start + n_thresholds):
+        n_left += count[bin_idx]
+        if context.constant_hessian:
+            hessian += count[bin_idx] * context.constant_hessian_value
+        else:
+            hessian += sum_hessians[bin_idx] * context.hessian_scale
+        gradient += sum_gradients[bin_idx] * context.gradient_scale
+        gradient_left[bin_idx] = gradient
+        hessian_left[bin_idx] = hessian
+        n_samples_left[bin_idx] = n_left
+
+    min_samples_leaf = (uint32(0) if context.min_samples_leaf is None
+                        else context.min_samples_leaf)
+    _threshold_gains(
+        gradient_left, hessian_left, n_samples_left, start,
+        start + n_thresholds, gradient_missing, hessian_missing,
+        n_samples_missing, uint32(n_samples), context.sum_gradients,
+        context.sum_hessians, context.l2_regularization,
+        context.min_hessian_to_split, min_samples_leaf,
+        context.min_gain_to_split, gains, missing_go_to_left)
+
+    split_info = context.split_infos[feature_idx]
+    _reset_split_info(split_info)
+    best_idx = -1
+    best_gain = float32(-1.)
+    for bin_idx in range(start, start + n_thresholds):
+        if gains[bin_idx] > best_gain:
+            best_gain = gains[bin_idx]
+            best_idx = bin_idx
+    if best_idx >= 0:
+        gradient = gradient_left[best_idx]
+        hessian = hessian_left[best_idx]
+        n_left = n_samples_left[best_idx]
+        if missing_go_to_left[best_idx]:
+            gradient += gradient_missing
+            hessian += hessian_missing
+            n_left += n_samples_missing
+        split_info.gain = best_gain
+        split_info.feature_idx = feature_idx
+        split_info.bin_idx = best_idx - start
+        split_info.gradient_left = gradient
+        split_info.hessian_left = hessian
+        split_info.n_samples_left = n_left
+        split_info.gradient_right = context.sum_gradients - gradient
+        split_info.hessian_right = context.sum_hessians - hessian
+        split_info.n_samples_right = n_samples - n_left
+        split_info.missing_go_to_left = missing_go_to_left[best_idx]
+    if context.support_missing_values and n_samples_missing == 0:
+        # Samples with missing values at prediction time go to the child
+        # that received most of the training samples.
+        split_info.missing_go_to_left = (split_info.n_samples_left >
+                                         split_info.n_samples_right)
+
+
+@njit(error_model='numpy')
+def _threshold_gains(gradient_left, hessian_left, n_samples_left, start,
+                     stop, gradient_missing, hessian_missing,
+                     n_samples_missing, n_samples, sum_gradients,
+                     sum_hessians, l2_regularization, min_hessian_to_split,
+                     min_samples_leaf, min_gain_to_split, gains,
+                     missing_go_to_left):
+    """Compute the gains of the thresholds start to stop, -1 for those that
+    are not valid splits, see _scan_histograms_vectorized
+
+    The parameters of the node are scalars and the loops have no branches
+    so that they are vectorized (error_model='numpy' removes the checks for
+    divisions by zero, which cannot happen anyway). The thresholds are
+    evaluated with the missing values sent to the left child only if there
+    are any.
+    """
+    for bin_idx in range(start, stop):
+        gains[bin_idx] = _masked_split_gain(
+            gradient_left[bin_idx], hessian_left[bin_idx],
+            n_samples_left[bin_idx], n_samples, sum_gradients, sum_hessians,
+            l2_regularization, min_hessian_to_split, min_samples_leaf,
+            min_gain_to_split)
+        missing_go_to_left[bin_idx] = False
+    if n_samples_missing == 0:
+        return
+    for bin_idx in range(start, stop):
+        gain_left = _masked_split_gain(
+            gradient_left[bin_idx] + gradient_missing,
+            hessian_left[bin_idx] + hessian_missing,
+            n_samples_left[bin_idx] + n_samples_missing, n_samples,
+            sum_gradients, sum_hessians, l2_regularization,
+            min_hessian_to_split, min_samples_leaf, min_gain_to_split)
+        go_left = gain_left > gains[bin_idx]
+        gains[bin_idx] = gain_left if go_left else gains[bin_idx]
+        missing_go_to_left[bin_idx] = go_left
+
+
+@njit(error_model='numpy', inline='always')
+def _masked_split_gain(gradient_left, hessian_left, n_samples_left,
+                       n_samples, sum_gradients, sum_hessians,
+                       l2_regularization, min_hessian_to_split,
+                       min_samples_leaf, min_gain_to_split):
+    """Return the gain of a split, or -1 if it does not satisfy the
+    min_samples_leaf, min_hessian_to_split and min_gain_to_split
+    conditions
+
+    The gain is computed whatever the conditions: the hessians of invalid
+    splits are replaced by that of the node, so as not to divide by zero.
+    """
+    hessian_right = sum_hessians - hessian_left
+    is_valid = ((hessian_left >= min_hessian_to_split) &
+                (hessian_right >= min_hessian_to_split) &
+                (n_samples_left >= min_samples_leaf) &
+                (n_samples - n_samples_left >= min_samples_leaf))
+    hessian_left = hessian_left if is_valid else sum_hessians
+    hessian_right = hessian_right if is_valid else sum_hessians
+    gain = _split_gain(gradient_left, hessian_left,
+                       sum_gradients - gradient_left, hessian_right,
+                       sum_gradients, sum_hessians, l2_regularization)
+    is_valid &= gain > min_gain_to_split
+    return gain if is_valid else float32(-1.)
+
+
+@njit(parallel=True)
+def _find_best_feature_to_split_helper(context):
+    """Return the split of context.split_infos with the highest gain (the
+    first one in case of ties), as a SplitInfo
+
+    The argmax is computed in parallel over chunks of features, then over
+    the best splits of the chunks.
+    """
+    split_infos = context.split_infos
+    n_features = split_infos.shape[0]
+    n_chunks = max(1, min(context.n_threads,
+                          n_features // MIN_FEATURES_PER_CHUNK))
+    chunk_size = (n_features + n_chunks - 1) // n_chunks
+    chunk_best_idx = np.empty(n_chunks, dtype=np.int64)
+    for chunk_idx in prange(n_chunks):
+        start = chunk_idx * chunk_size
+        best_idx = start
+        for feature_idx in range(start + 1,
+                                 min(start + chunk_size, n_features)):
+            if split_infos[feature_idx].gain > split_infos[best_idx].gain:
+                best_idx = feature_idx
+        chunk_best_idx[chunk_idx] = best_idx
+
+    best_idx = chunk_best_idx[0]
+    for chunk_idx in range(1, n_chunks):
+        feature_idx = chunk_best_idx[chunk_idx]
+        if split_infos[feature_idx].gain > split_infos[best_idx].gain:
+            best_idx = feature_idx
+    split_info = split_infos[best_idx]
+    return SplitInfo(split_info.gain, split_info.feature_idx,
+                     split_info.bin_idx, split_info.gradient_left,
+                     split_info.hessian_left, split_info.gradient_right,
+                     split_info.hessian_right, split_info.n_samples_left,
+                     split_info.n_samples_right,
+                     split_info.missing_go_to_left, split_info.is_categorical,
+                     split_info.left_cat_bitset.copy())
 
 
 @njit(fastmath=True)
 def _find_histogram_split(context, feature_idx, sample_indices):
-    """Compute the histogram for a given feature and return the best bin."""
-    n_samples = sample_indices.shape[0]
-    binned_feature = context.binned_features.T[feature_idx]
+    """Compute the histogram for a given feature and find its best bin,
+    stored in context.split_infos[feature_idx]."""
+    histogram = _build_column_histogram(context, feature_idx, sample_indices,
+                                        0, sample_indices.shape[0])
+    return _find_best_bin_to_split_helper(context, feature_idx, histogram,
+                                          sample_indices.shape[0])
+
 
-    root_node = binned_feature.shape[0] == n_samples
-    ordered_gradients = context.ordered_gradients[:n_samples]
-    ordered_hessians = context.ordered_hessians[:n_samples]
+@njit(fastmath=True)
+def _build_column_histogram(context, column_idx, sample_indices, start, stop):
+    """Compute the histogram of a column of context.binned_features.
+
+    Only the samples start:stop of sample_indices are counted.
+    """
+    n_bins = context.column_n_bins[column_idx]
+    binned_feature = context.binned_features.T[column_idx]
+
+    root_node = binned_feature.shape[0] == sample_indices.shape[0]
+    offset = context.gradients_offset
+    ordered_gradients = context.ordered_gradients[offset + start:
+                                                  offset + stop]
+    ordered_hessians = context.ordered_hessians[offset + start:
+                                                offset + stop]
 
     if root_node:
         if context.constant_hessian:
             histogram = _build_histogram_root_no_hessian(
-                context.n_bins, binned_feature, ordered_gradients)
+                n_bins, binned_feature[start:stop], ordered_gradients)
         else:
             histogram = _build_histogram_root(
-                context.n_bins, binned_feature, ordered_gradients,
-                context.ordered_hessians)
+                n_bins, binned_feature[start:stop], ordered_gradients,
+                ordered_hessians)
     else:
         if context.constant_hessian:
             histogram = _build_histogram_no_hessian(
-                context.n_bins, sample_indices, binned_feature,
+                n_bins, sample_indices[start:stop], binned_feature,
                 ordered_gradients)
         else:
             histogram = _build_histogram(
-                context.n_bins, sample_indices, binned_feature,
+                n_bins, sample_indices[start:stop], binned_feature,
                 ordered_gradients, ordered_hessians)
 
-    return _find_best_bin_to_split_helper(context, feature_idx, histogram,
-                                          n_samples)
+    return histogram
 
 
 @njit(fastmath=True)
 def _find_histogram_split_subtraction(context, feature_idx,
-                                      parent_histograms, sibling_histograms,
+                                      parent_histogram, sibling_histogram,
                                       n_samples):
     """Compute the histogram by substraction of parent and sibling
 
-    Uses the identity: hist(parent) = hist(left) + hist(right)
+    Uses the identity: hist(parent) = hist(left) + hist(right). The
+    histogram is computed in place in parent_histogram.
     """
-    histogram = _subtract_histograms(
-        context.n_bins, parent_histograms[feature_idx],
-        sibling_histograms[feature_idx])
+    histogram = _subtract_histograms(parent_histogram.count.shape[0],
+                                     parent_histogram, sibling_histogram)
 
     return _find_best_bin_to_split_helper(context, feature_idx, histogram,
                                           n_samples)
 
 
+@njit(fastmath=True)
+def _find_best_bin_to_split_helper(context, feature_idx, histogram, n_samples):
+    """Find best bin to split on and store it in context.split_infos
+
+    When missing values are supported, the histogram is scanned twice: once
+    with the samples of the missing values bin sent to the right child and,
+    if there are any such samples, once with them sent to the left child.
+
+    Returns the histogram.
+    """
+    # Reset the split of the feature. It is left as such (with a negative
+    # gain) if the min_hessian_to_split condition is not satisfied. Such
+    # invalid splits are later discarded by the TreeGrower.
+    best_split = context.split_infos[feature_idx]
+    _reset_split_info(best_split)
+    # Only the actual bins of the feature are scanned, the missing values
+    # being in the last one.
+    n_bins = histogram.count.shape[0]
+
+    if context.is_categorical[feature_idx]:
+        _scan_categorical_histogram(context, feature_idx, histogram,
+                                    n_samples, best_split)
+        return histogram
+
+    if not context.support_missing_values:
+        _scan_histogram(context, feature_idx, histogram, n_samples,
+                        n_bins, 0., 0., 0, False, best_split)
+        return histogram
+
+    missing_bin = min(context.missing_values_bin_idx, n_bins - 1)
+    n_samples_missing = histogram.count[missing_bin]
+    _scan_histogram(context, feature_idx, histogram, n_samples, missing_bin,
+                    0., 0., 0, False, best_split)
+    if n_samples_missing > 0:
+        if context.constant_hessian:
+            hessian_missing = (n_samples_missing *
+                               context.constant_hessian_value)
+        else:
+            hessian_missing = (histogram.sum_hessians[missing_bin] *
+                               context.hessian_scale)
+        _scan_histogram(context, feature_idx, histogram, n_samples,
+                        missing_bin,
+                        (histogram.sum_gradients[missing_bin] *
+                         context.gradient_scale),
+                        hessian_missing, n_samples_missing, True, best_split)
+    else:
+        # Samples with missing values at prediction time go to the child
+        # that received most of the training samples.
+        best_split.missing_go_to_left = (best_split.n_samples_left >
+                                         best_split.n_samples_right)
+    return histogram
+
+
+@njit
+def _reset_split_info(split_info):
+    """Reset a record of context.split_infos to an invalid split"""
+    split_info.gain = -1.
+    split_info.feature_idx = 0
+    split_info.bin_idx = 0
+    split_info.gradient_left = 0.
+    split_info.hessian_left = 0.
+    split_info.gradient_right = 0.
+    split_info.hessian_right = 0.
+    split_info.n_samples_left = 0
+    split_info.n_samples_right = 0
+    split_info.missing_go_to_left = False
+    split_info.is_categorical = False
+    split_info.left_cat_bitset[:] = 0
+
+
 @njit(locals={'gradient_left': float32, 'hessian_left': float32,
               'n_samples_left': uint32},
       fastmath=True)
-def _find_best_bin_to_split_helper(context, feature_idx, histogram, n_samples):
-    """Find best bin to split on and return the corresponding SplitInfo"""
-    # Allocate the structure for the best split information. It can be
-    # returned as such (with a negative gain) if the min_hessian_to_split
-    # condition is not satisfied. Such invalid splits are later discarded by
-    # the TreeGrower.
-    best_split = SplitInfo(-1., 0, 0, 0., 0., 0., 0., 0, 0)
-    gradient_left, hessian_left = 0., 0.
-    n_samples_left = 0
+def _scan_histogram(context, feature_idx, histogram, n_samples, n_bins,
+                    gradient_left, hessian_left, n_samples_left,
+                    missing_go_to_left, best_split):
+    """Scan the first n_bins bins of histogram and update best_split
 
-    for bin_idx in range(context.n_bins):
-        n_samples_left += histogram[bin_idx]['count']
+    gradient_left, hessian_left and n_samples_left are the statistics of the
+    samples that are sent to the left child whatever the bin threshold.
+    """
+    for bin_idx in range(n_bins):
+        n_samples_left += histogram.count[bin_idx]
         n_samples_right = n_samples - n_samples_left
+        if context.constant_hessian:
+            hessian_left += (histogram.count[bin_idx]
+                             * context.constant_hessian_value)
+        else:
+            hessian_left += (histogram.sum_hessians[bin_idx] *
+                             context.hessian_scale)
+        gradient_left += (histogram.sum_gradients[bin_idx] *
+                          context.gradient_scale)
+
         if context.min_samples_leaf is not None:
             if n_samples_left < context.min_samples_leaf:
                 continue
@@ -407,11 +1254,6 @@ def _find_best_bin_to_split_helper(context, feature_idx, histogram, n_samples):
                 # won't get any better
                 break
 
-        if context.constant_hessian:
-            hessian_left += (histogram[bin_idx]['count']
-                             * context.constant_hessian_value)
-        else:
-            hessian_left += histogram[bin_idx]['sum_hessians']
         if hessian_left < context.min_hessian_to_split:
             continue
         hessian_right = context.sum_hessians - hessian_left
@@ -419,7 +1261,6 @@ def _find_best_bin_to_split_helper(context, feature_idx, histogram, n_samples):
             # won't get any better
             break
 
-        gradient_left += histogram[bin_idx]['sum_gradients']
         gradient_right = context.sum_gradients - gradient_left
         gain = _split_gain(gradient_left, hessian_left,
                            gradient_right, hessian_right,
@@ -436,8 +1277,92 @@ def _find_best_bin_to_split_helper(context, feature_idx, histogram, n_samples):
             best_split.gradient_right = gradient_right
             best_split.hessian_right = hessian_right
             best_split.n_samples_right = n_samples_right
+            best_split.missing_go_to_left = missing_go_to_left
+
+
+@njit(locals={'gradient_left': float32, 'hessian_left': float32,
+              'n_samples_left': uint32},
+      fastmath=True)
+def _scan_categorical_histogram(context, feature_idx, histogram, n_samples,
+                                best_split):
+    """Find the best many-vs-many split of a categorical feature
+
+    The categories are sorted by increasing ratio of their gradient and
+    hessian sums, and the best split is searched among the partitions of
+    this ordering into a left prefix and a right suffix (Fisher, 1958). The
+    missing values bin, if any, is considered as another category.
+    """
+    n_bins = histogram.count.shape[0]
+    n_categories = 0
+    categories = np.empty(n_bins, dtype=np.uint32)
+    ratios = np.empty(n_bins, dtype=np.float32)
+    for bin_idx in range(n_bins):
+        count = histogram.count[bin_idx]
+        if count == 0:
+            continue
+        if context.constant_hessian:
+            hessian = count * context.constant_hessian_value
+        else:
+            hessian = histogram.sum_hessians[bin_idx] * context.hessian_scale
+        categories[n_categories] = bin_idx
+        ratios[n_categories] = (histogram.sum_gradients[bin_idx] *
+                                context.gradient_scale /
+                                (hessian + context.l2_regularization))
+        n_categories += 1
+    sorted_categories = categories[:n_categories][
+        np.argsort(ratios[:n_categories])]
+
+    gradient_left, hessian_left = 0., 0.
+    n_samples_left = 0
+    best_n_left_categories = 0
+    for i in range(n_categories - 1):
+        bin_idx = sorted_categories[i]
+        n_samples_left += histogram.count[bin_idx]
+        n_samples_right = n_samples - n_samples_left
+        if context.constant_hessian:
+            hessian_left += (histogram.count[bin_idx]
+                             * context.constant_hessian_value)
+        else:
+            hessian_left += (histogram.sum_hessians[bin_idx] *
+                             context.hessian_scale)
+        gradient_left += (histogram.sum_gradients[bin_idx] *
+                          context.gradient_scale)
+
+        if context.min_samples_leaf is not None:
+            if n_samples_left < context.min_samples_leaf:
+                continue
+            if n_samples_right < context.min_samples_leaf:
+                break
+        if hessian_left < context.min_hessian_to_split:
+            continue
+        hessian_right = context.sum_hessians - hessian_left
+        if hessian_right < context.min_hessian_to_split:
+            break
 
-    return best_split, histogram
+        gradient_right = context.sum_gradients - gradient_left
+        gain = _split_gain(gradient_left, hessian_left,
+                           gradient_right, hessian_right,
+                           context.sum_gradients, context.sum_hessians,
+                           context.l2_regularization)
+        if gain > best_split.gain and gain > context.min_gain_to_split:
+            best_split.gain = gain
+            best_split.feature_idx = feature_idx
+            best_split.gradient_left = gradient_left
+            best_split.hessian_left = hessian_left
+            best_split.n_samples_left = n_samples_left
+            best_split.gradient_right = gradient_right
+            best_split.hessian_right = hessian_right
+            best_split.n_samples_right = n_samples_right
+            best_n_left_categories = i + 1
+
+    best_split.is_categorical = True
+    missing_bin = min(context.missing_values_bin_idx, n_bins - 1)
+    for i in range(best_n_left_categories):
+        bin_idx = sorted_categories[i]
+        if context.support_missing_values and bin_idx == missing_bin:
+            best_split.missing_go_to_left = True
+        else:
+            set_bitset(best_split.left_cat_bitset, bin_idx)
 
 
 @njit(fastmath=False)
@@ -1,8 +1,11 @@
 import numpy as np
 from numpy.testing import assert_array_equal, assert_allclose
 import pytest
+from scipy import sparse
 
 from pygbm.binning import BinMapper, find_binning_thresholds, map_to_bins
+from pygbm.binning import QuantileSketch, find_feature_bundles
+from pygbm.binning import find_packed_columns, decode_bin
 
 
 DATA = np.random.RandomState(42).normal(
@@ -60,7 +63,24 @@ def test_find_binning_thresholds_low_n_bins():
 
 def test_find_binning_thresholds_invalid_n_bins():
     with pytest.raises(ValueError):
-        find_binning_thresholds(DATA, max_bins=1024)
+        find_binning_thresholds(DATA, max_bins=65537)
+
+
+@pytest.mark.parametrize('max_bins', [5, 255])
+def test_find_binning_thresholds_parallel(max_bins):
+    # Processing the features with a pool of threads does not change the
+    # thresholds.
+    rng = np.random.RandomState(42)
+    data = rng.normal(size=(1000, 12)).astype(np.float32)
+    data[:, :4] = rng.randint(0, 7, size=(1000, 4))
+
+    sequential = find_binning_thresholds(data, max_bins=max_bins,
+                                         n_threads=1)
+    parallel = find_binning_thresholds(data, max_bins=max_bins, n_threads=4)
+    assert len(sequential) == len(parallel) == data.shape[1]
+    for thresholds_seq, thresholds_par in zip(sequential, parallel):
+        assert thresholds_par.dtype == thresholds_seq.dtype
+        assert_array_equal(thresholds_seq, thresholds_par)
 
 
 @pytest.mark.parametrize('n_bins', [16, 128, 256])
@@ -81,6 +101,38 @@ def test_map_to_bins(n_bins):
         assert binned[max_idx, feature_idx] == n_bins - 1
 
 
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_map_to_bins_memory_layouts(dtype):
+    # The row-block kernel used on C-contiguous data and the column-wise
+    # kernel give the same results.
+    rng = np.random.RandomState(42)
+    data = rng.normal(size=(5000, 7)).astype(dtype)
+    data[:, 2] = rng.randint(0, 3, size=data.shape[0])
+    data[:, 3] = 1.
+    bin_thresholds = find_binning_thresholds(data, max_bins=128,
+                                             random_state=0)
+    assert bin_thresholds[3].shape == (0,)
+
+    binned_c = map_to_bins(np.ascontiguousarray(data), bin_thresholds)
+    binned_f = map_to_bins(np.asfortranarray(data), bin_thresholds)
+    assert binned_c.flags.f_contiguous
+    assert_array_equal(binned_c, binned_f)
+    assert_array_equal(binned_c[:, 2], data[:, 2])
+    assert_array_equal(binned_c[:, 3], 0)
+
+
+def test_map_to_bins_memmap_chunks(tmpdir):
+    # Binning chunks of rows into a Fortran-ordered memory-mapped output
+    # gives the same result as binning the whole data at once.
+    mapper = BinMapper(max_bins=42, random_state=0).fit(DATA)
+    out = np.memmap(str(tmpdir.join('binned.mmap')), dtype=np.uint8,
+                    mode='w+', shape=DATA.shape, order='F')
+    for start in range(0, DATA.shape[0], 300000):
+        stop = start + 300000
+        mapper.transform(DATA[start:stop], out=out[start:stop])
+    assert_array_equal(out, mapper.transform(DATA))
+
+
 @pytest.mark.parametrize("n_bins", [5, 10, 42])
 def test_bin_mapper_random_data(n_bins):
     n_samples, n_features = DATA.shape
@@ -190,3 +242,293 @@ def test_bin_mapper_idempotence(n_bins_small, n_bins_large):
     binned_small = mapper_small.fit_transform(data)
     binned_large = mapper_large.fit_transform(binned_small)
     assert_array_equal(binned_small, binned_large)
+
+
+def test_bin_mapper_partial_fit_exact():
+    # As long as the sketch is not compacted, partial_fit gives the same
+    # thresholds as fit.
+    data = DATA[:1000]
+    mapper = BinMapper(max_bins=42, sketch_size=2048)
+    for chunk in np.array_split(data, 7):
+        mapper.partial_fit(chunk)
+    expected = BinMapper(max_bins=42).fit(data)
+    for thresholds, expected_thresholds in zip(mapper.bin_thresholds_,
+                                               expected.bin_thresholds_):
+        assert thresholds.dtype == expected_thresholds.dtype
+        assert_array_equal(thresholds, expected_thresholds)
+
+
+def test_bin_mapper_partial_fit_lazy_thresholds():
+    # The thresholds are computed from the sketch when first needed, and
+    # again after the next chunk.
+    data = DATA[:1000]
+    mapper = BinMapper(max_bins=42).partial_fit(data[:500])
+    assert 'bin_thresholds_' not in vars(mapper)
+    binned = mapper.transform(data[:500])
+    assert 'bin_thresholds_' in vars(mapper)
+    assert_array_equal(binned, BinMapper(max_bins=42).fit_transform(
+        data[:500]))
+    mapper.partial_fit(data[500:])
+    assert 'bin_thresholds_' not in vars(mapper)
+    assert mapper.n_columns_ == data.shape[1]
+    assert_array_equal(mapper.transform(data),
+                       BinMapper(max_bins=42).fit_transform(data))
+
+    with pytest.raises(ValueError, match='partial_fit'):
+        BinMapper().merge(mapper)
+    with pytest.raises(ValueError, match='partial_fit'):
+        mapper.merge(BinMapper().fit(data))
+
+
+@pytest.mark.parametrize('n_workers', [1, 3])
+def test_bin_mapper_partial_fit_merge(n_workers):
+    n_bins = 10
+    mappers = [BinMapper(max_bins=n_bins, sketch_size=256, random_state=seed)
+               for seed in range(n_workers)]
+    chunks = np.array_split(DATA, 40)
+    for chunk_idx, chunk in enumerate(chunks):
+        mappers[chunk_idx % n_workers].partial_fit(chunk)
+    mapper = mappers[0]
+    for other in mappers[1:]:
+        mapper.merge(other)
+
+    assert mapper.sketch_.n_samples == DATA.shape[0]
+    n_items = sum(items.shape[0] for items in mapper.sketch_.levels)
+    assert n_items < 10 * 256
+
+    # The streamed bins are approximately balanced.
+    binned = mapper.transform(DATA)
+    for feature_idx in range(DATA.shape[1]):
+        counts = np.bincount(binned[:, feature_idx], minlength=n_bins)
+        assert_allclose(counts / DATA.shape[0], 1 / n_bins, atol=1e-2)
+
+
+def test_quantile_sketch_distinct_values():
+    # Distinct values survive the compactions and are used as midpoints.
+    rng = np.random.RandomState(0)
+    data = rng.randint(0, 5, size=(100000, 2))
+    sketch = QuantileSketch(2, sketch_size=128, random_state=0)
+    for chunk in np.array_split(data, 10):
+        sketch.update(chunk)
+    assert len(sketch.levels) > 1
+    for thresholds in sketch.binning_thresholds(max_bins=255):
+        assert_allclose(thresholds, [.5, 1.5, 2.5, 3.5])
+
+    with pytest.raises(ValueError):
+        sketch.update(data[:, :1])
+    with pytest.raises(ValueError):
+        sketch.merge(QuantileSketch(3))
+
+
+@pytest.mark.parametrize('order', ['C', 'F'])
+def test_map_to_bins_missing_values(order):
+    data = np.array([[1, np.nan],
+                     [np.nan, 2],
+                     [3, 3],
+                     [2, np.nan]], dtype=np.float32, order=order)
+    mapper = BinMapper(max_bins=42).fit(data)
+    assert mapper.missing_values_bin_idx_ == 42
+    assert_allclose(mapper.bin_thresholds_[0], [1.5, 2.5])
+    assert_allclose(mapper.bin_thresholds_[1], [2.5])
+
+    binned = mapper.transform(data)
+    assert_array_equal(binned, [[0, 42],
+                                [42, 0],
+                                [2, 1],
+                                [1, 42]])
+
+
+def test_bin_mapper_missing_values_too_many_bins():
+    data = np.array([[1.], [np.nan]])
+    with pytest.raises(ValueError, match='missing values bin'):
+        BinMapper(max_bins=256).fit(data)
+    mapper = BinMapper(max_bins=256).fit(data[:1])
+    # Missing values seen at transform time have no bin either.
+    with pytest.raises(ValueError, match='missing values bin'):
+        mapper.transform(data)
+    with pytest.raises(ValueError, match='missing values bin'):
+        mapper.transform(sparse.csr_matrix(data))
+
+
+def test_bin_mapper_categorical_features():
+    rng = np.random.RandomState(0)
+    X = np.c_[rng.randint(0, 10, size=1000), rng.normal(size=1000)]
+    X[::7, 0] = np.nan
+    mapper = BinMapper(max_bins=32, categorical_features=[0]).fit(X)
+    assert_array_equal(mapper.is_categorical_, [True, False])
+    X_binned = mapper.transform(X)
+    is_missing = np.isnan(X[:, 0])
+    # Each category is mapped to its own bin, even unobserved ones.
+    assert_array_equal(X_binned[~is_missing, 0], X[~is_missing, 0])
+    assert np.all(X_binned[is_missing, 0] == mapper.missing_values_bin_idx_)
+    assert_array_equal(mapper.transform(np.array([[25., 0.]]))[:, 0], [25])
+    # Unknown categories are mapped to the missing values bin.
+    X_unknown = np.array([[-1., 0.], [32., 0.], [2.5, 0.]])
+    assert np.all(mapper.transform(X_unknown)[:, 0] ==
+                  mapper.missing_values_bin_idx_)
+    assert_array_equal(
+        mapper.transform(sparse.csc_matrix(X_unknown)).toarray()[:, 0],
+        mapper.missing_values_bin_idx_)
+
+    for invalid in (-1., 32., 2.5):
+        X_invalid = X.copy()
+        X_invalid[0, 0] = invalid
+        with pytest.raises(ValueError, match='should be encoded as integers'):
+            BinMapper(max_bins=32, categorical_features=[0]).fit(X_invalid)
+
+
+@pytest.mark.parametrize('max_bins', [16, 255])
+def test_bin_mapper_sparse_data(max_bins):
+    # Sparse data is binned like its dense counterpart: the implicit zeros
+    # fall into the zero bin of their feature.
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(1000, 5))
+    X[rng.binomial(1, .9, size=X.shape).astype(bool)] = 0
+    X[0, 0] = np.nan
+    X_sparse = sparse.csr_matrix(X)
+
+    mapper_dense = BinMapper(max_bins=max_bins, random_state=0).fit(X)
+    mapper_sparse = BinMapper(max_bins=max_bins,
+                              random_state=0).fit(X_sparse.tocsc())
+    for bt_dense, bt_sparse in zip(mapper_dense.bin_thresholds_,
+                                   mapper_sparse.bin_thresholds_):
+        assert_allclose(bt_dense, bt_sparse)
+
+    X_binned = mapper_sparse.transform(X_sparse)
+    assert sparse.isspmatrix_csr(X_binned)
+    assert X_binned.nnz == X_sparse.nnz
+    X_binned_dense = np.tile(mapper_sparse.zero_bins_, (X.shape[0], 1))
+    X_binned_dense[X != 0] = X_binned.toarray()[X != 0]
+    assert_array_equal(X_binned_dense, mapper_dense.transform(X))
+
+
+def test_bin_mapper_bundle_features():
+    # One-hot encoded columns are mutually exclusive and are packed into a
+    # single bundle. The column with missing values and the dense column
+    # are left alone.
+    rng = np.random.RandomState(0)
+    n_samples = 1000
+    categories = rng.randint(0, 5, size=n_samples)
+    one_hot = np.eye(5)[categories] * rng.randint(1, 4, size=(n_samples, 1))
+    dense = rng.normal(size=n_samples)
+    with_missing = np.where(categories == 0, np.nan, 0.)
+    X = np.c_[one_hot, dense, with_missing]
+
+    mapper = BinMapper(max_bins=32, bundle_features=True,
+                       random_state=0).fit(X)
+    assert len(mapper.columns_) == 3
+    assert_array_equal(mapper.columns_[0], [0, 1, 2, 3, 4])
+    assert_array_equal(mapper.columns_[1], [5])
+    assert_array_equal(mapper.columns_[2], [6])
+    assert not mapper.is_packed_column_.any()
+    assert mapper.n_columns_ == 3
+
+    X_binned = mapper.transform(X)
+    assert X_binned.shape == (n_samples, 3)
+    assert X_binned.flags.f_contiguous
+    # Unpacking the bundles gives back the binned features.
+    X_binned_unbundled = BinMapper(max_bins=32,
+                                   random_state=0).fit_transform(X)
+    assert_array_equal(mapper.unpack(X_binned), X_binned_unbundled)
+
+    # Sparse data is packed into the same dense bundles.
+    X_sparse = sparse.csr_matrix(np.nan_to_num(X))
+    mapper_sparse = BinMapper(max_bins=32, bundle_features=True,
+                              random_state=0).fit(X_sparse)
+    assert len(mapper_sparse.columns_) == 2
+    assert_array_equal(mapper_sparse.transform(X_sparse)[:, 0],
+                       X_binned[:, 0])
+
+    with pytest.raises(ValueError, match='partial_fit'):
+        BinMapper(bundle_features=True).partial_fit(X)
+
+
+def test_find_feature_bundles_max_bins():
+    # Bundles cannot hold more than max_bins values.
+    binned = np.eye(6, dtype=np.uint8) * 3
+    zero_bins = np.zeros(6, dtype=np.uint8)
+    n_bins = np.full(6, 4)
+    candidates = np.ones(6, dtype=bool)
+    bundles = find_feature_bundles(binned, zero_bins, n_bins, candidates,
+                                   max_bins=9)
+    assert [list(bundle) for bundle in bundles] == [[0, 1], [2, 3], [4, 5]]
+    candidates[0] = False
+    bundles = find_feature_bundles(binned, zero_bins, n_bins, candidates,
+                                   max_bins=9)
+    assert [list(bundle) for bundle in bundles] == [[0], [1, 2], [3, 4], [5]]
+
+
+def test_bin_mapper_uint16():
+    # More than 256 bins are coded as uint16, uint8 stays the default.
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(10000, 2))
+    X[::10, 1] = np.nan
+    assert BinMapper().fit(X).binned_dtype_ == np.uint8
+
+    mapper = BinMapper(max_bins=1024, random_state=0).fit(X)
+    assert mapper.binned_dtype_ == np.uint16
+    assert len(mapper.bin_thresholds_[0]) == 1023
+    X_binned = mapper.transform(X)
+    assert X_binned.dtype == np.uint16
+    assert X_binned[:, 0].max() == 1023
+    assert np.all(X_binned[::10, 1] == 1024)
+    counts = np.bincount(X_binned[:, 0])
+    assert_allclose(counts / X.shape[0], 1 / 1024, atol=1e-3)
+
+    X_binned_sparse = mapper.transform(sparse.csr_matrix(X))
+    assert X_binned_sparse.dtype == np.uint16
+    assert_array_equal(X_binned_sparse.toarray(), X_binned)
+
+    with pytest.raises(ValueError, match='missing values bin'):
+        BinMapper(max_bins=65536).fit(X)
+    with pytest.raises(ValueError, match='categorical features'):
+        BinMapper(max_bins=1024, categorical_features=[0]).fit(X)
+
+
+def test_find_packed_columns():
+    # The single-feature columns with at most 15 bins are paired, bundles
+    # are left alone.
+    columns = [np.array([0]), np.array([1, 2]), np.array([3]), np.array([4]),
+               np.array([5])]
+    n_bins = np.array([15, 3, 3, 256, 2, 16])
+    columns, is_packed = find_packed_columns(columns, n_bins)
+    assert ([list(column) for column in columns] ==
+            [[0, 4], [1, 2], [3], [5]])
+    assert_array_equal(is_packed, [True, False, False, False])
+
+
+@pytest.mark.parametrize('n_features', [3, 4])
+def test_bin_mapper_pack_features(n_features):
+    # Features with few distinct values are 4-bit packed two by two, and
+    # their bins (including the missing values bin) are decoded back.
+    rng = np.random.RandomState(0)
+    n_samples = 1000
+    X = rng.randint(0, 10, size=(n_samples, n_features)).astype(np.float64)
+    X[rng.uniform(size=X.shape) < .1] = np.nan
+    X = np.c_[X, rng.normal(size=n_samples)]
+
+    mapper = BinMapper(pack_features=True, random_state=0).fit(X)
+    n_packed_columns = (n_features + 1) // 2
+    assert mapper.n_columns_ == n_packed_columns + 1
+    assert_array_equal(mapper.is_packed_column_[:n_packed_columns], True)
+    assert not mapper.is_packed_column_[-1]
+    X_binned = mapper.transform(X)
+    assert X_binned.shape == (n_samples, mapper.n_columns_)
+    assert X_binned.dtype == np.uint8
+
+    X_binned_unpacked = BinMapper(random_state=0).fit_transform(X)
+    assert_array_equal(mapper.unpack(X_binned), X_binned_unpacked)
+    for feature_idx in range(X.shape[1]):
+        column_idx = mapper.feature_layout_[feature_idx]['column']
+        for sample_idx in range(0, n_samples, 97):
+            value = X_binned[sample_idx, column_idx]
+            assert (decode_bin(mapper.feature_layout_, feature_idx, value) ==
+                    X_binned_unpacked[sample_idx, feature_idx])
+
+    # The packing only depends on the number of bins: partial_fit supports
+    # it as well.
+    mapper_partial = BinMapper(pack_features=True).partial_fit(X)
+    assert mapper_partial.n_columns_ == mapper.n_columns_
+    # There is no packing for uint16 binned data.
+    mapper_uint16 = BinMapper(max_bins=1000, pack_features=True).fit(X)
+    assert mapper_uint16.feature_layout_ is None
@@ -0,0 +1,67 @@
+import numpy as np
+from numpy.testing import assert_array_equal, assert_allclose
+import pytest
+from sklearn.datasets import make_regression
+
+from pygbm import GradientBoostingMachine
+from pygbm.dataset import BinnedDataset
+
+
+X, y = make_regression(n_samples=1000, n_features=5, random_state=0)
+
+
+@pytest.mark.parametrize('with_targets', [True, False])
+def test_save_load(tmpdir, with_targets):
+    dataset = BinnedDataset.from_data(X, y if with_targets else None)
+    folder = str(tmpdir.join('dataset'))
+    dataset.save(folder)
+
+    loaded = BinnedDataset.load(folder)
+    assert isinstance(loaded.X_binned, np.memmap)
+    assert loaded.X_binned.flags.f_contiguous
+    assert loaded.X_binned.dtype == np.uint8
+    assert_array_equal(loaded.X_binned, dataset.X_binned)
+    if with_targets:
+        assert_array_equal(loaded.y, dataset.y)
+    else:
+        assert loaded.y is None
+    for thresholds, expected in zip(loaded.bin_mapper.bin_thresholds_,
+                                    dataset.bin_mapper.bin_thresholds_):
+        assert_array_equal(thresholds, expected)
+
+    loaded = BinnedDataset.load(folder, mmap_mode=None)
+    assert not isinstance(loaded.X_binned, np.memmap)
+
+
+def test_inconsistent_lengths():
+    dataset = BinnedDataset.from_data(X)
+    with pytest.raises(ValueError):
+        BinnedDataset(dataset.X_binned, y[:-1], dataset.bin_mapper)
+
+
+@pytest.mark.parametrize('validation_split', [None, .1])
+def test_fit_predict_binned_dataset(tmpdir, validation_split):
+    # Fitting on a (memory-mapped) BinnedDataset gives the same model as
+    # fitting on the numerical data.
+    # The validation split is stratified: the targets should be classes.
+    y_classes = (y > 0).astype(np.float32)
+    folder = str(tmpdir.join('dataset'))
+    BinnedDataset.from_data(X, y_classes).save(folder)
+    dataset = BinnedDataset.load(folder)
+
+    params = dict(max_iter=10, validation_split=validation_split,
+                  scoring=None, random_state=0)
+    est = GradientBoostingMachine(**params).fit(X, y_classes)
+    est_binned = GradientBoostingMachine(**params).fit(dataset)
+    assert est_binned.bin_mapper_ is dataset.bin_mapper
+
+    assert_allclose(est_binned.predict(X), est.predict(X), rtol=1e-5)
+    assert_allclose(est_binned.predict(dataset), est.predict(X), rtol=1e-5)
+
+
+def test_fit_binned_dataset_without_targets():
+    dataset = BinnedDataset.from_data(X)
+    with pytest.raises(ValueError, match='no targets'):
+        GradientBoostingMachine(max_iter=2).fit(dataset)
+    GradientBoostingMachine(max_iter=2, scoring=None,
+                            validation_split=None).fit(dataset, y)
@@ -0,0 +1,209 @@
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+import pytest
+from scipy import sparse
+from sklearn.datasets import make_regression
+
+from pygbm import GradientBoostingMachine
+
+
+X, y = make_regression(n_samples=2000, n_features=5, random_state=0)
+# validation_split stratifies on the target: use a discrete target.
+y = np.clip(np.round(y / 50), -5, 5)
+
+
+@pytest.mark.parametrize('validation_split', [None, 0.1])
+def test_mmap_folder(tmpdir, validation_split):
+    # Training from memory-mapped binned data gives the same model as
+    # training from in-memory binned data.
+    params = dict(max_iter=10, validation_split=validation_split,
+                  scoring=None, random_state=0)
+    est_mmap = GradientBoostingMachine(mmap_folder=str(tmpdir), **params)
+    est_mmap.fit(np.asarray(X, dtype=np.float32), y)
+    est = GradientBoostingMachine(**params)
+    est.fit(np.asarray(X, dtype=np.float32), y)
+
+    assert est_mmap.n_iter_ == est.n_iter_
+    assert_allclose(est_mmap.predict(X), est.predict(X), rtol=1e-4,
+                    atol=1e-3)
+
+
+def test_missing_values():
+    # The target depends on whether the first feature is missing: no
+    # imputation is required to learn it.
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(2000, 3))
+    is_missing = rng.binomial(1, .2, size=X.shape[0]).astype(bool)
+    X[is_missing, 0] = np.nan
+    y = np.where(is_missing, 10, X[:, 0])
+    y = np.round(y)
+
+    est = GradientBoostingMachine(max_iter=20, scoring=None,
+                                  validation_split=None, random_state=0)
+    est.fit(X, y)
+    predictions = est.predict(X)
+    assert_allclose(predictions[is_missing], 10, atol=.5)
+    assert_allclose(predictions,
+                    est._predict_binned(est.bin_mapper_.transform(X)),
+                    rtol=1e-5)
+
+
+def test_categorical_features():
+    # The target only depends on whether the category is in a scattered set
+    # of categories: a single categorical split is enough to learn it.
+    rng = np.random.RandomState(0)
+    n_samples = 2000
+    X = np.c_[rng.randint(0, 30, size=n_samples),
+              rng.normal(size=n_samples)].astype(np.float64)
+    X[rng.binomial(1, .05, size=n_samples).astype(bool), 0] = np.nan
+    y = np.isin(X[:, 0], [2, 3, 7, 13, 17, 23, 29]) * 10.
+
+    est = GradientBoostingMachine(max_iter=1, max_leaf_nodes=2,
+                                  scoring=None, validation_split=None,
+                                  categorical_features=[0], random_state=0)
+    est.fit(X, y)
+    assert_allclose(est.predict(X), y, atol=1e-5)
+    assert_allclose(est.predict(X),
+                    est._predict_binned(est.bin_mapper_.transform(X)),
+                    rtol=1e-5)
+    # Unobserved categories in [0, max_bins) have their own bin and go to
+    # the right child, like in the binned predictor.
+    X_unobserved = np.array([[30., 0.], [254., 0.]])
+    nodes = est.predictors_[0].nodes
+    right_child_value = nodes[nodes[0]['right']]['value']
+    assert_allclose(est.predict(X_unobserved), right_child_value)
+    assert_allclose(
+        est._predict_binned(est.bin_mapper_.transform(X_unobserved)),
+        right_child_value, rtol=1e-5)
+    # Unknown categories are treated as missing values by both predictors.
+    X_unknown = np.array([[255., 0.], [300., 0.], [-1., 0.], [2.5, 0.]])
+    X_missing = np.full_like(X_unknown, np.nan)
+    assert_allclose(est.predict(X_unknown), est.predict(X_missing))
+    assert_allclose(est._predict_binned(est.bin_mapper_.transform(X_unknown)),
+                    est.predict(X_missing), rtol=1e-5)
+
+
+@pytest.mark.parametrize('format', ['csr', 'csc'])
+def test_sparse_data(format):
+    # Training on sparse data gives the same model as training on the
+    # densified data, and sparse data can be predicted without binning.
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(2000, 10))
+    X[rng.binomial(1, .9, size=X.shape).astype(bool)] = 0
+    y = np.round(X[:, 0] - 2 * X[:, 1] + 3 * (X[:, 2] != 0))
+    X_sparse = sparse.csr_matrix(X).asformat(format)
+
+    params = dict(max_iter=10, scoring=None, validation_split=None,
+                  random_state=0)
+    est_sparse = GradientBoostingMachine(**params).fit(X_sparse, y)
+    est_dense = GradientBoostingMachine(**params).fit(X, y)
+    assert_allclose(est_sparse.predict(X_sparse), est_dense.predict(X),
+                    rtol=1e-4, atol=1e-3)
+    assert_allclose(est_sparse.predict(X_sparse), est_sparse.predict(X),
+                    rtol=1e-5)
+    assert_allclose(
+        est_sparse.predict(X_sparse),
+        est_sparse._predict_binned(est_sparse.bin_mapper_.transform(X_sparse)),
+        rtol=1e-5)
+
+
+def test_bundle_features():
+    # Bundling exclusive features gives the same model as training on the
+    # original features, and the predictor splits on the original features.
+    rng = np.random.RandomState(0)
+    n_samples = 2000
+    categories = rng.randint(0, 8, size=n_samples)
+    X_one_hot = np.eye(8)[categories] * rng.randint(1, 5, size=(n_samples, 1))
+    X = np.c_[X_one_hot, rng.normal(size=n_samples)]
+    y = np.round(categories + X_one_hot.sum(axis=1) + X[:, -1])
+
+    params = dict(max_iter=5, scoring=None, validation_split=None,
+                  random_state=0)
+    est_bundled = GradientBoostingMachine(bundle_features=True, **params)
+    est_bundled.fit(X, y)
+    assert len(est_bundled.bin_mapper_.columns_) == 2
+    est = GradientBoostingMachine(**params).fit(X, y)
+    assert_allclose(est_bundled.predict(X), est.predict(X), rtol=1e-5)
+    assert_allclose(
+        est_bundled.predict(X),
+        est_bundled._predict_binned(est_bundled.bin_mapper_.transform(X)),
+        rtol=1e-5)
+    for predictor, predictor_bundled in zip(est.predictors_,
+                                            est_bundled.predictors_):
+        assert_allclose(predictor.nodes['feature_idx'],
+                        predictor_bundled.nodes['feature_idx'])
+
+
+def test_pack_features():
+    # 4-bit packing of the low-cardinality features gives the same model as
+    # training on the original features.
+    rng = np.random.RandomState(0)
+    n_samples = 2000
+    X = rng.randint(0, 12, size=(n_samples, 3)).astype(np.float64)
+    X[rng.uniform(size=X.shape) < .05] = np.nan
+    X = np.c_[X, rng.normal(size=n_samples)]
+    y = np.nan_to_num(X[:, 0]) - np.nan_to_num(X[:, 1]) * X[:, 3]
+
+    params = dict(max_iter=5, scoring=None, validation_split=None,
+                  random_state=0)
+    est_packed = GradientBoostingMachine(pack_features=True, **params)
+    est_packed.fit(X, y)
+    assert_array_equal(est_packed.bin_mapper_.is_packed_column_,
+                       [True, True, False])
+    est = GradientBoostingMachine(**params).fit(X, y)
+    assert_allclose(est_packed.predict(X), est.predict(X), rtol=1e-5,
+                    atol=1e-4)
+    assert_allclose(
+        est_packed.predict(X),
+        est_packed._predict_binned(est_packed.bin_mapper_.transform(X)),
+        rtol=1e-5)
+    for predictor, predictor_packed in zip(est.predictors_,
+                                           est_packed.predictors_):
+        assert_allclose(predictor.nodes['feature_idx'],
+                        predictor_packed.nodes['feature_idx'])
+
+
+def test_max_bins_uint16():
+    # Fitting with more than 256 bins uses uint16 binned data.
+    rng = np.random.RandomState(0)
+    X = rng.uniform(size=(5000, 2))
+    X[::20, 1] = np.nan
+    y = np.round(X[:, 0] * 1000) % 2 + np.nan_to_num(X[:, 1])
+
+    params = dict(max_iter=5, max_leaf_nodes=63, min_samples_leaf=1,
+                  scoring=None, validation_split=None, random_state=0)
+    est = GradientBoostingMachine(max_bins=1024, **params).fit(X, y)
+    assert est.bin_mapper_.binned_dtype_ == np.uint16
+    X_binned = est.bin_mapper_.transform(X)
+    assert_allclose(est.predict(X), est._predict_binned(X_binned),
+                    rtol=1e-5)
+    assert est.predictors_[0].nodes['bin_threshold'].max() > 255
+    est_small = GradientBoostingMachine(max_bins=255, **params).fit(X, y)
+    assert (np.mean((est.predict(X) - y) ** 2) <
+            np.mean((est_small.predict(X) - y) ** 2))
+
+
+@pytest.mark.parametrize('quantized_gradients', [8, 16])
+@pytest.mark.parametrize('data', ['dense', 'sparse', 'bundled', 'uint16'])
+def test_quantized_gradients(quantized_gradients, data):
+    # Training on stochastically rounded gradients gives about the same
+    # training error as training on the exact gradients.
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(2000, 5))
+    X[rng.binomial(1, .5, size=X.shape).astype(bool)] = 0
+    y = np.round(X[:, 0] - 2 * X[:, 1] + 3 * (X[:, 2] != 0))
+    params = dict(max_iter=10, scoring=None, validation_split=None,
+                  random_state=0)
+    if data == 'sparse':
+        X = sparse.csr_matrix(X)
+    elif data == 'bundled':
+        params['bundle_features'] = True
+    elif data == 'uint16':
+        params['max_bins'] = 1024
+
+    est = GradientBoostingMachine(**params).fit(X, y)
+    est_quantized = GradientBoostingMachine(
+        quantized_gradients=quantized_gradients, **params).fit(X, y)
+    mse = np.mean((est.predict(X) - y) ** 2)
+    mse_quantized = np.mean((est_quantized.predict(X) - y) ** 2)
+    assert mse_quantized < 1.1 * mse
@@ -1,10 +1,11 @@
 import numpy as np
 
 from numpy.testing import assert_array_almost_equal
+from numpy.testing import assert_array_equal
 import pytest
 from pytest import approx
 
-from pygbm.grower import TreeGrower
+from pygbm.grower import TreeGrower, HistogramPool
 from pygbm.binning import BinMapper
 
 
@@ -229,3 +230,187 @@ def test_min_samples_leaf(n_samples, min_samples_leaf, n_bins,
         assert predictor.nodes.shape[0] == 1
         assert predictor.nodes[0]['is_leaf']
         assert predictor.nodes[0]['count'] == n_samples
+
+
+@pytest.mark.parametrize('histogram_method', ['col_wise', 'row_wise'])
+def test_histogram_method(histogram_method):
+    # Both histogram building methods grow the expected tree.
+    features_data, all_gradients, all_hessians = _make_training_data()
+    grower = TreeGrower(features_data, all_gradients, all_hessians,
+                        max_leaf_nodes=3, histogram_method=histogram_method)
+    grower.grow()
+    predictor = grower.make_predictor()
+    assert_array_almost_equal(predictor.predict_binned(features_data),
+                              all_gradients, decimal=5)
+
+    with pytest.raises(ValueError, match='histogram_method should be one'):
+        TreeGrower(features_data, all_gradients, all_hessians,
+                   histogram_method='columns')
+
+
+@pytest.mark.parametrize('scan_method', ['loop', 'vectorized'])
+def test_scan_method(scan_method):
+    # Both histogram scans grow the expected tree.
+    features_data, all_gradients, all_hessians = _make_training_data()
+    grower = TreeGrower(features_data, all_gradients, all_hessians,
+                        max_leaf_nodes=3, scan_method=scan_method)
+    grower.grow()
+    predictor = grower.make_predictor()
+    assert_array_almost_equal(predictor.predict_binned(features_data),
+                              all_gradients, decimal=5)
+
+    with pytest.raises(ValueError, match='scan_method should be one'):
+        TreeGrower(features_data, all_gradients, all_hessians,
+                   scan_method='simd')
+
+
+def test_histogram_pool():
+    # The least recently used histograms are evicted to stay within the
+    # budget, the histograms that were just added are kept.
+    histograms = (np.zeros(100, dtype=np.uint8),)  # 100 bytes
+    pool = HistogramPool(max_bytes=250)
+    pool.put('a', histograms)
+    pool.put('b', histograms)
+    assert pool.get('a') is histograms  # 'b' is now the least recently used
+    pool.put('c', histograms)
+    assert pool.get('b') is None
+    assert pool.get('a') is histograms
+    assert pool.get('c') is histograms
+    assert (pool.n_hits, pool.n_misses, pool.n_evictions) == (3, 1, 1)
+    assert pool.n_bytes == 200
+    assert pool.max_n_bytes == 300
+
+    pool.release('a')
+    pool.release('b')  # already evicted
+    assert pool.get('a') is None
+    assert pool.n_bytes == 100
+
+    pool = HistogramPool(max_bytes=50)
+    pool.put('a', histograms)
+    assert pool.get('a') is histograms
+
+
+@pytest.mark.parametrize('histogram_pool_size', [None, 0.02])
+def test_grower_histogram_pool(histogram_pool_size):
+    # Evicting histograms from the pool does not change the tree: the
+    # histograms of the children of their node are built from the data.
+    # Once the tree is grown, all the histograms are released.
+    rng = np.random.RandomState(0)
+    n_samples, n_features, n_bins = 10000, 5, 256
+    features_data = np.asfortranarray(
+        rng.randint(0, n_bins, size=(n_samples, n_features), dtype=np.uint8))
+    all_gradients = rng.randn(n_samples).astype(np.float32)
+    all_hessians = np.ones(1, dtype=np.float32)
+
+    reference = TreeGrower(features_data, all_gradients, all_hessians,
+                           max_leaf_nodes=30, n_bins=n_bins)
+    reference.grow()
+    grower = TreeGrower(features_data, all_gradients, all_hessians,
+                        max_leaf_nodes=30, n_bins=n_bins,
+                        histogram_pool_size=histogram_pool_size)
+    grower.grow()
+    assert_array_almost_equal(
+        grower.make_predictor().predict_binned(features_data),
+        reference.make_predictor().predict_binned(features_data), decimal=5)
+
+    pool = grower.histogram_pool
+    assert pool.n_bytes == 0
+    assert pool.n_hits > 0
+    node_nbytes = n_features * n_bins * 12
+    if histogram_pool_size is None:
+        assert pool.n_misses == pool.n_evictions == 0
+    else:
+        # Only one node's histograms fit along with the histograms that
+        # were just added.
+        assert pool.n_misses > 0
+        assert pool.n_evictions > 0
+        assert pool.max_n_bytes <= 20000 + node_nbytes
+        assert pool.max_n_bytes < reference.histogram_pool.max_n_bytes
+
+
+@pytest.mark.parametrize('constant_hessian', [True, False])
+def test_grower_partition_gradients(constant_hessian):
+    # Keeping the gradients in partition order does not change the tree.
+    features_data, all_gradients, all_hessians = _make_training_data(
+        n_bins=256, constant_hessian=constant_hessian)
+    predictions = []
+    for partition_gradients in (False, True):
+        grower = TreeGrower(features_data, all_gradients, all_hessians,
+                            max_leaf_nodes=20, min_samples_leaf=10,
+                            n_bins=256,
+                            partition_gradients=partition_gradients)
+        grower.grow()
+        predictions.append(
+            grower.make_predictor().predict_binned(features_data))
+    context = grower.splitting_context
+    assert_array_almost_equal(context.ordered_gradients,
+                              all_gradients[context.partition])
+    assert_array_almost_equal(*predictions, decimal=5)
+
+
+@pytest.mark.parametrize('constant_hessian', [True, False])
+@pytest.mark.parametrize('quantized_gradients', [8, 16])
+def test_grower_quantized_gradients(quantized_gradients, constant_hessian):
+    # The tree grown on the quantized gradients recovers the same decision
+    # function, and its leaf values are computed from the exact gradients.
+    features_data, all_gradients, all_hessians = _make_training_data(
+        n_bins=256, constant_hessian=constant_hessian)
+    grower = TreeGrower(features_data, all_gradients, all_hessians,
+                        max_leaf_nodes=3, n_bins=256,
+                        quantized_gradients=quantized_gradients,
+                        random_state=0)
+    grower.grow()
+
+    context = grower.splitting_context
+    assert context.all_gradients.dtype == np.dtype(
+        f'int{quantized_gradients}')
+    assert grower.root.split_info.feature_idx == 0
+    for leaf in grower.finalized_leaves:
+        if constant_hessian:
+            expected_hessian = all_hessians[0] * leaf.n_samples
+        else:
+            expected_hessian = all_hessians[leaf.sample_indices].sum()
+        expected_value = (all_gradients[leaf.sample_indices].sum() /
+                          expected_hessian)
+        assert leaf.value == approx(expected_value, rel=1e-5)
+
+
+def test_grower_quantized_gradients_bad_value():
+    features_data, all_gradients, all_hessians = _make_training_data()
+    with pytest.raises(ValueError, match='quantized_gradients should be'):
+        TreeGrower(features_data, all_gradients, all_hessians,
+                   quantized_gradients=32)
+
+
+@pytest.mark.parametrize('constant_hessian', [True, False])
+@pytest.mark.parametrize('partition_gradients', [False, True])
+def test_grower_compact_node_size(constant_hessian, partition_gradients):
+    # Copying the rows of the small nodes into compact blocks does not
+    # change the tree, and the leaves still hold the indices of their
+    # samples.
+    features_data, all_gradients, all_hessians = _make_training_data(
+        n_bins=256, constant_hessian=constant_hessian)
+    growers = []
+    for compact_node_size in (None, 3000):
+        grower = TreeGrower(features_data, all_gradients, all_hessians,
+                            max_leaf_nodes=20, min_samples_leaf=10,
+                            n_bins=256,
+                            partition_gradients=partition_gradients,
+                            compact_node_size=compact_node_size)
+        grower.grow()
+        growers.append(grower)
+    reference, grower = growers
+    assert_array_almost_equal(
+        grower.make_predictor().predict_binned(features_data),
+        reference.make_predictor().predict_binned(features_data), decimal=5)
+    assert reference.total_compact_nbytes == 0
+    assert grower.total_compact_nbytes > 0
+    assert grower.total_compact_time > 0
+    leaves_samples = np.concatenate(
+        [leaf.sample_indices for leaf in grower.finalized_leaves])
+    assert_array_equal(np.sort(leaves_samples),
+                       np.arange(features_data.shape[0]))
+    for leaf in grower.finalized_leaves:
+        assert leaf.value == approx(
+            all_gradients[leaf.sample_indices].sum() /
+            leaf.sum_hessians, rel=1e-4)
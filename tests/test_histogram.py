@@ -8,6 +8,10 @@ from pygbm.histogram import _build_histogram_no_hessian
 from pygbm.histogram import _build_histogram_root_no_hessian
 from pygbm.histogram import _build_histogram_root
 from pygbm.histogram import _subtract_histograms
+from pygbm.histogram import _build_histograms_row_wise
+from pygbm.histogram import _zero_histogram
+from pygbm.histogram import _zero_histograms
+from pygbm.histogram import Histograms
 
 
 @pytest.mark.parametrize(
@@ -22,9 +26,9 @@ def test_build_histogram(build_func):
     sample_indices = np.array([0, 2, 3], dtype=np.uint32)
     hist = build_func(3, sample_indices, binned_feature,
                       ordered_gradients, ordered_hessians)
-    assert_array_equal(hist['count'], [2, 1, 0])
-    assert_allclose(hist['sum_gradients'], [1, 3, 0])
-    assert_allclose(hist['sum_hessians'], [2, 2, 0])
+    assert_array_equal(hist.count, [2, 1, 0])
+    assert_allclose(hist.sum_gradients, [1, 3, 0])
+    assert_allclose(hist.sum_hessians, [2, 2, 0])
 
     # Larger sample_indices (above unrolling threshold)
     sample_indices = np.array([0, 2, 3, 6, 7], dtype=np.uint32)
@@ -33,9 +37,9 @@ def test_build_histogram(build_func):
 
     hist = build_func(3, sample_indices, binned_feature,
                       ordered_gradients, ordered_hessians)
-    assert_array_equal(hist['count'], [2, 2, 1])
-    assert_allclose(hist['sum_gradients'], [1, 4, 0])
-    assert_allclose(hist['sum_hessians'], [2, 2, 1])
+    assert_array_equal(hist.count, [2, 2, 1])
+    assert_allclose(hist.sum_gradients, [1, 4, 0])
+    assert_allclose(hist.sum_hessians, [2, 2, 1])
 
 
 def test_histogram_sample_order_independence():
@@ -64,12 +68,12 @@ def test_histogram_sample_order_independence():
         n_bins, sample_indices[permutation], binned_feature,
         ordered_gradients[permutation], ordered_hessians[permutation])
 
-    assert_allclose(hist_gc['sum_gradients'], hist_gc_perm['sum_gradients'])
-    assert_array_equal(hist_gc['count'], hist_gc_perm['count'])
+    assert_allclose(hist_gc.sum_gradients, hist_gc_perm.sum_gradients)
+    assert_array_equal(hist_gc.count, hist_gc_perm.count)
 
-    assert_allclose(hist_ghc['sum_gradients'], hist_ghc_perm['sum_gradients'])
-    assert_allclose(hist_ghc['sum_hessians'], hist_ghc_perm['sum_hessians'])
-    assert_array_equal(hist_ghc['count'], hist_ghc_perm['count'])
+    assert_allclose(hist_ghc.sum_gradients, hist_ghc_perm.sum_gradients)
+    assert_allclose(hist_ghc.sum_hessians, hist_ghc_perm.sum_hessians)
+    assert_array_equal(hist_ghc.count, hist_ghc_perm.count)
 
 
 @pytest.mark.parametrize("constant_hessian", [True, False])
@@ -100,12 +104,12 @@ def test_unrolled_equivalent_to_naive(constant_hessian):
                                         ordered_gradients, ordered_hessians)
 
     for hist in (hist_gc_root, hist_ghc_root, hist_gc, hist_gc, hist_ghc):
-        assert_array_equal(hist['count'], hist_naive['count'])
-        assert_allclose(hist['sum_gradients'], hist_naive['sum_gradients'])
+        assert_array_equal(hist.count, hist_naive.count)
+        assert_allclose(hist.sum_gradients, hist_naive.sum_gradients)
     for hist in (hist_ghc_root, hist_ghc):
-        assert_allclose(hist['sum_hessians'], hist_naive['sum_hessians'])
+        assert_allclose(hist.sum_hessians, hist_naive.sum_hessians)
     for hist in (hist_gc_root, hist_gc):
-        assert_array_equal(hist['sum_hessians'], np.zeros(n_bins))
+        assert_array_equal(hist.sum_hessians, np.zeros(n_bins))
 
 
 @pytest.mark.parametrize("constant_hessian", [True, False])
@@ -157,9 +161,61 @@ def test_hist_subtraction(constant_hessian):
                                       binned_feature, ordered_gradients_right,
                                       ordered_hessians_right)
 
-    hist_left_sub = _subtract_histograms(n_bins, hist_parent, hist_right)
+    # The subtraction is done in place, in a copy of the parent histogram
+    hist_parent_copy = Histograms(*(a.copy() for a in hist_parent))
+    hist_left_sub = _subtract_histograms(n_bins, hist_parent_copy,
+                                         hist_right)
+    assert hist_left_sub.count is hist_parent_copy.count
     hist_right_sub = _subtract_histograms(n_bins, hist_parent, hist_left)
 
     for key in ('count', 'sum_hessians', 'sum_gradients'):
-        assert_allclose(hist_left[key], hist_left_sub[key], rtol=1e-6)
-        assert_allclose(hist_right[key], hist_right_sub[key], rtol=1e-6)
+        assert_allclose(getattr(hist_left, key), getattr(hist_left_sub, key),
+                        rtol=1e-6)
+        assert_allclose(getattr(hist_right, key),
+                        getattr(hist_right_sub, key), rtol=1e-6)
+
+
+@pytest.mark.parametrize("n_threads", [1, 3])
+@pytest.mark.parametrize("constant_hessian", [True, False])
+def test_build_histograms_row_wise(n_threads, constant_hessian):
+    # The row-wise kernel builds the same histograms as the column-wise
+    # ones, whatever the number of threads sharing the samples.
+    rng = np.random.RandomState(42)
+    n_samples = 1000
+    n_sub_samples = 301
+    n_columns = 4
+    n_bins = 16
+    binned_features = np.asfortranarray(
+        rng.randint(0, n_bins, size=(n_samples, n_columns), dtype=np.uint8))
+    sample_indices = rng.choice(np.arange(n_samples, dtype=np.uint32),
+                                n_sub_samples, replace=False)
+    ordered_gradients = rng.randn(n_sub_samples).astype(np.float32)
+    ordered_hessians = rng.lognormal(size=n_sub_samples).astype(np.float32)
+
+    # The columns have different numbers of bins: the larger bins of a
+    # column are counted into its last one.
+    column_n_bins = np.array([n_bins, 3, n_bins - 1, 1])
+    offsets = np.concatenate([[0], np.cumsum(column_n_bins)])
+    histograms = _zero_histograms(offsets)
+    buffers = _zero_histogram(n_threads * offsets[-1])
+    buffers = tuple(buffer.reshape(n_threads, offsets[-1])
+                    for buffer in buffers)
+    _build_histograms_row_wise(n_threads, sample_indices, binned_features,
+                               ordered_gradients, ordered_hessians,
+                               constant_hessian, offsets, histograms,
+                               buffers)
+
+    for column_idx in range(n_columns):
+        hist_naive = _build_histogram_naive(
+            column_n_bins[column_idx], sample_indices,
+            binned_features[:, column_idx], ordered_gradients,
+            ordered_hessians)
+        start, stop = offsets[column_idx:column_idx + 2]
+        assert_array_equal(histograms.count[start:stop], hist_naive.count)
+        assert_allclose(histograms.sum_gradients[start:stop],
+                        hist_naive.sum_gradients, rtol=1e-5, atol=1e-6)
+        if constant_hessian:
+            assert_array_equal(histograms.sum_hessians[start:stop], 0)
+        else:
+            assert_allclose(histograms.sum_hessians[start:stop],
+                            hist_naive.sum_hessians, rtol=1e-5)
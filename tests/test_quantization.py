@@ -0,0 +1,40 @@
+import numpy as np
+from numpy.testing import assert_array_equal
+import pytest
+
+from pygbm.quantization import quantize, MAX_HISTOGRAM_SUM
+
+
+@pytest.mark.parametrize('n_bits', [8, 16])
+def test_quantize(n_bits):
+    rng = np.random.RandomState(0)
+    values = rng.randn(10000).astype(np.float32)
+    quantized, scale = quantize(values, n_bits, rng)
+
+    assert quantized.dtype == np.dtype(f'int{n_bits}')
+    n_levels = np.abs(quantized).max()
+    assert n_levels == 2 ** (n_bits - 1) - 1
+    # Each value is rounded down or up to a multiple of the scale.
+    assert np.all(np.abs(quantized * scale - values) <= scale * (1 + 1e-5))
+    # The rounding is unbiased: the errors average out in the sums.
+    error = quantized.astype(np.float64).sum() * scale - values.sum()
+    assert abs(error) < 5 * scale * np.sqrt(values.shape[0])
+
+
+def test_quantize_histogram_sums_fit_int32():
+    # With many samples, the integers are bounded so that the sums of the
+    # int32 histograms cannot overflow.
+    rng = np.random.RandomState(0)
+    values = np.full(1000000, -2., dtype=np.float32)
+    quantized, scale = quantize(values, 16, rng)
+    n_levels = MAX_HISTOGRAM_SUM // values.shape[0]
+    assert quantized.min() == -n_levels
+    assert abs(quantized.astype(np.int64).sum()) <= MAX_HISTOGRAM_SUM
+    assert n_levels * scale == pytest.approx(2.)
+
+
+def test_quantize_zeros():
+    rng = np.random.RandomState(0)
+    quantized, scale = quantize(np.zeros(10, dtype=np.float32), 8, rng)
+    assert_array_equal(quantized, 0)
+    assert scale == 1.
@@ -1,12 +1,21 @@
 import numpy as np
+from numpy.testing import assert_allclose
 from numpy.testing import assert_almost_equal
 from numpy.testing import assert_array_almost_equal
+from numpy.testing import assert_array_equal
 import pytest
 
 from pygbm.splitting import _find_histogram_split
+from pygbm.splitting import _find_best_feature_to_split_helper
 from pygbm.splitting import (SplittingContext, find_node_split,
                              find_node_split_subtraction,
-                             split_indices)
+                             split_indices, HISTOGRAM_COL_WISE,
+                             HISTOGRAM_ROW_WISE, SCAN_LOOP, SCAN_VECTORIZED)
+from pygbm.histogram import Histograms
+
+
+def _copy(histograms):
+    return Histograms(*(array.copy() for array in histograms))
 
 
 @pytest.mark.parametrize('n_bins', [3, 32, 256])
@@ -38,8 +47,8 @@ def test_histogram_split(n_bins):
                                        min_hessian_to_split,
                                        min_samples_leaf, min_gain_to_split)
 
-            split_info, _ = _find_histogram_split(context, feature_idx,
-                                                  sample_indices)
+            _find_histogram_split(context, feature_idx, sample_indices)
+            split_info = context.split_infos.view(np.recarray)[feature_idx]
 
             assert split_info.bin_idx == true_bin
             assert split_info.gain >= 0
@@ -90,20 +99,21 @@ def test_split_vs_split_subtraction(constant_hessian):
     si_left, hists_left = find_node_split(context, sample_indices_left)
     si_right, hists_right = find_node_split(context, sample_indices_right)
 
-    # split left with subtraction method
+    # split left with subtraction method, in a copy of the parent histograms
+    # since they are overwritten
     si_left_sub, hists_left_sub = find_node_split_subtraction(
-        context, sample_indices_left, hists_parent, hists_right)
+        context, sample_indices_left, _copy(hists_parent), hists_right)
 
     # split right with subtraction method
     si_right_sub, hists_right_sub = find_node_split_subtraction(
-        context, sample_indices_right, hists_parent, hists_left)
+        context, sample_indices_right, _copy(hists_parent), hists_left)
 
     # make sure histograms from classical and subtraction method are the same
     for hists, hists_sub in ((hists_left, hists_left_sub),
                              (hists_right, hists_right_sub)):
-        for hist, hist_sub in zip(hists, hists_sub):
-            for key in ('count', 'sum_hessians', 'sum_gradients'):
-                assert_array_almost_equal(hist[key], hist_sub[key], decimal=4)
+        for key in ('count', 'sum_hessians', 'sum_gradients'):
+            assert_array_almost_equal(getattr(hists, key),
+                                      getattr(hists_sub, key), decimal=4)
 
     # make sure split_infos from classical and subtraction method are the same
     for si, si_sub in ((si_left, si_left_sub), (si_right, si_right_sub)):
@@ -167,13 +177,14 @@ def test_gradient_and_hessian_sanity(constant_hessian):
     si_left, hists_left = find_node_split(context, sample_indices_left)
     si_right, hists_right = find_node_split(context, sample_indices_right)
 
-    # split left with subtraction method
+    # split left with subtraction method, in a copy of the parent histograms
+    # since they are overwritten
     si_left_sub, hists_left_sub = find_node_split_subtraction(
-        context, sample_indices_left, hists_parent, hists_right)
+        context, sample_indices_left, _copy(hists_parent), hists_right)
 
     # split right with subtraction method
     si_right_sub, hists_right_sub = find_node_split_subtraction(
-        context, sample_indices_right, hists_parent, hists_left)
+        context, sample_indices_right, _copy(hists_parent), hists_left)
 
     # make sure that si.gradient_left + si.gradient_right have their expected
     # value, same for hessians
@@ -205,9 +216,10 @@ def test_gradient_and_hessian_sanity(constant_hessian):
         # note: gradients and hessians have shape (n_features,),
         # we're comparing them to *scalars*. This has the benefit of also
         # making sure that all the entries are equal.
-        gradients = hists['sum_gradients'].sum(axis=1)  # shape = (n_features,)
+        starts = context.column_offsets[:-1]
+        gradients = np.add.reduceat(hists.sum_gradients, starts)
         expected_gradient = all_gradients[indices].sum()  # scalar
-        hessians = hists['sum_hessians'].sum(axis=1)
+        hessians = np.add.reduceat(hists.sum_hessians, starts)
         if constant_hessian:
             # 0 is not the actual hessian, but it's not computed in this case
             expected_hessian = 0.
@@ -277,6 +289,51 @@ def test_split_indices():
     assert samples_right.shape[0] == si_root.n_samples_right
 
 
+@pytest.mark.parametrize('constant_hessian', [True, False])
+def test_partition_gradients(constant_hessian):
+    # With partition_gradients, split_indices permutes the gradients and
+    # hessians along with the partition, and find_node_split finds the same
+    # splits from them as from the gathered gradients.
+    rng = np.random.RandomState(0)
+    n_bins, n_features, n_samples = 32, 3, 1000
+    binned_features = np.asfortranarray(
+        rng.randint(0, n_bins, size=(n_samples, n_features), dtype=np.uint8))
+    all_gradients = rng.randn(n_samples).astype(np.float32)
+    if constant_hessian:
+        all_hessians = np.ones(1, dtype=np.float32)
+    else:
+        all_hessians = rng.lognormal(size=n_samples).astype(np.float32)
+
+    contexts = [
+        SplittingContext(n_features, binned_features, n_bins, all_gradients,
+                         all_hessians, 0., 1e-3, 1, 0.,
+                         partition_gradients=partition_gradients)
+        for partition_gradients in (False, True)]
+    for context in contexts:
+        split_info, _ = find_node_split(context, context.partition.view())
+        left, right = split_indices(context, split_info,
+                                    context.partition.view())
+        # split the right child, then find the split of its right child
+        split_info, _ = find_node_split(context, right, left.shape[0])
+        split_indices(context, split_info, right, left.shape[0])
+    reference, context = contexts
+    assert_array_equal(context.partition, reference.partition)
+    assert_array_equal(context.ordered_gradients,
+                       all_gradients[context.partition])
+    if not constant_hessian:
+        assert_array_equal(context.ordered_hessians,
+                           all_hessians[context.partition])
+
+    start = left.shape[0] + split_info.n_samples_left
+    sample_indices = context.partition[start:]
+    split_infos = [find_node_split(reference, sample_indices)[0],
+                   find_node_split(context, sample_indices, start)[0]]
+    for attr in ('feature_idx', 'bin_idx', 'gain', 'gradient_left',
+                 'hessian_left', 'n_samples_left'):
+        assert (getattr(split_infos[0], attr) ==
+                pytest.approx(getattr(split_infos[1], attr), rel=1e-5))
+
+
 def test_min_gain_to_split():
     # Try to split a pure node (all gradients are equal, same for hessians)
     # with min_gain_to_split = 0 and make sure that the node is not split (best
@@ -304,5 +361,308 @@ def test_min_gain_to_split():
                                min_hessian_to_split,
                                min_samples_leaf, min_gain_to_split)
 
-    split_info, _ = _find_histogram_split(context, feature_idx, sample_indices)
+    _find_histogram_split(context, feature_idx, sample_indices)
+    split_info = context.split_infos.view(np.recarray)[feature_idx]
     assert split_info.gain == -1
+
+
+@pytest.mark.parametrize('constant_hessian', [True, False])
+@pytest.mark.parametrize('missing_go_to_left', [True, False])
+def test_split_missing_values(constant_hessian, missing_go_to_left):
+    # The samples of the missing values bin have the same target as the
+    # samples of either the first bins or the last bins: the split finder
+    # must send them to the corresponding child.
+    rng = np.random.RandomState(42)
+    n_bins = 10
+    missing_values_bin_idx = n_bins - 1
+    n_samples = 1000
+    l2_regularization = 0.
+    min_hessian_to_split = 1e-3
+    min_samples_leaf = 1
+    min_gain_to_split = 0.
+
+    binned_features = rng.randint(0, n_bins, size=(n_samples, 2),
+                                  dtype=np.uint8)
+    binned_features = np.asfortranarray(binned_features)
+    binned_feature = binned_features[:, 0]
+    is_missing = binned_feature == missing_values_bin_idx
+    all_gradients = np.where(binned_feature <= 3, -1, 1).astype(np.float32)
+    all_gradients[is_missing] = -1 if missing_go_to_left else 1
+    if constant_hessian:
+        all_hessians = np.ones(1, dtype=np.float32)
+    else:
+        all_hessians = np.ones(n_samples, dtype=np.float32)
+    sample_indices = np.arange(n_samples, dtype=np.uint32)
+
+    context = SplittingContext(2, binned_features, n_bins,
+                               all_gradients, all_hessians,
+                               l2_regularization, min_hessian_to_split,
+                               min_samples_leaf, min_gain_to_split,
+                               missing_values_bin_idx)
+    split_info, _ = find_node_split(context, sample_indices)
+    assert split_info.feature_idx == 0
+    assert split_info.bin_idx == 3
+    assert split_info.missing_go_to_left == missing_go_to_left
+
+    samples_left, samples_right = split_indices(context, split_info,
+                                                context.partition.view())
+    assert samples_left.shape[0] == split_info.n_samples_left
+    assert np.all(all_gradients[samples_left] == -1)
+    assert np.all(all_gradients[samples_right] == 1)
+    assert set(np.flatnonzero(is_missing)) <= set(
+        samples_left if missing_go_to_left else samples_right)
+
+
+@pytest.mark.parametrize('constant_hessian', [True, False])
+def test_n_bins_per_feature(constant_hessian):
+    # With n_bins_per_feature, the histogram of each feature only has its
+    # actual bins and the missing values bin: the splits are the same as
+    # with histograms of n_bins bins.
+    rng = np.random.RandomState(42)
+    n_bins = 256
+    missing_values_bin_idx = n_bins - 1
+    n_samples = 1000
+    n_bins_non_missing = np.array([3, 10, 50, 255], dtype=np.uint32)
+    n_features = n_bins_non_missing.shape[0]
+
+    binned_features = np.asfortranarray(np.stack(
+        [rng.randint(0, n, size=n_samples) for n in n_bins_non_missing],
+        axis=1).astype(np.uint8))
+    binned_features[rng.rand(n_samples) < .1, 1] = missing_values_bin_idx
+    all_gradients = (binned_features[:, 1] % 3 +
+                     rng.randn(n_samples)).astype(np.float32)
+    if constant_hessian:
+        all_hessians = np.ones(1, dtype=np.float32)
+    else:
+        all_hessians = rng.lognormal(size=n_samples).astype(np.float32)
+    sample_indices = np.arange(n_samples, dtype=np.uint32)
+    sample_indices_left = sample_indices[rng.rand(n_samples) < .3]
+    sample_indices_right = np.setdiff1d(sample_indices, sample_indices_left)
+
+    results = []
+    for n_bins_per_feature in (None, n_bins_non_missing + 1):
+        context = SplittingContext(
+            n_features, binned_features, n_bins, all_gradients,
+            all_hessians, 0., 1e-3, 1, 0., missing_values_bin_idx,
+            n_bins_per_feature=n_bins_per_feature)
+        si_parent, hists_parent = find_node_split(context, sample_indices)
+        si_left, hists_left = find_node_split(context, sample_indices_left)
+        si_right, _ = find_node_split_subtraction(
+            context, sample_indices_right, hists_parent, hists_left)
+        results.append((si_parent, si_left, si_right))
+
+    expected_offsets = np.concatenate([[0],
+                                       np.cumsum(n_bins_non_missing + 1)])
+    assert_array_equal(context.column_offsets, expected_offsets)
+    assert hists_left.count.shape == (expected_offsets[-1],)
+    for si, si_per_feature in zip(*results):
+        assert si_per_feature.feature_idx == si.feature_idx
+        assert si_per_feature.bin_idx == si.bin_idx
+        assert si_per_feature.missing_go_to_left == si.missing_go_to_left
+        assert si_per_feature.n_samples_left == si.n_samples_left
+        assert_almost_equal(si_per_feature.gain, si.gain, decimal=4)
+
+
+@pytest.mark.parametrize('n_threads', [1, 3])
+def test_best_feature_to_split(n_threads):
+    # The best split is the first one with the highest gain, whatever the
+    # number of chunks of features of the parallel argmax.
+    rng = np.random.RandomState(42)
+    n_features = 300
+    binned_features = np.zeros((10, n_features), dtype=np.uint8, order='F')
+    all_gradients = np.zeros(10, dtype=np.float32)
+    all_hessians = np.ones(1, dtype=np.float32)
+    context = SplittingContext(n_features, binned_features, 2,
+                               all_gradients, all_hessians, 0.)
+    context.n_threads = n_threads
+    gains = rng.randint(0, 50, n_features).astype(np.float32)
+    split_infos = context.split_infos
+    split_infos['gain'] = gains
+    split_infos['feature_idx'] = np.arange(n_features)
+    split_infos['left_cat_bitset'][:, 0] = np.arange(n_features)
+
+    split_info = _find_best_feature_to_split_helper(context)
+    assert split_info.feature_idx == np.argmax(gains)
+    assert split_info.gain == gains.max()
+    # The returned split does not share the memory of the context.
+    split_infos['left_cat_bitset'][:] = 0
+    assert split_info.left_cat_bitset[0] == np.argmax(gains)
+
+
+@pytest.mark.parametrize('constant_hessian', [True, False])
+@pytest.mark.parametrize('min_samples_leaf', [None, 100])
+def test_vectorized_scan(constant_hessian, min_samples_leaf):
+    # The vectorized scan of the histograms of all the features finds the
+    # same best split of each feature as the per-feature loop, with missing
+    # values and categorical features.
+    rng = np.random.RandomState(42)
+    n_bins = 64
+    missing_values_bin_idx = n_bins - 1
+    n_samples = 2000
+    n_features = 6
+    n_bins_per_feature = np.array([3, 10, 64, 20, 64, 5], dtype=np.uint32)
+    binned_features = np.asfortranarray(np.stack(
+        [rng.randint(0, n - 1, size=n_samples) for n in n_bins_per_feature],
+        axis=1).astype(np.uint8))
+    binned_features[rng.rand(n_samples) < .1, 1] = missing_values_bin_idx
+    binned_features[rng.rand(n_samples) < .2, 2] = missing_values_bin_idx
+    is_categorical = np.array([0, 0, 0, 1, 0, 0], dtype=np.uint8)
+    all_gradients = (binned_features[:, 1] % 4 + binned_features[:, 3] % 3 +
+                     rng.randn(n_samples)).astype(np.float32)
+    if constant_hessian:
+        all_hessians = np.ones(1, dtype=np.float32)
+    else:
+        all_hessians = rng.lognormal(size=n_samples).astype(np.float32)
+    sample_indices = np.arange(n_samples, dtype=np.uint32)
+    sample_indices_left = sample_indices[rng.rand(n_samples) < .3]
+    sample_indices_right = np.setdiff1d(sample_indices, sample_indices_left)
+
+    results = []
+    for scan_method in (SCAN_LOOP, SCAN_VECTORIZED):
+        context = SplittingContext(
+            n_features, binned_features, n_bins, all_gradients,
+            all_hessians, 0., 1e-3, min_samples_leaf, 0.,
+            missing_values_bin_idx, is_categorical,
+            n_bins_per_feature=n_bins_per_feature, scan_method=scan_method)
+        split_infos = []
+        _, hists_parent = find_node_split(context, sample_indices)
+        split_infos.append(context.split_infos.copy())
+        _, hists_left = find_node_split(context, sample_indices_left)
+        split_infos.append(context.split_infos.copy())
+        find_node_split_subtraction(context, sample_indices_right,
+                                    hists_parent, hists_left)
+        split_infos.append(context.split_infos.copy())
+        results.append(split_infos)
+
+    for split_infos_loop, split_infos_vectorized in zip(*results):
+        assert np.any(split_infos_loop['gain'] > 0)
+        for name in split_infos_loop.dtype.names:
+            if name in ('gain', 'gradient_left', 'hessian_left',
+                        'gradient_right', 'hessian_right'):
+                assert_allclose(split_infos_vectorized[name],
+                                split_infos_loop[name], rtol=1e-4, atol=1e-4)
+            else:
+                assert_array_equal(split_infos_vectorized[name],
+                                   split_infos_loop[name])
+
+
+def test_split_categorical():
+    # The categories of the left child are scattered among the bins: a
+    # numerical split cannot isolate them in one go but a categorical split
+    # does.
+    rng = np.random.RandomState(42)
+    n_bins = 16
+    n_samples = 1000
+    l2_regularization = 0.
+    min_hessian_to_split = 1e-3
+    min_samples_leaf = 1
+    min_gain_to_split = 0.
+    left_categories = [1, 4, 6, 11, 14]
+
+    binned_features = rng.randint(0, n_bins, size=(n_samples, 2),
+                                  dtype=np.uint8)
+    binned_features = np.asfortranarray(binned_features)
+    goes_left = np.isin(binned_features[:, 0], left_categories)
+    all_gradients = np.where(goes_left, -1, 1).astype(np.float32)
+    all_hessians = np.ones(1, dtype=np.float32)
+    sample_indices = np.arange(n_samples, dtype=np.uint32)
+    is_categorical = np.array([1, 0], dtype=np.uint8)
+
+    context = SplittingContext(2, binned_features, n_bins,
+                               all_gradients, all_hessians,
+                               l2_regularization, min_hessian_to_split,
+                               min_samples_leaf, min_gain_to_split,
+                               None, is_categorical)
+    split_info, _ = find_node_split(context, sample_indices)
+    assert split_info.feature_idx == 0
+    assert split_info.is_categorical
+    assert split_info.n_samples_left == goes_left.sum()
+
+    samples_left, samples_right = split_indices(context, split_info,
+                                                context.partition.view())
+    assert_array_equal(np.sort(samples_left), np.flatnonzero(goes_left))
+    assert_array_equal(np.sort(samples_right), np.flatnonzero(~goes_left))
+
+
+@pytest.mark.parametrize('constant_hessian', [True, False])
+def test_row_wise_vs_col_wise(constant_hessian):
+    # Building the histograms of a node row-wise or column-wise gives the
+    # same histograms and the same split.
+    rng = np.random.RandomState(42)
+    n_bins = 10
+    n_features = 20
+    n_samples = 500
+
+    binned_features = np.asfortranarray(
+        rng.randint(0, n_bins, size=(n_samples, n_features), dtype=np.uint8))
+    all_gradients = rng.randn(n_samples).astype(np.float32)
+    if constant_hessian:
+        all_hessians = np.ones(1, dtype=np.float32)
+    else:
+        all_hessians = rng.lognormal(size=n_samples).astype(np.float32)
+    sample_indices = np.flatnonzero(rng.binomial(1, .3, size=n_samples))
+    sample_indices = sample_indices.astype(np.uint32)
+
+    results = []
+    for histogram_method in (HISTOGRAM_COL_WISE, HISTOGRAM_ROW_WISE):
+        context = SplittingContext(n_features, binned_features, n_bins,
+                                   all_gradients, all_hessians, 0., 1e-3,
+                                   None, 0., None, None, None, None,
+                                   histogram_method)
+        results.append(find_node_split(context, sample_indices))
+    (si_col, hists_col), (si_row, hists_row) = results
+
+    for key in ('count', 'sum_hessians', 'sum_gradients'):
+        assert_array_almost_equal(getattr(hists_col, key),
+                                  getattr(hists_row, key), decimal=4)
+    assert si_col.feature_idx == si_row.feature_idx
+    assert si_col.bin_idx == si_row.bin_idx
+    assert_almost_equal(si_col.gain, si_row.gain, decimal=3)
+
+
+@pytest.mark.parametrize('histogram_method',
+                         [HISTOGRAM_COL_WISE, HISTOGRAM_ROW_WISE])
+@pytest.mark.parametrize('root', [True, False])
+def test_sample_parallel_histograms(histogram_method, root):
+    # With fewer features than threads, the histograms are built in
+    # parallel over chunks of samples (column-wise) or over the samples
+    # (row-wise) into per-thread partial histograms: they must sum up to the
+    # histograms built by a single thread.
+    rng = np.random.RandomState(42)
+    n_bins = 10
+    n_features = 2
+    n_samples = 10000
+    n_threads = 8
+
+    binned_features = np.asfortranarray(
+        rng.randint(0, n_bins, size=(n_samples, n_features), dtype=np.uint8))
+    all_gradients = rng.randn(n_samples).astype(np.float32)
+    all_hessians = rng.lognormal(size=n_samples).astype(np.float32)
+    sample_indices = np.arange(n_samples, dtype=np.uint32)
+    if not root:
+        sample_indices = sample_indices[rng.binomial(1, .8, n_samples) == 1]
+
+    results = []
+    for context_n_threads in (1, n_threads):
+        context = SplittingContext(n_features, binned_features, n_bins,
+                                   all_gradients, all_hessians, 0., 1e-3,
+                                   None, 0., None, None, None, None,
+                                   histogram_method)
+        # Pretend that there are more threads than available, with the
+        # corresponding buffers.
+        shape = (context_n_threads, n_features * n_bins)
+        context.n_threads = context_n_threads
+        context.thread_gradients = np.zeros(shape, dtype=np.float32)
+        context.thread_hessians = np.zeros(shape, dtype=np.float32)
+        context.thread_count = np.zeros(shape, dtype=np.uint32)
+        results.append(find_node_split(context, sample_indices))
+    (si_serial, hists_serial), (si_parallel, hists_parallel) = results
+
+    assert_array_equal(hists_serial.count, hists_parallel.count)
+    # Only the order of the float32 sums differs.
+    assert_allclose(hists_serial.sum_gradients, hists_parallel.sum_gradients,
+                    rtol=1e-5, atol=1e-3)
+    assert_allclose(hists_serial.sum_hessians, hists_parallel.sum_hessians,
+                    rtol=1e-5)
+    assert si_serial.feature_idx == si_parallel.feature_idx
+    assert si_serial.bin_idx == si_parallel.bin_idx